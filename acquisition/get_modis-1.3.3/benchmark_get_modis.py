@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark for get_modis.py, run against the local `FakeDAAC`.
+
+For each concurrency setting this lists and downloads the whole fake
+product tree into a fresh temporary directory, and reports how long the
+listing took, the download rate in files/s and MB/s, and the retry overhead:
+how many more granule requests and bytes the server had to send than the
+bare minimum. Latency and failures are injected by the fake server, so the
+numbers can be compared between versions of the downloader without going
+anywhere near e4ftl01.
+
+    $ python benchmark_get_modis.py --workers 1,4,16 --latency 0.05 \
+        --failure-rate 0.1 --dates 8 --size 2000000
+"""
+import logging
+import optparse
+import os
+import shutil
+import tempfile
+import time
+
+import get_modis
+from fake_daac import FakeDAAC
+from modis_catalog import RemoteCatalog
+from modis_writer import DURABILITY_MODES, GranuleWriter
+
+
+def run_benchmark(daac, n_workers, verify=True, durability="file"):
+    """List and download everything on `daac` with `n_workers` workers,
+    writing with the given `GranuleWriter` durability.
+
+    Returns
+    -------
+    A dict of timings and counts.
+    """
+    out_dir = tempfile.mkdtemp(prefix="get_modis_benchmark_")
+    try:
+        daac.reset_stats()
+        catalog = RemoteCatalog(os.path.join(out_dir, "catalog.sqlite"))
+        t0 = time.time()
+        them_urls = get_modis.get_modis_urls(
+            daac.platform, daac.product, int(daac.dates[0][:4]), None, None,
+            base_url=daac.base_url, out_dir=out_dir, catalog=catalog,
+            n_workers=n_workers)
+        t1 = time.time()
+        failed = get_modis.download_files(
+            them_urls, daac.username, daac.password, out_dir=out_dir,
+            n_workers=n_workers, cookie_file=None, verify=verify,
+            writer=GranuleWriter(durability))
+        t2 = time.time()
+        catalog.close()
+        n_files = len(them_urls) - len(failed)
+        payload = n_files * daac.granule_size
+        stats = dict(daac.stats)
+        return {
+            "workers": n_workers,
+            "files": n_files,
+            "failed": len(failed),
+            "list_s": t1 - t0,
+            "download_s": t2 - t1,
+            "files_per_s": n_files / (t2 - t1),
+            "mb_per_s": payload / (t2 - t1) / 1e6,
+            "extra_requests": stats["granule_requests"] - n_files,
+            "byte_overhead": (stats["bytes_sent"] - payload) / float(payload)
+            if payload else 0.,
+            "logins": stats["logins"],
+        }
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def print_results(results):
+    print("%7s %6s %6s %8s %10s %8s %8s %8s %9s %6s" % (
+        "workers", "files", "failed", "list s", "download s", "files/s",
+        "MB/s", "retries", "overhead", "logins"))
+    for r in results:
+        print("%7d %6d %6d %8.2f %10.2f %8.1f %8.1f %8d %8.1f%% %6d" % (
+            r["workers"], r["files"], r["failed"], r["list_s"],
+            r["download_s"], r["files_per_s"], r["mb_per_s"],
+            r["extra_requests"], 100 * r["byte_overhead"], r["logins"]))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("--workers", dest="workers", default="1,2,4,8,16",
+                      help="Comma separated concurrency settings to try")
+    parser.add_option("--dates", dest="n_dates", type=int, default=4,
+                      help="Number of dates in the fake product")
+    parser.add_option("--size", dest="granule_size", type=int,
+                      default=1024 * 1024, help="Granule size in bytes")
+    parser.add_option("--latency", dest="latency", type=float, default=0.02,
+                      help="Seconds the server waits before each response")
+    parser.add_option("--failure-rate", dest="failure_rate", type=float,
+                      default=0., help="Fraction of transfers cut off")
+    parser.add_option("--error-rate", dest="error_rate", type=float,
+                      default=0., help="Fraction of granule requests to 503")
+    parser.add_option("--no-verify", dest="verify", action="store_false",
+                      default=True, help="Don't check the granule checksums")
+    parser.add_option("--fsync", dest="durability", type="choice",
+                      choices=list(DURABILITY_MODES), default="file",
+                      help="GranuleWriter durability: file, group or none")
+    (options, args) = parser.parse_args()
+
+    get_modis.LOG.setLevel(logging.WARNING)
+    with FakeDAAC(n_dates=options.n_dates,
+                  granule_size=options.granule_size,
+                  latency=options.latency,
+                  failure_rate=options.failure_rate,
+                  error_rate=options.error_rate) as daac:
+        # the fake login host is not the real one
+        get_modis.URS_HOST = daac.urs_host
+        results = [run_benchmark(daac, int(n), verify=options.verify,
+                                 durability=options.durability)
+                   for n in options.workers.split(",")]
+    print_results(results)
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the MODIS DAAC (e4ftl01), for testing and benchmarking
+get_modis.py without touching the real server.
+
+`FakeDAAC` serves a synthetic product tree over HTTP from a background
+thread:
+
+  * /PLATFORM/PRODUCT/ - the product index, one [DIR] line per date
+  * /PLATFORM/PRODUCT/YYYY.MM.DD/ - the date listing, in the same Apache
+    table format as the DAAC, with an ETag so conditional requests work
+  * the granules themselves: made-up bytes of a fixed size, with Range
+    support, and an .hdf.xml sidecar giving the size and cksum checksum
+
+Granule requests without a session cookie are sent through a URS-style login:
+a redirect to a different host name (`urs_host`, by default "localhost" while
+the data is served from 127.0.0.1), which checks the basic auth credentials
+and then redirects back via a callback that sets the cookie.
+
+Latency and failures can be injected: every request can be delayed, a
+fraction of granule transfers can be cut off half way through, and a
+fraction of requests can be answered with a 503. `stats` counts what was
+served so that retry overheads can be measured.
+
+It can also be run on its own, to poke at by hand:
+
+    $ python fake_daac.py --port 8080 --latency 0.05 --failure-rate 0.1
+"""
+import base64
+import optparse
+import random
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, quote, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import quote
+    from urlparse import parse_qs, urlparse
+
+from modis_verify import GranuleChecksum
+
+SESSION_COOKIE = "DATA"
+
+GRANULE_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<GranuleMetaDataFile>
+  <GranuleURMetaData>
+    <DataFiles>
+      <DataFileContainer>
+        <DistributedFileName>%(fname)s</DistributedFileName>
+        <FileSize>%(size)d</FileSize>
+        <ChecksumType>CKSUM</ChecksumType>
+        <Checksum>%(checksum)s</Checksum>
+        <ChecksumOrigin>PDR</ChecksumOrigin>
+      </DataFileContainer>
+    </DataFiles>
+  </GranuleURMetaData>
+</GranuleMetaDataFile>
+"""
+
+INDEX_HEAD = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">
+<html>
+ <head>
+  <title>Index of %(path)s</title>
+ </head>
+ <body>
+<h1>Index of %(path)s</h1>
+  <table>
+   <tr><th valign="top"><img src="/icons/blank.gif" alt="[ICO]"></th><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th><th><a href="?C=S;O=A">Size</a></th><th><a href="?C=D;O=A">Description</a></th></tr>
+   <tr><th colspan="5"><hr></th></tr>
+<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td><td><a href="/%(parent)s">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td><td>&nbsp;</td></tr>
+"""
+INDEX_DIR = """<tr><td valign="top"><img src="/icons/folder.gif" alt="[DIR]"></td><td><a href="%(name)s/">%(name)s/</a></td><td align="right">%(modified)s  </td><td align="right">  - </td><td>&nbsp;</td></tr>
+"""
+INDEX_FILE = """<tr><td valign="top"><img src="/icons/unknown.gif" alt="[   ]"></td><td><a href="%(name)s">%(name)s</a></td><td align="right">%(modified)s  </td><td align="right">%(size)s</td><td>&nbsp;</td></tr>
+"""
+INDEX_TAIL = """   <tr><th colspan="5"><hr></th></tr>
+</table>
+</body></html>
+"""
+
+DEFAULT_TILES = ["h17v07", "h18v07", "h19v07", "h20v07", "h17v08", "h18v08",
+                 "h19v08", "h20v08"]
+
+
+def _human_size(size):
+    """Sizes as Apache's index pages show them."""
+    for unit in ("", "K", "M", "G"):
+        if size < 1024 or unit == "G":
+            if unit and size < 10:
+                return "%.1f%s" % (size, unit)
+            return "%d%s" % (size, unit)
+        size /= 1024.
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients hanging up mid-transfer is business as usual here
+        pass
+
+
+class FakeDAAC(object):
+    """A synthetic DAAC product tree served from a background thread.
+
+    Parameters
+    ----------
+    platform: str
+        The platform directory, e.g. MOTA
+    product: str
+        The product, with collection, e.g. MCD43B4.005
+    year: int
+        The year of the (8-daily) dates to serve
+    n_dates: int
+        How many dates to serve, starting from day 1
+    tiles: list
+        The tiles served for each date
+    granule_size: int
+        The size of every granule in bytes
+    latency: float
+        Seconds to wait before answering each request
+    failure_rate: float
+        Fraction of granule transfers that get cut off half way through
+    error_rate: float
+        Fraction of granule (and .hdf.xml) requests answered with a 503
+    username, password: str
+        The credentials that the fake URS accepts
+    urs_host: str
+        The host name that logins are redirected to. It must differ from
+        `host` for the redirect to look like the real thing.
+    host, port: str, int
+        Where to listen. Port 0 picks a free port.
+    seed: int
+        Seed for the failure injection and the granule contents
+    """
+
+    def __init__(self, platform="MOTA", product="MCD43B4.005", year=2004,
+                 n_dates=4, tiles=None, granule_size=1024 * 1024, latency=0.,
+                 failure_rate=0., error_rate=0., username="user",
+                 password="pass", urs_host="localhost", host="127.0.0.1",
+                 port=0, seed=0):
+        self.platform = platform
+        self.product = product
+        self.tiles = tiles or DEFAULT_TILES
+        self.granule_size = granule_size
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.username = username
+        self.password = password
+        self.urs_host = urs_host
+        self.host = host
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+        self.dates = [time.strftime("%Y.%m.%d", time.strptime(
+            "%d/%d" % (doy, year), "%j/%Y"))
+            for doy in range(1, 1 + 8 * n_dates, 8)]
+        # all granules share the same made-up contents, only the name varies
+        block = bytes(bytearray(random.Random(seed).getrandbits(8)
+                                for i in range(65536)))
+        self._body = (block * (granule_size // len(block) + 1))[:granule_size]
+        checksum = GranuleChecksum("CKSUM")
+        checksum.update(self._body)
+        self._checksum = checksum.hexdigest()
+        self._token = "%016x" % random.Random(seed).getrandbits(64)
+        self._server = _Server((host, port), self._handler_class())
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "http://%s:%d" % (self.host, self.port)
+
+    @property
+    def product_url(self):
+        return "%s/%s/%s/" % (self.base_url, self.platform, self.product)
+
+    def granule_names(self, date):
+        short_name, collection = self.product.split(".")
+        doy = time.strftime("%Y%j", time.strptime(date, "%Y.%m.%d"))
+        return ["%s.A%s.%s.%s.2006268133546.hdf" % (short_name, doy, tile,
+                                                    collection)
+                for tile in self.tiles]
+
+    @property
+    def n_granules(self):
+        return len(self.dates) * len(self.tiles)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats = {"requests": 0, "granule_requests": 0,
+                          "bytes_sent": 0, "logins": 0, "truncated": 0,
+                          "errors": 0, "not_modified": 0}
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _chance(self, rate):
+        if rate <= 0:
+            return False
+        with self._random_lock:
+            return self._random.random() < rate
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handler_class(self):
+        daac = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code, body=b"", headers=None):
+                self.send_response(code)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+                    daac._count("bytes_sent", len(body))
+
+            def _redirect(self, location, headers=None):
+                headers = dict(headers or {})
+                headers["Location"] = location
+                self._send(302, b"", headers)
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                daac._count("requests")
+                if daac.latency > 0:
+                    time.sleep(daac.latency)
+                url = urlparse(self.path)
+                host = self.headers.get("Host", "").split(":")[0]
+                if host == daac.urs_host:
+                    return self._urs(url)
+                if url.path == "/urs_callback":
+                    return self._callback(url)
+                parts = [p for p in url.path.split("/") if p]
+                if parts[:2] != [daac.platform, daac.product]:
+                    return self._send(404)
+                if len(parts) == 2:
+                    return self._index()
+                if len(parts) == 3:
+                    return self._listing(parts[2])
+                if len(parts) == 4:
+                    return self._granule(parts[2], parts[3])
+                return self._send(404)
+
+            def _urs(self, url):
+                auth = self.headers.get("Authorization", "")
+                expected = "Basic " + base64.b64encode(
+                    ("%s:%s" % (daac.username, daac.password)).encode()
+                ).decode()
+                if auth != expected:
+                    return self._send(401, b"Unauthorized")
+                daac._count("logins")
+                redirect = parse_qs(url.query)["redirect"][0]
+                self._redirect("%s/urs_callback?code=%s&redirect=%s" %
+                               (daac.base_url, daac._token, quote(redirect)))
+
+            def _callback(self, url):
+                query = parse_qs(url.query)
+                if query.get("code") != [daac._token]:
+                    return self._send(401, b"Bad code")
+                self._redirect(query["redirect"][0], {
+                    "Set-Cookie": "%s=%s; Path=/" % (SESSION_COOKIE,
+                                                     daac._token)})
+
+            def _index(self):
+                body = INDEX_HEAD % {"path": self.path, "parent": daac.platform}
+                for date in daac.dates:
+                    body += INDEX_DIR % {"name": date,
+                                         "modified": "2015-06-01 10:00"}
+                self._send(200, (body + INDEX_TAIL).encode(),
+                           {"Content-Type": "text/html"})
+
+            def _listing(self, date):
+                if date not in daac.dates:
+                    return self._send(404)
+                etag = '"%s-%s"' % (daac._token, date)
+                if self.headers.get("If-None-Match") == etag:
+                    daac._count("not_modified")
+                    return self._send(304, b"", {"ETag": etag})
+                body = INDEX_HEAD % {"path": self.path,
+                                     "parent": daac.platform + "/" +
+                                     daac.product + "/"}
+                for fname in daac.granule_names(date):
+                    body += INDEX_FILE % {
+                        "name": fname, "modified": "2006-09-25 14:02",
+                        "size": _human_size(daac.granule_size)}
+                    body += INDEX_FILE % {
+                        "name": fname + ".xml", "modified": "2006-09-25 14:02",
+                        "size": "7.5K"}
+                self._send(200, (body + INDEX_TAIL).encode(),
+                           {"Content-Type": "text/html", "ETag": etag})
+
+            def _logged_in(self):
+                cookie = "%s=%s" % (SESSION_COOKIE, daac._token)
+                return cookie in self.headers.get("Cookie", "")
+
+            def _granule(self, date, fname):
+                if date not in daac.dates:
+                    return self._send(404)
+                is_xml = fname.endswith(".hdf.xml")
+                hdf_name = fname[:-4] if is_xml else fname
+                if hdf_name not in daac.granule_names(date):
+                    return self._send(404)
+                if not self._logged_in():
+                    return self._redirect(
+                        "http://%s:%d/urs/authorize?redirect=%s" %
+                        (daac.urs_host, daac.port,
+                         quote("%s%s" % (daac.base_url, self.path))))
+                if not is_xml:
+                    daac._count("granule_requests")
+                # the metadata sidecars get throttled too
+                if daac._chance(daac.error_rate):
+                    daac._count("errors")
+                    return self._send(503, b"Service Unavailable",
+                                      {"Retry-After": "1"})
+                if is_xml:
+                    body = GRANULE_XML % {"fname": fname[:-4],
+                                          "size": daac.granule_size,
+                                          "checksum": daac._checksum}
+                    return self._send(200, body.encode(),
+                                      {"Content-Type": "text/xml"})
+                self._send_granule()
+
+            def _send_granule(self):
+                body = daac._body
+                size = len(body)
+                start = 0
+                code = 200
+                headers = {"Content-Type": "application/octet-stream",
+                           "Accept-Ranges": "bytes"}
+                range_header = self.headers.get("Range")
+                if range_header and range_header.startswith("bytes="):
+                    start = int(range_header[6:].split("-")[0])
+                    if start >= size:
+                        return self._send(416, b"", {
+                            "Content-Range": "bytes */%d" % size})
+                    code = 206
+                    headers["Content-Range"] = "bytes %d-%d/%d" % (
+                        start, size - 1, size)
+                payload = body[start:]
+                if not daac._chance(daac.failure_rate):
+                    return self._send(code, payload, headers)
+                # promise the whole thing, deliver half and hang up
+                daac._count("truncated")
+                self.send_response(code)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                half = payload[:len(payload) // 2]
+                self.wfile.write(half)
+                daac._count("bytes_sent", len(half))
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("--port", dest="port", type=int, default=8080)
+    parser.add_option("--platform", dest="platform", default="MOTA")
+    parser.add_option("--product", dest="product", default="MCD43B4.005")
+    parser.add_option("--year", dest="year", type=int, default=2004)
+    parser.add_option("--dates", dest="n_dates", type=int, default=4)
+    parser.add_option("--size", dest="granule_size", type=int,
+                      default=1024 * 1024, help="Granule size in bytes")
+    parser.add_option("--latency", dest="latency", type=float, default=0.,
+                      help="Seconds to wait before each response")
+    parser.add_option("--failure-rate", dest="failure_rate", type=float,
+                      default=0., help="Fraction of transfers to cut off")
+    parser.add_option("--error-rate", dest="error_rate", type=float,
+                      default=0., help="Fraction of requests to 503")
+    (options, args) = parser.parse_args()
+    daac = FakeDAAC(platform=options.platform, product=options.product,
+                    year=options.year, n_dates=options.n_dates,
+                    granule_size=options.granule_size,
+                    latency=options.latency,
+                    failure_rate=options.failure_rate,
+                    error_rate=options.error_rate, port=options.port)
+    print("Serving %s" % daac.product_url)
+    try:
+        daac._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -22,14 +22,35 @@ try:
     import urllib.request as urllib2
 except ImportError:
     import urllib2
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+try:
+    from http.cookiejar import LWPCookieJar, LoadError
+except ImportError:
+    from cookielib import LWPCookieJar, LoadError
 import time
 import calendar
+import datetime
 import logging
 import sys
 import fnmatch
+import re
+import threading
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
+from modis_crawler import ListingCrawler, parse_granule_name
+from modis_tiles import as_tile_set, resolve_aoi
+from modis_verify import GranuleChecksum, fetch_granule_metadata
+from modis_writer import ALLOC_SUFFIX, DONE_SUFFIX, DURABILITY_MODES, \
+    PART_SUFFIX, GranuleWriter
+from modis_retry import DownloadError, DownloadScheduler, HostThrottle, \
+    RetryPolicy, parse_retry_after, seconds_until_maintenance_over
+from modis_catalog import RemoteCatalog, default_catalog_path, \
+    DEFAULT_CATALOG_NAME
+
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 
@@ -46,6 +67,7 @@ SYNOPSIS
 [--verbose, -v] [--platform=PLATFORM, -s PLATFORM]    [--proxy=PROXY -p PROXY]     
 [--product=PRODUCT, -p PRODUCT] [--tile=TILE, -t TILE]     [--year=YEAR, -y YEAR] 
 [--output=DIR_OUT, -o DIR_OUT]     [--begin=DOY_START, -b DOY_START] [--end=DOY_END, -e DOY_END]
+[--jobs=N_WORKERS, -j N_WORKERS] [--aoi=AOI, -a AOI]
 
 DESCRIPTION
 
@@ -71,6 +93,28 @@ EXAMPLES
     $ ./get_modis.py -v -p MCD45A1.005 -s MOTA -y 2004 -t h17v04 -o /tmp/ \
         -b 153 -e 243
 
+    Several products and years can be requested in one go, and all the
+    granules are then downloaded by a single pool of worker threads. Here
+    8 transfers are kept in flight for two products over 2000-2014:
+
+    $ ./get_modis.py -v -p MCD43B4.005,MOD11A2.005 -s MOTA -y 2000-2014 \
+        -o /tmp/ -j 8
+
+    Downloads can be restricted to an area of interest, given as a lon/lat
+    bounding box (west,south,east,north), a CSV of tiles with h and v columns,
+    or a list of tiles. Only the tiles of the sinusoidal grid that intersect
+    the area are downloaded:
+
+    $ ./get_modis.py -v -p MCD43B4.005 -s MOTA -y 2004 -o /tmp/ \
+        -a -18,-35,52,38
+
+    For keeping a local copy up to date (e.g. from a daily cron job), --sync
+    downloads whatever has been published since the last date that was
+    completely downloaded, which is remembered in the catalog. The first
+    time round it needs to be told where to start:
+
+    $ ./get_modis.py -p MOD11A2.006 -s MOLT -o /data/ --sync --since 2017.01.01
+
 
 EXIT STATUS
     No exit status yet, can't be bothered.
@@ -88,11 +132,24 @@ OUT_HDLR.setFormatter( logging.Formatter( '%(asctime)s %(message)s') )
 OUT_HDLR.setLevel( logging.INFO )
 LOG.addHandler( OUT_HDLR )
 LOG.setLevel( logging.INFO )
+logging.getLogger( "modis_retry" ).addHandler( OUT_HDLR )
+logging.getLogger( "modis_retry" ).setLevel( logging.INFO )
 
 HEADERS = { 'User-Agent' : 'get_modis Python %s' % __version__ }
 
 CHUNKS = 65536
 
+# where EarthData logins get redirected to
+URS_HOST = "urs.earthdata.nasa.gov"
+
+# with --sync, dates newer than this many days that don't have every wanted
+# tile are listed again on every sync, as the DAAC may still be adding to them
+HOLD_BACK_DAYS = 30
+
+# the login cookies are kept here between runs
+DEFAULT_COOKIE_FILE = os.path.join(os.path.expanduser("~"),
+                                   ".get_modis_cookies")
+
 # HSG: Fix SSL bug - http://askubuntu.com/a/346159
 import functools
 import ssl
@@ -104,19 +161,41 @@ def ubuntu_openssl_bug_965371(self, *args, **kwargs):
   old_init(self, *args, **kwargs)
 ssl.SSLSocket.__init__ = ubuntu_openssl_bug_965371
 def return_url(url):
-    the_day_today = time.asctime().split()[0]
-    the_hour_now = int(time.asctime().split()[3].split(":")[0])
-    if the_day_today == "Wed" and 14 <= the_hour_now <= 17:
-       pass
-       # LOG.info("Sleeping for %d hours... Yawn!" % (18 - the_hour_now))
-        #time.sleep(60 * 60 * (18 - the_hour_now))
+    wait = seconds_until_maintenance_over()
+    if wait > 0:
+        LOG.info("Sleeping for %.1f hours... Yawn!" % (wait / 3600.))
+        time.sleep(wait)
 
     req = urllib2.Request("%s" % (url), None, HEADERS)
     html = urllib2.urlopen(req).readlines()
     return html
 
 
-def parse_modis_dates ( url, dates, product, out_dir, checkExistingDates=False ):
+def list_modis_dates(url):
+    """Get all the date directories listed on a product's index page.
+
+    Parameters
+    ----------
+    url: str
+        A URL such as "http://e4ftl01.cr.usgs.gov/MOTA/MCD45A1.005/"
+    Returns
+    -------
+    A list of the directory names, normally dates as "YYYY.MM.DD".
+    """
+    html = return_url(url)
+    available_dates = []
+    for line in html:
+
+        if line.decode().find("href") >= 0 and \
+                        line.decode().find("[DIR]") >= 0:
+            # Points to a directory
+            the_date = line.decode().split('href="')[1].split('"')[0].strip("/")
+            available_dates.append(the_date)
+    return available_dates
+
+
+def parse_modis_dates ( url, dates, product, out_dir, checkExistingDates=False,
+                        catalog=None ):
     """Parse returned MODIS dates.
 
     This function gets the dates listing for a given MODIS products, and
@@ -139,55 +218,697 @@ def parse_modis_dates ( url, dates, product, out_dir, checkExistingDates=False )
         The output dir
     checkExistingDates: bool
         Whether to check for present files
+    catalog: RemoteCatalog
+        If given, the product's date listing is taken from this cache when
+        it's fresh enough, and stored in it when it has to be fetched.
     Returns
     -------
     A (sorted) list with the dates that will be downloaded.
     """
+    available_dates = None
+    if catalog is not None:
+        available_dates = catalog.get_dates(product)
+    if available_dates is None:
+        available_dates = list_modis_dates(url)
+        if catalog is not None:
+            catalog.set_dates(product, available_dates)
+
     if checkExistingDates:
-        product = product.split(".")[0]
         already_here = fnmatch.filter(os.listdir(out_dir),
-                                      "%s*hdf" % product)
-        already_here_dates = [x.split(".")[-5][1:]
-                              for x in already_here]
-
-    html = return_url(url)
-
-    available_dates = []
-    for line in html:
-
-        if line.decode().find("href") >= 0 and \
-                        line.decode().find("[DIR]") >= 0:
-            # Points to a directory
-            the_date = line.decode().split('href="')[1].split('"')[0].strip("/")
-            if checkExistingDates:
-                try:
-                    modis_date = time.strftime("%Y%j",
-                                               time.strptime(the_date,
-                                                             "%Y.%m.%d"))
-                except ValueError:
-                    continue
-                if modis_date in already_here_dates:
-                    continue
-                else:
-                    available_dates.append(the_date)
-            else:
-                available_dates.append(the_date)
+                                      "%s*hdf" % product.split(".")[0])
+        already_here_dates = set([x.split(".")[-5][1:]
+                                  for x in already_here])
+        not_here_dates = []
+        for the_date in available_dates:
+            try:
+                modis_date = time.strftime("%Y%j",
+                                           time.strptime(the_date,
+                                                         "%Y.%m.%d"))
+            except ValueError:
+                continue
+            if modis_date not in already_here_dates:
+                not_here_dates.append(the_date)
+        available_dates = not_here_dates
 
     dates = set(dates)
     available_dates = set(available_dates)
     suitable_dates = list(dates.intersection(available_dates))
     suitable_dates.sort()
     #print checkExistingDates
-    print suitable_dates
+    print(suitable_dates)
     #print available_dates
     return suitable_dates
 
 
-def get_modisfiles(username, password, platform, product, year, tile, proxy,
+def parse_years(years):
+    """Parse a year specification such as "2000-2014,2016" into a list.
+
+    Parameters
+    ----------
+    years: str
+        A comma separated list of years and/or inclusive year ranges.
+    Returns
+    -------
+    A sorted list of integer years.
+    """
+    the_years = set()
+    for chunk in str(years).split(","):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        if "-" in chunk:
+            first, last = chunk.split("-")
+            the_years.update(range(int(first), int(last) + 1))
+        else:
+            the_years.add(int(chunk))
+    return sorted(the_years)
+
+
+def get_modis_urls(platform, product, year, tile, proxy,
                    doy_start=1, doy_end=-1,
                    base_url="http://e4ftl01.cr.usgs.gov", out_dir=".",
-                   checkExistingDates=False, checkExistingTiles=False, get_xml=False, verbose=False):
+                   checkExistingDates=False, checkExistingTiles=False,
+                   get_xml=False, verbose=False, catalog=None,
+                   n_workers=8):
+    """Work out the granule URLs to download for a product, year & period.
 
+    This scrapes the remote index pages for every date of interest and
+    returns the URLs of the granules that are not yet present in `out_dir`.
+    Parameters are as for `get_modisfiles`. If a `RemoteCatalog` is given,
+    index pages that have been crawled recently are taken from it instead
+    of the server. Up to `n_workers` date listings are fetched at once.
+
+    Returns
+    -------
+    A list of granule URLs.
+    """
+    if proxy is not None:
+        proxy = urllib2.ProxyHandler(proxy)
+        opener = urllib2.build_opener(proxy)
+        urllib2.install_opener(opener)
+
+    if not os.path.exists(out_dir):
+        if verbose:
+            LOG.info("Creating outupt dir %s" % out_dir)
+        os.makedirs(out_dir)
+    if doy_end == -1:
+        if calendar.isleap(year):
+            doy_end = 367
+        else:
+            doy_end = 366
+    print("checking existing dates? "+str(checkExistingDates))
+    dates = [time.strftime("%Y.%m.%d", time.strptime("%d/%d" % (i, year),
+                                                     "%j/%Y")) for i in
+             range(doy_start, doy_end)]
+    url = "%s/%s/%s/" % (base_url, platform, product)
+    dates = parse_modis_dates(url, dates, product, out_dir,
+                              checkExistingDates=checkExistingDates,
+                              catalog=catalog)
+    crawler = ListingCrawler(catalog=catalog, n_workers=n_workers,
+                             headers=HEADERS)
+    listings = crawler.list_dates(url, product, dates)
+    tiles = as_tile_set(tile)
+    them_urls = []
+    for date in dates:
+        if date not in listings:
+            LOG.info("Couldn't get the listing for %s%s" % (url, date))
+            continue
+        for fname in _wanted_granules(listings[date], tiles, get_xml):
+            if not os.path.exists(os.path.join(out_dir, fname)):
+                them_urls.append("%s%s/%s" % (url, date, fname))
+            else:
+                if verbose:
+                    LOG.info("File %s already present. Skipping" % fname)
+    return them_urls
+
+
+def _wanted_granules(granules, tiles, get_xml=False):
+    """The filenames to download from a date listing, given a tile filter."""
+    fnames = []
+    for granule in granules:
+        if tiles is not None and granule.tile not in tiles:
+            continue
+        if granule.filename.endswith(".hdf.xml") and 1: #not get_xml:
+            continue
+        fnames.append(granule.filename)
+    return fnames
+
+
+def get_sync_urls(platform, product, tile, catalog,
+                  base_url="http://e4ftl01.cr.usgs.gov", out_dir=".",
+                  since=None, n_workers=8, verbose=False):
+    """Work out the granule URLs needed to bring a product up to date.
+
+    Rather than a year and range of days, this works from the product's
+    high-water mark in the catalog: the last date for which every granule
+    has been downloaded. Only date directories newer than that are listed
+    (always asking the server, as recent directories are still filling up).
+
+    Parameters
+    ----------
+    platform: str
+        One of three: MOLA, MOLT MOTA
+    product: str
+        The product name, with collection
+    tile: str or list
+        As for `get_modisfiles`
+    catalog: RemoteCatalog
+        Where the high-water mark and listings are kept
+    base_url: str, url
+        The URL to use. Shouldn't be changed, unless USGS change the server.
+    out_dir: str
+        The output directory
+    since: str
+        The date ("YYYY.MM.DD") to start from if the product has no
+        high-water mark yet. Dates after this one are downloaded.
+    n_workers: int
+        How many date listings to fetch at once
+    verbose: Boolean
+        Whether to sprout lots of text out or not.
+    Returns
+    -------
+    A (them_urls, pending) tuple: the URLs to download, and a dict of
+    date: granule filenames for every date after the mark, to be passed
+    to `advance_watermark` once the downloads are done.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    url = "%s/%s/%s/" % (base_url, platform, product)
+    mark = catalog.get_watermark(product) or since
+    if mark is None:
+        raise ValueError("No high-water mark for %s yet, so we need a date "
+                         "to start from" % product)
+    available_dates = list_modis_dates(url)
+    catalog.set_dates(product, available_dates)
+    new_dates = sorted(d for d in available_dates
+                       if re.match(r"^\d{4}\.\d{2}\.\d{2}$", d) and d > mark)
+    LOG.info("%s is complete up to %s, %d newer dates available" %
+             (product, mark, len(new_dates)))
+    crawler = ListingCrawler(catalog=catalog, n_workers=n_workers,
+                             headers=HEADERS, revalidate=True)
+    listings = crawler.list_dates(url, product, new_dates)
+    tiles = as_tile_set(tile)
+    them_urls = []
+    pending = {}
+    for date in new_dates:
+        if date not in listings:
+            LOG.info("Couldn't get the listing for %s%s" % (url, date))
+            break
+        pending[date] = _wanted_granules(listings[date], tiles)
+        for fname in pending[date]:
+            if not os.path.exists(os.path.join(out_dir, fname)):
+                them_urls.append("%s%s/%s" % (url, date, fname))
+            elif verbose:
+                LOG.info("File %s already present. Skipping" % fname)
+    return them_urls, pending
+
+
+def _date_is_settled(date, today, hold_back_days):
+    """Whether a "YYYY.MM.DD" date is more than hold_back_days before today,
+    so the DAAC should have finished publishing it."""
+    when = datetime.datetime.strptime(date, "%Y.%m.%d").date()
+    return (today - when).days > hold_back_days
+
+
+def advance_watermark(catalog, product, pending, out_dir=".", tiles=None,
+                      hold_back_days=HOLD_BACK_DAYS, today=None):
+    """Move a product's high-water mark past the dates that are complete.
+
+    The mark only moves forward over an unbroken run of complete dates.
+    Granules only get their final name once they're completely downloaded
+    (and verified), so being present is enough. But a recent date's
+    directory may still be filling up, so having everything it lists now
+    isn't enough: a date is complete once there is a granule for every tile
+    in `tiles`, or, failing that (or with no tile filter), once everything
+    listed is present and the date is more than `hold_back_days` old. Until
+    then it stays after the mark and gets listed again on every sync.
+
+    Parameters
+    ----------
+    catalog: RemoteCatalog
+        Where the high-water mark is kept
+    product: str
+        The product name, with collection
+    pending: dict
+        date: granule filenames, as from `get_sync_urls`
+    out_dir: str
+        The output directory
+    tiles: set
+        The tiles a complete date has, e.g. the AOI (None for all tiles)
+    hold_back_days: int
+        How long to keep re-listing a date that doesn't have all of `tiles`
+    today: datetime.date
+        For testing, default today
+    Returns
+    -------
+    The new high-water mark (which may be unchanged, or None).
+    """
+    mark = catalog.get_watermark(product)
+    today = today or datetime.date.today()
+    for date in sorted(pending):
+        present = [fname for fname in pending[date]
+                   if os.path.exists(os.path.join(out_dir, fname))]
+        have_tiles = set(parse_granule_name(fname)[0] for fname in present)
+        if tiles and have_tiles >= set(tiles):
+            mark = date
+            continue
+        if len(present) < len(pending[date]) or \
+                not _date_is_settled(date, today, hold_back_days):
+            # something missing, or it may still be on its way (including a
+            # date with nothing of interest published yet). once settled, a
+            # date with nothing wanted on it is as complete as it will get
+            break
+        mark = date
+    if mark is not None:
+        catalog.set_watermark(product, mark)
+        LOG.info("%s is now complete up to %s" % (product, mark))
+    return mark
+
+
+class EarthDataSession(requests.Session):
+    """A `requests.Session` that logs in to EarthData as it goes.
+
+    The DAAC redirects every unauthenticated granule request to the URS
+    login host, and requests normally drops the credentials on a redirect to
+    a different host. Keeping them for the URS host means a granule can be
+    fetched with one streamed GET; once logged in, the DAAC session cookie
+    (which can be shared between sessions, see `load_cookies`) means later
+    requests don't get redirected at all.
+    """
+
+    def __init__(self, username, password, cookies=None):
+        super(EarthDataSession, self).__init__()
+        self.auth = (username, password)
+        self.headers.update(HEADERS)
+        if cookies is not None:
+            self.cookies = cookies
+
+    def rebuild_auth(self, prepared_request, response):
+        headers = prepared_request.headers
+        if 'Authorization' in headers:
+            original = urlparse(response.request.url).hostname
+            redirect = urlparse(prepared_request.url).hostname
+            if original != redirect and \
+                    URS_HOST not in (original, redirect):
+                del headers['Authorization']
+
+
+def load_cookies(cookie_file):
+    """Load the login cookies saved by a previous run, if there are any.
+
+    Parameters
+    ----------
+    cookie_file: str
+        The cookie file, or None to not keep cookies between runs.
+    Returns
+    -------
+    A cookie jar, which can be shared by several `EarthDataSession`s.
+    """
+    cookies = LWPCookieJar(cookie_file)
+    if cookie_file is not None and os.path.exists(cookie_file):
+        try:
+            cookies.load(ignore_discard=True)
+        except (IOError, LoadError):
+            LOG.info("Ignoring unreadable cookie file %s" % cookie_file)
+    return cookies
+
+
+def save_cookies(cookies):
+    """Save the login cookies so that the next run doesn't log in again."""
+    if cookies.filename is None:
+        return
+    cookies.save(ignore_discard=True)
+    # they're as good as a password for as long as they last
+    os.chmod(cookies.filename, 0o600)
+
+
+def authenticate(s, the_url):
+    """Log in once, so that the workers can all reuse the session cookie.
+
+    This requests the granule's (small) .hdf.xml metadata file, which sits
+    behind the same login: the point is just to go through the URS redirect
+    chain (if the cookies we already had weren't good enough) and end up
+    with a valid DAAC session cookie, without the server starting to send a
+    whole granule that we'd then throw away.
+
+    Returns
+    -------
+    True if the login worked.
+    """
+    r = s.get(the_url + ".xml", stream=True)
+    r.close()
+    if not r.ok:
+        LOG.info("Couldn't log in to EarthData: %s" % r)
+    return r.ok
+
+
+def _new_checksum(checksum_type, part_fname=None, offset=0):
+    """Start a checksum of the given type, if we know how to compute it,
+    primed with the first `offset` bytes already in `part_fname`."""
+    if checksum_type is None:
+        return None
+    try:
+        checksum = GranuleChecksum(checksum_type)
+    except ValueError:
+        # a type we can't compute
+        return None
+    if offset > 0:
+        with open(part_fname, 'rb') as fp:
+            remaining = offset
+            while remaining > 0:
+                chunk = fp.read(min(CHUNKS, remaining))
+                if not chunk:
+                    break
+                checksum.update(chunk)
+                remaining -= len(chunk)
+    return checksum
+
+
+def _complete_part_ok(part_fname, size, checksum_type, expected_checksum):
+    """Whether a .part file that's all there has the right checksum (or we
+    can't tell)."""
+    checksum = None
+    if expected_checksum is not None:
+        checksum = _new_checksum(checksum_type, part_fname, size)
+    return checksum is None or checksum.hexdigest() == expected_checksum
+
+
+def get_metadata(s, the_url, verify=True):
+    """The (size, checksum_type, checksum) of a granule for verifying its
+    download, or Nones if there's nothing to check against. A throttled or
+    failing server raises `DownloadError`, to be retried."""
+    if verify:
+        try:
+            return fetch_granule_metadata(s, the_url)
+        except requests.exceptions.RequestException as e:
+            LOG.info("Can't get the metadata for %s, not verifying it: %s" %
+                     (the_url.split("/")[-1], e))
+    return None, None, None
+
+
+def fetch_file(s, the_url, out_dir=".", metadata=(None, None, None),
+               verbose=False, writer=None):
+    """Make one attempt at downloading a granule.
+
+    The granule is written to a temporary file, which is renamed to the
+    granule name only once its length matches what the server said it
+    would be. A failed attempt (in this or a previous run) is left as a
+    ".part" file and resumed with an HTTP Range request from the last byte
+    received rather than from scratch. How the bytes get to disk (buffer
+    size, preallocation, when to fsync) is up to the `GranuleWriter`.
+
+    If the size and checksum of the granule are known from its .hdf.xml
+    metadata, a download of the wrong size is rejected as soon as the
+    server's response headers arrive, and the checksum is worked out as the
+    data streams in and checked before the file is renamed, so a corrupt
+    granule never needs to be read back from disk.
+
+    Parameters
+    ----------
+    s: EarthDataSession
+        A logged-in session. Sessions are not shared between threads.
+    the_url: str
+        The granule URL
+    out_dir: str
+        The output directory
+    metadata: tuple
+        (size, checksum_type, checksum) as from `get_metadata`
+    verbose: Boolean
+        Whether to sprout lots of text out or not.
+    writer: GranuleWriter
+        Writes the granule to disk. Defaults to fsyncing every granule.
+    Raises
+    ------
+    DownloadError, or whatever requests raises, if the attempt failed.
+    """
+    writer = writer or GranuleWriter()
+    fname = the_url.split("/")[-1]
+    out_fname = os.path.join(out_dir, fname)
+    part_fname = out_fname + PART_SUFFIX
+    expected_size, checksum_type, expected_checksum = metadata
+    if os.path.exists(out_fname + ALLOC_SUFFIX):
+        # left over from a crash mid-write, so no telling what's in it
+        os.remove(out_fname + ALLOC_SUFFIX)
+    if os.path.exists(out_fname + DONE_SUFFIX):
+        # completely written by a run that stopped before its group fsync:
+        # check it like a .part file that's all there
+        os.rename(out_fname + DONE_SUFFIX, part_fname)
+    # carry on from wherever a previous attempt (or run) got to
+    offset = 0
+    if os.path.exists(part_fname):
+        offset = os.path.getsize(part_fname)
+    if offset > 0 and offset == expected_size:
+        # all there already, so no need to ask the server
+        if _complete_part_ok(part_fname, offset, checksum_type,
+                             expected_checksum):
+            os.rename(part_fname, out_fname)
+            return
+        os.remove(part_fname)
+        offset = 0
+    headers = {}
+    if offset > 0:
+        headers['Range'] = "bytes=%d-" % offset
+    r = s.get(the_url, stream=True, headers=headers)
+
+    if r.status_code == 416:
+        # either the partial file was in fact complete (we died
+        # before renaming it), or it's no use to the server. there's
+        # nothing more to read, so give the connection back to the pool
+        r.close()
+        total = r.headers.get('content-range', '').split('/')[-1]
+        if total == str(offset) and _complete_part_ok(
+                part_fname, offset, checksum_type, expected_checksum):
+            os.rename(part_fname, out_fname)
+            return
+        os.remove(part_fname)
+        raise DownloadError("Can't resume download... [%s]" % fname)
+    if not r.ok:
+        r.close()
+        raise DownloadError("Can't start download, %s... [%s]" % (r, fname),
+                            status=r.status_code,
+                            retry_after=parse_retry_after(
+                                r.headers.get('retry-after')))
+    if r.status_code != 206:
+        # server ignored the range request, so it's a fresh copy
+        offset = 0
+    file_size = offset + int(r.headers['content-length'])
+    if expected_size is not None and file_size != expected_size:
+        r.close()
+        if offset > 0:
+            os.remove(part_fname)
+        raise DownloadError("Server is sending %d bytes but the metadata "
+                            "says %d [%s]" % (file_size, expected_size, fname))
+    checksum = None
+    if expected_checksum is not None:
+        checksum = _new_checksum(checksum_type, part_fname, offset)
+    if offset > 0:
+        LOG.info("Resuming download on %s(%d of %d bytes) ..." %
+                 (out_fname, offset, file_size))
+    else:
+        LOG.info("Starting download on %s(%d bytes) ..." %
+                 (out_fname, file_size))
+    part = writer.open(out_fname, offset, file_size)
+    try:
+        # small reads off the network, so that little is lost if the
+        # connection drops mid-read; the writer's buffer batches them up
+        for chunk in r.iter_content(chunk_size=CHUNKS):
+            if chunk:
+                part.write(chunk)
+                if checksum is not None:
+                    checksum.update(chunk)
+    except BaseException:
+        # keep whatever did arrive for the next attempt
+        part.abort()
+        raise
+    # only give the file its real name once it's all there, so a
+    # half-written granule never looks like it's already present
+    if part.written != file_size:
+        part.abort()
+        raise DownloadError("Incomplete download, got %d of %d bytes [%s]" %
+                            (part.written, file_size, fname))
+    if checksum is not None and checksum.hexdigest() != expected_checksum:
+        part.discard()
+        raise DownloadError("%s checksum mismatch, got %s expected %s [%s]"
+                            % (checksum_type, checksum.hexdigest(),
+                               expected_checksum, fname))
+    writer.finish(part)
+    if verbose:
+        LOG.info("\tDone!")
+
+
+def download_file(s, the_url, out_dir=".", verbose=False, verify=True,
+                  policy=None, writer=None):
+    """Download a single granule, backing off and retrying on failure.
+
+    See `fetch_file` for how each attempt goes. This is the simple,
+    one-at-a-time version: `download_files` schedules retries itself so that
+    other granules can carry on in the meantime.
+
+    Parameters
+    ----------
+    s: EarthDataSession
+        A logged-in session. Sessions are not shared between threads.
+    the_url: str
+        The granule URL
+    out_dir: str
+        The output directory
+    verbose: Boolean
+        Whether to sprout lots of text out or not.
+    verify: Boolean
+        Whether to check the download against the granule metadata.
+    policy: RetryPolicy
+        How long to back off between attempts, and how many to make.
+    writer: GranuleWriter
+        Writes the granule to disk. With group durability, the caller has
+        to `close` it to make sure the granule gets its real name.
+    Returns
+    -------
+    True if the file was downloaded, False if every attempt failed.
+    """
+    policy = policy or RetryPolicy()
+    fname = the_url.split("/")[-1]
+    metadata = None
+    attempt = 0
+    while True:
+        try:
+            # until we've got it, look the metadata up again on each attempt
+            if metadata is None or metadata[0] is None:
+                metadata = get_metadata(s, the_url, verify)
+            fetch_file(s, the_url, out_dir, metadata, verbose=verbose,
+                       writer=writer)
+        except Exception as e:
+            attempt += 1
+            LOG.info("Attempt %d on %s failed: %s" % (attempt, fname, e))
+            if not policy.should_retry(attempt, e):
+                LOG.info("Giving up on %s after %d attempts" %
+                         (fname, attempt))
+                return False
+            time.sleep(policy.delay(attempt, e))
+        else:
+            return True
+
+
+def download_files(them_urls, username, password, out_dir=".", n_workers=4,
+                   verbose=False, cookie_file=DEFAULT_COOKIE_FILE,
+                   verify=True, policy=None, writer=None):
+    """Download a list of granule URLs with a bounded pool of worker threads.
+
+    The URLs can come from any mix of products, years and dates: they are
+    all fed through one `DownloadScheduler`, so that up to `n_workers`
+    transfers are in flight at any one time from a single process. A
+    granule that fails goes to the back of the queue with an exponential
+    backoff rather than holding up (or aborting) everything else, and is
+    only given up on after `policy.max_attempts` tries. Each server also
+    gets a `HostThrottle`, which cuts the number of simultaneous transfers
+    when the server starts answering 429 / 503, and pauses everything
+    during the DAAC's maintenance window.
+
+    Each worker has its own `EarthDataSession`, but they all share one set
+    of login cookies: we log in once up front, and the cookies are saved to
+    `cookie_file` so that later runs don't have to log in again either.
+
+    Parameters
+    ----------
+    them_urls: list
+        The granule URLs to download
+    username: str
+        The EarthData username string
+    password: str
+        The EarthData password string
+    out_dir: str
+        The output directory
+    n_workers: int
+        The (maximum) number of simultaneous downloads
+    verbose: Boolean
+        Whether to sprout lots of text out or not.
+    cookie_file: str
+        Where to keep the login cookies between runs. None to not keep them.
+    verify: Boolean
+        Whether to check each download against the granule metadata.
+    policy: RetryPolicy
+        How long to back off after failures, and how many attempts to make.
+    writer: GranuleWriter
+        Writes the granules to disk, shared by all the workers. It is
+        flushed before returning, so every granule downloaded is in place.
+    Returns
+    -------
+    A list of the URLs that could not be downloaded.
+    """
+    print("Attempting to download {0!s} files".format(len(them_urls)))
+    if not them_urls:
+        return []
+    cookies = load_cookies(cookie_file)
+    with EarthDataSession(username, password, cookies) as s:
+        if authenticate(s, them_urls[0]):
+            save_cookies(cookies)
+    scheduler = DownloadScheduler(them_urls, policy)
+    writer = writer or GranuleWriter()
+    n_workers = max(1, min(n_workers, len(them_urls)))
+    throttles = {}
+    throttles_lock = threading.Lock()
+    metadata = {}
+
+    def throttle_for(the_url):
+        host = urlparse(the_url).hostname
+        with throttles_lock:
+            if host not in throttles:
+                throttles[host] = HostThrottle(n_workers)
+            return throttles[host]
+
+    def worker():
+        with EarthDataSession(username, password, cookies) as s:
+            while True:
+                the_url = scheduler.get()
+                if the_url is None:
+                    return
+                throttle = throttle_for(the_url)
+                throttle.acquire()
+                error = None
+                try:
+                    granule_metadata = metadata.get(the_url)
+                    if granule_metadata is None:
+                        granule_metadata = get_metadata(s, the_url, verify)
+                        # only keep a lookup that worked, so a failed one
+                        # is tried again on the next attempt
+                        if granule_metadata[0] is not None:
+                            metadata[the_url] = granule_metadata
+                    fetch_file(s, the_url, out_dir, granule_metadata,
+                               verbose=verbose, writer=writer)
+                except Exception as e:
+                    error = e
+                finally:
+                    throttle.release(error)
+                if error is None:
+                    scheduler.done(the_url)
+                    continue
+                fname = the_url.split("/")[-1]
+                attempt = scheduler.attempts(the_url) + 1
+                LOG.info("Attempt %d on %s failed: %s" % (attempt, fname,
+                                                         error))
+                if not scheduler.failed_attempt(the_url, error):
+                    LOG.info("Giving up on %s after %d attempts" %
+                             (fname, attempt))
+
+    threads = [threading.Thread(target=worker) for i in range(n_workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join with a timeout so that Ctrl-C still reaches the main thread
+        while thread.is_alive():
+            thread.join(1)
+    writer.close()
+    save_cookies(cookies)
+    if scheduler.retries:
+        LOG.info("%d retries were needed" % scheduler.retries)
+    return scheduler.failed
+
+
+def get_modisfiles(username, password, platform, product, year, tile, proxy,
+                   doy_start=1, doy_end=-1,
+                   base_url="http://e4ftl01.cr.usgs.gov", out_dir=".",
+                   checkExistingDates=False, checkExistingTiles=False, get_xml=False, verbose=False,
+                   n_workers=4, catalog=None):
     """Download MODIS products for a given tile, year & period of interest
 
     This function uses the `urllib2` module to download MODIS "granules" from
@@ -214,8 +935,10 @@ def get_modisfiles(username, password, platform, product, year, tile, proxy,
         need to specify the collection number (005 in the examples)
     year: int
         The year of interest
-    tile: str
-        The tile (e.g., "h17v04")
+    tile: str or list
+        The tile (e.g., "h17v04"), a list of tiles (see `modis_tiles` for
+        working them out from an area of interest), or '*' or None for
+        all tiles.
     proxy: dict
         A proxy definition, such as {'http': 'http://127.0.0.1:8080', \
         'ftp': ''}, etc.
@@ -237,80 +960,28 @@ def get_modisfiles(username, password, platform, product, year, tile, proxy,
     get_xml: Boolean
         Whether to get the XML metadata files or not. Someone uses them,
         apparently ;-)
+    n_workers: int
+        The number of simultaneous downloads
+    catalog: RemoteCatalog
+        A cache of the remote listings to use, so that reruns don't have to
+        crawl the server again.
     Returns
     -------
     Nothing
     """
 
-    if proxy is not None:
-        proxy = urllib2.ProxyHandler(proxy)
-        opener = urllib2.build_opener(proxy)
-        urllib2.install_opener(opener)
-
-    if not os.path.exists(out_dir):
-        if verbose:
-            LOG.info("Creating outupt dir %s" % out_dir)
-        os.makedirs(out_dir)
-    if doy_end == -1:
-        if calendar.isleap(year):
-            doy_end = 367
-        else:
-            doy_end = 366
-    print "checking existing dates? "+str(checkExistingDates)
-    dates = [time.strftime("%Y.%m.%d", time.strptime("%d/%d" % (i, year),
-                                                     "%j/%Y")) for i in
-             range(doy_start, doy_end)]
-    url = "%s/%s/%s/" % (base_url, platform, product)
-    dates = parse_modis_dates(url, dates, product, out_dir, checkExistingDates=checkExistingDates)
-    them_urls = []
-    for date in dates:
-        formatted = "%s%s" % (url, date)
-        r = requests.get(formatted, verify=False)
-        print(formatted)
-        for line in r.text.split("\n"):
-            #print(line)
-            #if line is not None and line.decode().find(tile) >= 0 or tile == '*':
-            if line is not None :
-                if line.decode().find(".hdf")  >= 0:
-                    fname = line.decode().split("href=")[1].split(">")[0].strip('"')                    
-                    if fname.endswith(".hdf.xml") and 1: #not get_xml:
-                        pass
-                    else:
-                        if not os.path.exists(os.path.join(out_dir, fname)):
-                            them_urls.append("%s/%s/%s" % (url, date, fname))
-                        else:
-                            if verbose:
-                                LOG.info("File %s already present. Skipping" % fname)
-    print("Attempting to download {0!s} files".format(len(them_urls)))        
-    with requests.Session() as s:
-        s.auth = (username, password)
-        for the_url in them_urls:
-            for attempt in range(10):
-                try:
-                    r1 = s.request('get', the_url)
-                    r = s.get(r1.url, stream=True)
-
-                    if not r.ok:
-                        print r
-                        raise IOError("Can't start download... [%s]" % fname)
-                    file_size = int(r.headers['content-length'])
-                    fname = the_url.split("/")[-1]
-                    LOG.info("Starting download on %s(%d bytes) ..." %
-                             (os.path.join(out_dir, fname), file_size))
-                    with open(os.path.join(out_dir, fname), 'wb') as fp:
-                        for chunk in r.iter_content(chunk_size=CHUNKS):
-                            if chunk:
-                                fp.write(chunk)
-                        fp.flush()
-                        os.fsync(fp)
-                        if verbose:
-                            LOG.info("\tDone!")
-                except:
-                    pass
-                else:
-                    break
-            else:
-                raise IOError("conneection error occurred 10 times on "+fname)
+    them_urls = get_modis_urls(platform, product, year, tile, proxy,
+                               doy_start=doy_start, doy_end=doy_end,
+                               base_url=base_url, out_dir=out_dir,
+                               checkExistingDates=checkExistingDates,
+                               checkExistingTiles=checkExistingTiles,
+                               get_xml=get_xml, verbose=verbose,
+                               catalog=catalog, n_workers=n_workers)
+    failed = download_files(them_urls, username, password, out_dir=out_dir,
+                            n_workers=n_workers, verbose=verbose)
+    if failed:
+        raise IOError("Gave up downloading %d files: %s"
+                      % (len(failed), ", ".join(failed)))
     if verbose:
         LOG.info("Completely finished downlading all there was")
 
@@ -329,11 +1000,19 @@ if __name__ == "__main__":
     parser.add_option('-p', '--product', action='store', dest="product",
                       type=str,
                       help="MODIS product name with collection tag at the end " +
-                           "(e.g. MOD09GA.005)")
+                           "(e.g. MOD09GA.005). Several products can be " +
+                           "given separated by commas")
     parser.add_option('-t', '--tile', action="store", dest="tile",
                       type=str, help="Required tile (h17v04, for example)")
+    parser.add_option('-a', '--aoi', action="store", dest="aoi",
+                      type=str, default=None,
+                      help="Area of interest: a bounding box " +
+                           "west,south,east,north in degrees, a CSV file " +
+                           "of h,v tiles, or a list of tiles. With --tile, " +
+                           "only the tiles that are also in this area")
     parser.add_option("-y", "--year", action="store", dest="year",
-                      type=int, help="Year of interest")
+                      type=str, help="Year of interest, or a list/range of " +
+                                     "years such as 2000-2014,2016")
     parser.add_option('-o', '--output', action="store", dest="dir_out",
                       default=".", type=str, help="Output directory")
     parser.add_option('-b', '--begin', action="store", dest="doy_start",
@@ -348,6 +1027,64 @@ if __name__ == "__main__":
     parser.add_option ('-x', '--xml', action="store_true", dest="get_xml",
                      default=False,
                      help="Get the XML metadata files too.")
+    parser.add_option('-j', '--jobs', action="store", dest="n_workers",
+                      type=int, default=4,
+                      help="Number of simultaneous downloads (default 4)")
+    parser.add_option('--retries', action="store", dest="max_attempts",
+                      type=int, default=10,
+                      help="Number of attempts at each file before giving " +
+                           "up on it (default 10)")
+    parser.add_option('-c', '--catalog', action="store", dest="catalog",
+                      type=str, default=None,
+                      help="SQLite cache of the remote listings (default " +
+                           "%s in the output directory)" %
+                           DEFAULT_CATALOG_NAME)
+    parser.add_option('--catalog-max-age', action="store",
+                      dest="catalog_max_age", type=float, default=24.,
+                      help="Re-crawl cached listings older than this many " +
+                           "hours (default 24)")
+    parser.add_option('--refresh', action="store_true", dest="refresh",
+                      default=False,
+                      help="Ignore the cached listings and re-crawl everything")
+    parser.add_option('--cookies', action="store", dest="cookie_file",
+                      type=str, default=DEFAULT_COOKIE_FILE,
+                      help="File to keep the EarthData login cookies in " +
+                           "between runs (default %s)" % DEFAULT_COOKIE_FILE)
+    parser.add_option('--no-verify', action="store_false", dest="verify",
+                      default=True,
+                      help="Don't check downloads against the size and " +
+                           "checksum in the granule .hdf.xml metadata")
+    parser.add_option('--sync', action="store_true", dest="sync",
+                      default=False,
+                      help="Download everything newer than the last " +
+                           "complete date of each product, instead of a " +
+                           "given year")
+    parser.add_option('--since', action="store", dest="since", type=str,
+                      default=None,
+                      help="With --sync, the date (YYYY.MM.DD) to start " +
+                           "after if a product hasn't been synced before")
+    parser.add_option('--hold-back', action="store", dest="hold_back_days",
+                      type=int, default=HOLD_BACK_DAYS,
+                      help="With --sync, keep re-listing dates this many " +
+                           "days old until they have every wanted tile " +
+                           "(default %d)" % HOLD_BACK_DAYS)
+    parser.add_option('--fsync', action="store", dest="durability",
+                      type="choice", choices=list(DURABILITY_MODES),
+                      default="file",
+                      help="When to make downloads durable: after every " +
+                           "'file' (default), in a 'group' every few files " +
+                           "or seconds, or 'none' (leave it to the OS)")
+    parser.add_option('--fsync-files', action="store", dest="group_files",
+                      type=int, default=32,
+                      help="With --fsync group, sync after this many " +
+                           "files (default 32)")
+    parser.add_option('--fsync-seconds', action="store",
+                      dest="group_seconds", type=float, default=30.,
+                      help="With --fsync group, sync at least this often " +
+                           "(default 30)")
+    parser.add_option('--write-buffer', action="store", dest="buffer_mb",
+                      type=float, default=4.,
+                      help="Write buffer size in MB (default 4)")
     (options, args) = parser.parse_args()
     if 'username' not in options.__dict__:
         parser.error("You need to provide a username! Sgrunt!")
@@ -361,10 +1098,61 @@ if __name__ == "__main__":
     else:
         PROXY = None
 
-    get_modisfiles(options.username, options.password, options.platform,
-                   options.product, options.year,
-                   options.tile, PROXY,
-                   doy_start=options.doy_start, doy_end=options.doy_end,
-                   out_dir=options.dir_out,
-                   verbose=options.verbose, checkExistingDates=False, #options.quick,
-                   get_xml=options.get_xml)
+    if not os.path.exists(options.dir_out):
+        os.makedirs(options.dir_out)
+    catalog = RemoteCatalog(options.catalog or
+                            default_catalog_path(options.dir_out),
+                            max_age=options.catalog_max_age * 60 * 60,
+                            refresh=options.refresh)
+    tiles = as_tile_set(options.tile)
+    if options.aoi is not None:
+        # with both, just the given tiles that are in the area
+        aoi_tiles = set(resolve_aoi(options.aoi))
+        tiles = aoi_tiles if tiles is None else tiles & aoi_tiles
+        if not tiles:
+            parser.error("None of the tiles given are in the area of interest")
+    them_urls = []
+    pending = {}
+    for product in options.product.split(","):
+        if options.sync:
+            try:
+                product_urls, pending[product] = get_sync_urls(
+                    options.platform, product, tiles, catalog,
+                    out_dir=options.dir_out, since=options.since,
+                    n_workers=options.n_workers, verbose=options.verbose)
+            except ValueError as e:
+                parser.error(str(e))
+            them_urls.extend(product_urls)
+            continue
+        for year in parse_years(options.year):
+            them_urls.extend(
+                get_modis_urls(options.platform, product, year,
+                               tiles, PROXY,
+                               doy_start=options.doy_start,
+                               doy_end=options.doy_end,
+                               out_dir=options.dir_out,
+                               verbose=options.verbose,
+                               checkExistingDates=False, #options.quick,
+                               get_xml=options.get_xml,
+                               catalog=catalog,
+                               n_workers=options.n_workers))
+    failed = download_files(them_urls, options.username, options.password,
+                            out_dir=options.dir_out,
+                            n_workers=options.n_workers,
+                            verbose=options.verbose,
+                            cookie_file=options.cookie_file,
+                            verify=options.verify,
+                            policy=RetryPolicy(options.max_attempts),
+                            writer=GranuleWriter(
+                                options.durability,
+                                int(options.buffer_mb * 1024 * 1024),
+                                group_files=options.group_files,
+                                group_seconds=options.group_seconds))
+    for product in pending:
+        advance_watermark(catalog, product, pending[product],
+                          out_dir=options.dir_out, tiles=tiles,
+                          hold_back_days=options.hold_back_days)
+    catalog.close()
+    if failed:
+        raise IOError("Gave up downloading %d files: %s"
+                      % (len(failed), ", ".join(failed)))
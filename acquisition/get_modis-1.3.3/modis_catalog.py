@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+A local, on-disk cache of the remote MODIS DAAC listings.
+
+Crawling the DAAC means fetching the product index page and then one HTML
+listing per date directory, which for a full year of a global product takes a
+considerable time before a single granule is transferred. `RemoteCatalog`
+stores what was seen in a small SQLite database so that a rerun (for example a
+retry pass after some downloads timed out) can work out what is missing
+locally without going back to the server.
+
+The catalog is keyed by product (including the collection, e.g.
+MCD43B4.005), date directory (YYYY.MM.DD) and granule filename, and records
+the `Granule` details reported by the server and when the entry was last
+seen. Entries older than `max_age` seconds are treated as absent and get
+re-crawled; setting `refresh` ignores the cache altogether (but still updates
+it). The ETag / Last-Modified validators of each listing are kept too, so
+that a re-crawl can be a conditional request.
+
+It also holds each product's high-water mark for --sync: the last date for
+which every granule has been downloaded. Unlike the rest of the catalog this
+isn't just a cache, so it is carried over when the schema changes.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from modis_crawler import Granule
+
+# bump this when the schema changes: older catalogs are then simply dropped
+# and rebuilt, as they only ever hold cached data
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dates (
+    product TEXT NOT NULL,
+    date TEXT NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (product, date)
+);
+CREATE TABLE IF NOT EXISTS products (
+    product TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS listings (
+    product TEXT NOT NULL,
+    date TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (product, date)
+);
+CREATE TABLE IF NOT EXISTS granules (
+    product TEXT NOT NULL,
+    date TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER,
+    modified TEXT,
+    tile TEXT,
+    production TEXT,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (product, date, filename)
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    product TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+DEFAULT_CATALOG_NAME = ".get_modis_catalog.sqlite"
+
+
+class RemoteCatalog(object):
+    """A SQLite cache of remote product dates and per-date granule listings.
+
+    Parameters
+    ----------
+    path: str
+        The SQLite file. Will be created if it doesn't exist.
+    max_age: float
+        Age in seconds after which cached listings are considered stale.
+        None means cached listings never go stale.
+    refresh: bool
+        Ignore anything already cached, i.e. re-crawl everything (the new
+        listings are still stored).
+    """
+
+    def __init__(self, path, max_age=24 * 60 * 60, refresh=False):
+        self.path = path
+        self.max_age = max_age
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            for table in ("dates", "products", "listings", "granules"):
+                self._conn.execute("DROP TABLE IF EXISTS %s" % table)
+            self._conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _is_fresh(self, last_seen):
+        if self.refresh or last_seen is None:
+            return False
+        if self.max_age is None:
+            return True
+        return (time.time() - last_seen) <= self.max_age
+
+    def get_dates(self, product):
+        """Return the cached date directories for a product.
+
+        Returns
+        -------
+        A sorted list of "YYYY.MM.DD" strings, or None if the product index
+        has not been crawled recently enough.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_seen FROM products WHERE product = ?",
+                (product,)).fetchone()
+            if row is None or not self._is_fresh(row[0]):
+                return None
+            rows = self._conn.execute(
+                "SELECT date FROM dates WHERE product = ? ORDER BY date",
+                (product,)).fetchall()
+        return [r[0] for r in rows]
+
+    def set_dates(self, product, dates):
+        """Store the date directories found on the product index page."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO dates (product, date, last_seen) "
+                "VALUES (?, ?, ?)", [(product, d, now) for d in dates])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO products (product, last_seen) "
+                "VALUES (?, ?)", (product, now))
+            self._conn.commit()
+
+    def get_files(self, product, date, stale_ok=False):
+        """Return the cached granule listing for one date directory.
+
+        Parameters
+        ----------
+        product: str
+            The product name, with collection
+        date: str
+            The date directory, "YYYY.MM.DD"
+        stale_ok: bool
+            Return the listing however old it is (e.g. because the server
+            has just said it hasn't changed).
+        Returns
+        -------
+        A list of `Granule`s, or None if the date directory has not been
+        listed recently enough.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_seen FROM listings WHERE product = ? AND date = ?",
+                (product, date)).fetchone()
+            if row is None or not (stale_ok or self._is_fresh(row[0])):
+                return None
+            rows = self._conn.execute(
+                "SELECT filename, size, modified, tile, production "
+                "FROM granules WHERE product = ? AND date = ? "
+                "ORDER BY filename", (product, date)).fetchall()
+        return [Granule(*r) for r in rows]
+
+    def get_validators(self, product, date):
+        """Return the (etag, last_modified) of a cached listing.
+
+        Either may be None, e.g. if the listing has never been fetched or
+        the server didn't send them.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified FROM listings "
+                "WHERE product = ? AND date = ?", (product, date)).fetchone()
+        if row is None:
+            return None, None
+        return row[0], row[1]
+
+    def set_files(self, product, date, granules, etag=None,
+                  last_modified=None):
+        """Store the granule listing of one date directory.
+
+        Granules that have disappeared from the listing (e.g. superseded by
+        reprocessing) are removed from the catalog.
+
+        Parameters
+        ----------
+        product: str
+            The product name, with collection
+        date: str
+            The date directory, "YYYY.MM.DD"
+        granules: list
+            `Granule`s
+        etag: str
+            The listing's ETag header, if any
+        last_modified: str
+            The listing's Last-Modified header, if any
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM granules WHERE product = ? AND date = ?",
+                (product, date))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO granules (product, date, filename, "
+                "size, modified, tile, production, last_seen) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(product, date) + tuple(g) + (now,) for g in granules])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO listings "
+                "(product, date, etag, last_modified, last_seen) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (product, date, etag, last_modified, now))
+            self._conn.commit()
+
+    def touch_files(self, product, date):
+        """Mark a listing as fresh again, without changing its contents."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE listings SET last_seen = ? "
+                "WHERE product = ? AND date = ?", (now, product, date))
+            self._conn.execute(
+                "UPDATE granules SET last_seen = ? "
+                "WHERE product = ? AND date = ?", (now, product, date))
+            self._conn.commit()
+
+
+    def get_watermark(self, product):
+        """Return the last completely downloaded date of a product, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT date FROM watermarks WHERE product = ?",
+                (product,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_watermark(self, product, date):
+        """Record the last completely downloaded date of a product."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO watermarks (product, date, updated) "
+                "VALUES (?, ?, ?)", (product, date, time.time()))
+            self._conn.commit()
+
+
+def default_catalog_path(out_dir):
+    """The catalog lives alongside the downloads unless told otherwise."""
+    return os.path.join(out_dir, DEFAULT_CATALOG_NAME)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Concurrent crawler for the per-date directory listings on the MODIS DAAC.
+
+Before any data moves, the downloader needs the listing of every date
+directory of interest, which for a full mission is thousands of small HTML
+pages. `ListingCrawler` fetches these concurrently over a pool of keep-alive
+connections, and turns each page into `Granule` records rather than raw
+lines. When given a `RemoteCatalog` it makes conditional requests (ETag /
+If-Modified-Since) for listings it has seen before, so that directories that
+haven't changed come back as cheap 304s and are served from the catalog.
+"""
+import collections
+import re
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import requests
+
+# one entry on a date directory listing. size is in bytes (approximate, as
+# the listing only gives it to 2 significant figures), modified is the
+# listing's timestamp as "YYYY-MM-DD HH:MM", and tile / production are taken
+# from the granule name, e.g. MCD43B4.A2000055.h00v08.005.2006268133546.hdf
+Granule = collections.namedtuple(
+    "Granule", ["filename", "size", "modified", "tile", "production"])
+
+_SIZE_MULTIPLIERS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+_SIZE_RE = re.compile(r"^(\d+(?:\.\d+)?)([KMG]?)$")
+_TAG_RE = re.compile(r"<[^>]+>")
+_HREF_RE = re.compile(r'href="?([^" >]+\.hdf(?:\.xml)?)"?')
+_MODIFIED_RE = re.compile(
+    r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2})|(\d{2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2})")
+
+
+def parse_granule_name(fname):
+    """Get the tile and production timestamp out of a granule filename.
+
+    Returns
+    -------
+    A (tile, production) tuple, either of which is None if the name doesn't
+    follow the usual PRODUCT.AYYYYDDD.hXXvYY.CCC.YYYYDDDHHMMSS.hdf pattern.
+    """
+    parts = fname.split(".")
+    if len(parts) < 6:
+        return None, None
+    tile = parts[2] if re.match(r"^h\d{2}v\d{2}$", parts[2]) else None
+    production = parts[4] if parts[4].isdigit() else None
+    return tile, production
+
+
+def parse_listing(text):
+    """Parse a date directory listing into `Granule` records.
+
+    Parameters
+    ----------
+    text: str
+        The HTML of a directory index page as served by the DAAC.
+    Returns
+    -------
+    A list of `Granule`s, one per .hdf or .hdf.xml file on the page.
+    """
+    granules = []
+    for line in text.split("\n"):
+        match = _HREF_RE.search(line)
+        if match is None:
+            continue
+        fname = match.group(1)
+        stripped = _TAG_RE.sub(" ", line)
+        size = None
+        for token in reversed(stripped.split()):
+            size_match = _SIZE_RE.match(token)
+            if size_match:
+                size = int(float(size_match.group(1)) *
+                           _SIZE_MULTIPLIERS[size_match.group(2)])
+                break
+        modified = None
+        modified_match = _MODIFIED_RE.search(stripped)
+        if modified_match is not None:
+            if modified_match.group(1):
+                modified = modified_match.group(1)
+            else:
+                modified = time.strftime(
+                    "%Y-%m-%d %H:%M",
+                    time.strptime(modified_match.group(2), "%d-%b-%Y %H:%M"))
+        tile, production = parse_granule_name(fname)
+        granules.append(Granule(fname, size, modified, tile, production))
+    return granules
+
+
+def thread_map(func, items, n_workers):
+    """Call `func` on every item using up to `n_workers` threads.
+
+    Returns
+    -------
+    A list of (item, result, exception) tuples, in no particular order.
+    """
+    item_queue = queue.Queue()
+    for item in items:
+        item_queue.put(item)
+    results = []
+    results_lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                item = item_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = (item, func(item), None)
+            except Exception as e:
+                result = (item, None, e)
+            with results_lock:
+                results.append(result)
+
+    n_workers = max(1, min(n_workers, item_queue.qsize()))
+    threads = [threading.Thread(target=worker) for i in range(n_workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+    return results
+
+
+class ListingCrawler(object):
+    """Lists many date directories concurrently over pooled connections.
+
+    Parameters
+    ----------
+    catalog: RemoteCatalog
+        Optional cache of previous listings. Fresh listings are used without
+        asking the server at all; stale ones are revalidated with a
+        conditional request.
+    n_workers: int
+        The number of listings to fetch at once. This is also the size of
+        the connection pool.
+    headers: dict
+        Extra HTTP headers, e.g. a User-Agent.
+    verify: bool
+        Whether to verify SSL certificates.
+    revalidate: bool
+        Always check cached listings with the server (with a conditional
+        request), however recently they were fetched.
+    """
+
+    def __init__(self, catalog=None, n_workers=8, headers=None, verify=False,
+                 revalidate=False):
+        self.catalog = catalog
+        self.revalidate = revalidate
+        self.n_workers = n_workers
+        self.headers = headers or {}
+        self.verify = verify
+        # the sessions are per-thread, but all draw on the same pool of
+        # keep-alive connections
+        self._adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=max(1, n_workers))
+        self._local = threading.local()
+
+    def _session(self):
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = requests.Session()
+            s.headers.update(self.headers)
+            s.mount("http://", self._adapter)
+            s.mount("https://", self._adapter)
+            self._local.session = s
+        return s
+
+    def list_date(self, url, product, date):
+        """Get the granules in one date directory.
+
+        Parameters
+        ----------
+        url: str
+            The product URL, such as "http://e4ftl01.cr.usgs.gov/MOTA/MCD45A1.005/"
+        product: str
+            The product name, with collection
+        date: str
+            The date directory, "YYYY.MM.DD"
+        Returns
+        -------
+        A list of `Granule`s.
+        """
+        headers = {}
+        if self.catalog is not None:
+            if not self.revalidate:
+                granules = self.catalog.get_files(product, date)
+                if granules is not None:
+                    return granules
+            etag, last_modified = self.catalog.get_validators(product, date)
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        r = self._session().get("%s%s/" % (url, date), headers=headers,
+                                verify=self.verify)
+        if r.status_code == 304:
+            self.catalog.touch_files(product, date)
+            return self.catalog.get_files(product, date, stale_ok=True)
+        r.raise_for_status()
+        granules = parse_listing(r.text)
+        if self.catalog is not None:
+            self.catalog.set_files(product, date, granules,
+                                   etag=r.headers.get("ETag"),
+                                   last_modified=r.headers.get("Last-Modified"))
+        return granules
+
+    def list_dates(self, url, product, dates):
+        """Get the granules in many date directories at once.
+
+        Returns
+        -------
+        A dict of date: list of `Granule`s. Dates whose listing couldn't be
+        fetched are left out (and logged by the caller, if it cares, by
+        comparing with what it asked for).
+        """
+        results = thread_map(lambda date: self.list_date(url, product, date),
+                             dates, self.n_workers)
+        listings = {}
+        for date, granules, error in results:
+            if error is None:
+                listings[date] = granules
+        return listings
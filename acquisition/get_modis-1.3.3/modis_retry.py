@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+Retry scheduling and rate control for long unattended downloads.
+
+Rather than retrying a failed granule straight away (and giving up on the
+whole run when it keeps failing), the downloader keeps its work in a
+`DownloadScheduler`: a failed granule goes to the back of the queue with an
+exponential, jittered backoff (`RetryPolicy`), and is only abandoned after
+a fixed number of attempts. Each server gets a `HostThrottle`, which limits
+how many transfers are in flight to it and adapts that limit: halving it
+when the server answers 429 or 503 (and pausing for its Retry-After), and
+creeping back up while requests succeed. The throttle also pauses all
+transfers during the DAAC's weekly maintenance window.
+"""
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# the DAAC goes down for maintenance on Wednesday afternoons (local time)
+MAINTENANCE_DAY = 2  # Monday is 0
+MAINTENANCE_START_HOUR = 14
+MAINTENANCE_END_HOUR = 18
+
+# responses that mean "slow down" rather than "this is broken"
+THROTTLE_STATUSES = (429, 503)
+# responses that won't get better by asking again
+PERMANENT_STATUSES = (400, 401, 403, 404, 410)
+
+
+class DownloadError(IOError):
+    """A failed transfer, with the HTTP status if there was one."""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super(DownloadError, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def throttled(self):
+        return self.status in THROTTLE_STATUSES
+
+    @property
+    def permanent(self):
+        return self.status in PERMANENT_STATUSES
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, or None. Only the
+    delta-seconds form is understood."""
+    try:
+        return max(0., float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def seconds_until_maintenance_over(now=None):
+    """How long until the DAAC's maintenance window is over: 0 outside it.
+
+    Parameters
+    ----------
+    now: float
+        A time.time() value, defaults to now.
+    """
+    if now is None:
+        now = time.time()
+    t = time.localtime(now)
+    if t.tm_wday != MAINTENANCE_DAY or \
+            not MAINTENANCE_START_HOUR <= t.tm_hour < MAINTENANCE_END_HOUR:
+        return 0.
+    end = time.mktime((t.tm_year, t.tm_mon, t.tm_mday, MAINTENANCE_END_HOUR,
+                       0, 0, t.tm_wday, t.tm_yday, -1))
+    return max(0., end - now)
+
+
+class RetryPolicy(object):
+    """Exponential backoff with jitter.
+
+    Parameters
+    ----------
+    max_attempts: int
+        How many times to try each granule before giving up on it.
+    base_delay: float
+        The delay in seconds after the first failure, doubled after each
+        subsequent one.
+    max_delay: float
+        Upper limit on the delay.
+    """
+
+    def __init__(self, max_attempts=10, base_delay=2., max_delay=600.):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, error=None):
+        """Seconds to wait before trying again after `attempt` failures.
+        The delay is randomised between half and the full backoff so that
+        workers which failed together don't all come back together."""
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        backoff = random.uniform(backoff / 2., backoff)
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            backoff = max(backoff, retry_after)
+        return backoff
+
+    def should_retry(self, attempt, error=None):
+        if getattr(error, "permanent", False):
+            return False
+        return attempt < self.max_attempts
+
+
+class HostThrottle(object):
+    """An adaptive limit on simultaneous transfers to one server.
+
+    The limit starts at `max_limit`. A throttling response halves it (down
+    to `min_limit`) and pauses new transfers for the server's Retry-After;
+    after every `limit` successes in a row it goes back up by one.
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = self.max_limit
+        self.in_flight = 0
+        self.paused_until = 0.
+        self._successes = 0
+        self._in_maintenance = False
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Block until a transfer to this host may start."""
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = max(self.paused_until - now,
+                           seconds_until_maintenance_over(now))
+                if wait <= 0 and self.in_flight < self.limit:
+                    break
+                if wait > 0 and not self._in_maintenance and \
+                        seconds_until_maintenance_over(now) > 0:
+                    self._in_maintenance = True
+                    LOG.info("Maintenance window, pausing downloads for %d "
+                             "minutes" % (wait / 60))
+                self._cond.wait(min(wait, 60.) if wait > 0 else None)
+            self._in_maintenance = False
+            self.in_flight += 1
+
+    def release(self, error=None):
+        """Finish a transfer, adapting the limit to how it went."""
+        with self._cond:
+            self.in_flight -= 1
+            if getattr(error, "throttled", False):
+                self._successes = 0
+                new_limit = max(self.min_limit, self.limit // 2)
+                if new_limit != self.limit:
+                    LOG.info("Server is throttling us, down to %d "
+                             "simultaneous downloads" % new_limit)
+                self.limit = new_limit
+                if error.retry_after is not None:
+                    self.paused_until = max(self.paused_until,
+                                            time.time() + error.retry_after)
+            elif error is None:
+                self._successes += 1
+                if self._successes >= self.limit and \
+                        self.limit < self.max_limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+class DownloadScheduler(object):
+    """A queue of downloads where failures go to the back after a backoff.
+
+    Items are handed out oldest first, except that a failed item isn't
+    handed out again until its backoff delay has passed, and then only
+    after every item that is already waiting. `get` returns None once
+    everything has either succeeded or been given up on.
+
+    Parameters
+    ----------
+    items: list
+        The things to download (e.g. URLs)
+    policy: RetryPolicy
+        How to back off, and when to give up
+    """
+
+    def __init__(self, items, policy=None):
+        self.policy = policy or RetryPolicy()
+        self.failed = []
+        self.retries = 0
+        self._counter = itertools.count()
+        self._heap = []
+        self._attempts = {}
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        for item in items:
+            heapq.heappush(self._heap, (0., next(self._counter), item))
+
+    def get(self):
+        """Block until an item is due, and return it. None when all done."""
+        with self._cond:
+            while True:
+                if self._heap:
+                    not_before = self._heap[0][0]
+                    wait = not_before - time.time()
+                    if wait <= 0:
+                        item = heapq.heappop(self._heap)[2]
+                        self._in_flight += 1
+                        return item
+                    self._cond.wait(wait)
+                elif self._in_flight:
+                    # whatever's in flight may yet fail and come back
+                    self._cond.wait()
+                else:
+                    return None
+
+    def attempts(self, item):
+        with self._cond:
+            return self._attempts.get(item, 0)
+
+    def done(self, item):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def failed_attempt(self, item, error=None):
+        """Put an item back at the end of the queue after a backoff, or
+        give up on it if it has had its chances.
+
+        Returns
+        -------
+        True if it will be retried.
+        """
+        with self._cond:
+            self._in_flight -= 1
+            attempt = self._attempts.get(item, 0) + 1
+            self._attempts[item] = attempt
+            retry = self.policy.should_retry(attempt, error)
+            if retry:
+                self.retries += 1
+                not_before = time.time() + self.policy.delay(attempt, error)
+                heapq.heappush(self._heap,
+                               (not_before, next(self._counter), item))
+            else:
+                self.failed.append(item)
+            self._cond.notify_all()
+            return retry
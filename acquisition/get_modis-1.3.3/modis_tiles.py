@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+MODIS sinusoidal tile grid helpers, for restricting downloads to an area of
+interest.
+
+The MODIS land products are on a fixed 36 x 18 grid of hXXvYY tiles in the
+sinusoidal projection, so the tiles that cover an area can be worked out
+without asking the server anything. An area of interest can be given as a
+lon/lat bounding box, a CSV of tiles with h and v columns (like
+modis_tiles_africa.csv), or an explicit list of tile names.
+"""
+import csv
+import math
+import os
+import re
+
+# sphere radius used by the MODIS sinusoidal projection (metres)
+EARTH_RADIUS = 6371007.181
+# tiles are 10 degrees at the equator
+TILE_SIZE = 2 * math.pi * EARTH_RADIUS / 36
+# upper left corner of tile h00v00
+GRID_XMIN = -18 * TILE_SIZE
+GRID_YMAX = 9 * TILE_SIZE
+N_TILES_H = 36
+N_TILES_V = 18
+
+_TILE_RE = re.compile(r"^h(\d{2})v(\d{2})$")
+
+
+def tile_name(h, v):
+    return "h%02dv%02d" % (h, v)
+
+
+def tiles_for_bbox(west, south, east, north):
+    """Find the tiles that intersect a lon/lat bounding box.
+
+    For each row of tiles the box is clipped to the row's latitude band,
+    and the sinusoidal x extent of the clipped box is then exact: it is
+    widest where the band is closest to the equator.
+
+    Parameters
+    ----------
+    west, south, east, north: float
+        The bounding box in decimal degrees.
+    Returns
+    -------
+    A sorted list of tile names such as "h17v07".
+    """
+    if west > east or south > north:
+        raise ValueError("Bounding box %s is the wrong way round" %
+                         ((west, south, east, north),))
+    tiles = []
+    for v in range(N_TILES_V):
+        row_north = math.degrees((GRID_YMAX - v * TILE_SIZE) / EARTH_RADIUS)
+        row_south = math.degrees(
+            (GRID_YMAX - (v + 1) * TILE_SIZE) / EARTH_RADIUS)
+        lat_south = max(south, row_south)
+        lat_north = min(north, row_north)
+        # boxes which only touch the row's edge don't count
+        if lat_south > lat_north or (lat_south == lat_north and south < north):
+            continue
+        if lat_south <= 0 <= lat_north:
+            cos_max = 1.0
+        else:
+            cos_max = math.cos(math.radians(min(abs(lat_south),
+                                                abs(lat_north))))
+        cos_min = math.cos(math.radians(max(abs(lat_south), abs(lat_north))))
+        x_west = EARTH_RADIUS * math.radians(west) * \
+            (cos_max if west < 0 else cos_min)
+        x_east = EARTH_RADIUS * math.radians(east) * \
+            (cos_max if east > 0 else cos_min)
+        h_west = int(math.floor((x_west - GRID_XMIN) / TILE_SIZE))
+        h_east = int(math.ceil((x_east - GRID_XMIN) / TILE_SIZE)) - 1
+        h_east = max(h_east, h_west)
+        for h in range(max(h_west, 0), min(h_east, N_TILES_H - 1) + 1):
+            tiles.append(tile_name(h, v))
+    return sorted(tiles)
+
+
+def read_tile_csv(csvpath):
+    """Read a list of tiles from a CSV with h and v columns.
+
+    Returns
+    -------
+    A sorted list of tile names.
+    """
+    with open(csvpath) as f:
+        return sorted(set(tile_name(int(row['h']), int(row['v']))
+                          for row in csv.DictReader(f)))
+
+
+def parse_tile_list(tile_list):
+    """Parse a comma separated list of tile names.
+
+    Returns
+    -------
+    A sorted list of tile names.
+    """
+    tiles = set()
+    for tile in tile_list.split(","):
+        tile = tile.strip()
+        if not tile:
+            continue
+        if not _TILE_RE.match(tile):
+            raise ValueError("%s is not a MODIS tile name (hXXvYY)" % tile)
+        tiles.add(tile)
+    return sorted(tiles)
+
+
+def resolve_aoi(aoi):
+    """Work out the tiles for an area of interest given on the command line.
+
+    Parameters
+    ----------
+    aoi: str
+        Either the path of a tile CSV, a bounding box "west,south,east,north"
+        in decimal degrees, or a comma separated list of tile names.
+    Returns
+    -------
+    A sorted list of tile names.
+    """
+    if os.path.isfile(aoi):
+        return read_tile_csv(aoi)
+    parts = aoi.split(",")
+    if len(parts) == 4:
+        try:
+            bbox = [float(p) for p in parts]
+        except ValueError:
+            pass
+        else:
+            return tiles_for_bbox(*bbox)
+    return parse_tile_list(aoi)
+
+
+def as_tile_set(tile):
+    """Normalise a tile filter: None or '*' mean all tiles (returns None),
+    otherwise a single tile name or a list of them gives a set of names."""
+    if tile is None or tile == '*':
+        return None
+    if hasattr(tile, "split"):
+        return set(parse_tile_list(tile))
+    return set(tile)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Integrity checks for downloaded granules, using the .hdf.xml metadata.
+
+Every granule on the DAAC has an ECS metadata sidecar (the .hdf.xml file)
+which gives its size and a checksum, normally a POSIX `cksum` CRC but
+sometimes an MD5. `fetch_granule_metadata` gets these (the sidecar is only a
+few KB), and `GranuleChecksum` computes the same checksum incrementally, so
+that it can be fed the chunks as they stream in and the download checked
+without reading the file back off disk.
+"""
+import hashlib
+import xml.etree.ElementTree as ET
+import zlib
+
+from modis_retry import DownloadError, THROTTLE_STATUSES, parse_retry_after
+
+# bit-reversal of every byte value. POSIX cksum is the unreflected version
+# of the CRC-32 that zlib implements, so feeding zlib the bit-reversed bytes
+# and bit-reversing its register gives us cksum at C speed
+_REVERSE_BITS = bytes(bytearray(
+    int("{0:08b}".format(i)[::-1], 2) for i in range(256)))
+
+
+def _reverse32(value):
+    return int("{0:032b}".format(value)[::-1], 2)
+
+
+class GranuleChecksum(object):
+    """Incremental checksum of a granule, of the type given in its metadata.
+
+    Parameters
+    ----------
+    checksum_type: str
+        "CKSUM" or "MD5", as in the ECS ChecksumType element.
+    """
+
+    def __init__(self, checksum_type):
+        self.checksum_type = checksum_type.upper()
+        if self.checksum_type == "CKSUM":
+            self._crc = 0
+            self._length = 0
+        elif self.checksum_type == "MD5":
+            self._md5 = hashlib.md5()
+        else:
+            raise ValueError("Unsupported checksum type %s" % checksum_type)
+
+    def _update_crc(self, data):
+        # zlib inverts the register on the way in and out, we don't want it to
+        self._crc = zlib.crc32(data.translate(_REVERSE_BITS),
+                               self._crc ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+    def update(self, data):
+        if self.checksum_type == "CKSUM":
+            self._update_crc(data)
+            self._length += len(data)
+        else:
+            self._md5.update(data)
+
+    def hexdigest(self):
+        """The checksum as written in the metadata: a decimal integer for
+        CKSUM, hex for MD5."""
+        if self.checksum_type == "MD5":
+            return self._md5.hexdigest()
+        crc = self._crc
+        length = self._length
+        tail = bytearray()
+        while length:
+            tail.append(length & 0xFF)
+            length >>= 8
+        self._update_crc(bytes(tail))
+        result = (~_reverse32(self._crc)) & 0xFFFFFFFF
+        self._crc = crc
+        return str(result)
+
+
+def parse_granule_metadata(xml_text):
+    """Get the size and checksum of a granule out of its ECS metadata.
+
+    Returns
+    -------
+    A (size, checksum_type, checksum) tuple. Any of them may be None if the
+    metadata doesn't say.
+    """
+    root = ET.fromstring(xml_text)
+    size = root.findtext(".//DataFileContainer/FileSize")
+    checksum_type = root.findtext(".//DataFileContainer/ChecksumType")
+    checksum = root.findtext(".//DataFileContainer/Checksum")
+    if size is not None:
+        size = int(size.strip())
+    if checksum_type is not None:
+        checksum_type = checksum_type.strip()
+    if checksum is not None:
+        checksum = checksum.strip()
+    return size, checksum_type, checksum
+
+
+def fetch_granule_metadata(s, the_url):
+    """Fetch and parse the .hdf.xml metadata of a granule.
+
+    Parameters
+    ----------
+    s: requests.Session
+        A logged-in session
+    the_url: str
+        The URL of the granule (not the XML)
+    Returns
+    -------
+    A (size, checksum_type, checksum) tuple as from `parse_granule_metadata`,
+    or (None, None, None) if there is no usable metadata.
+
+    Raises `DownloadError` if the server is throttling us or failing (a 429
+    or 5xx), so the lookup gets retried like a download would.
+    """
+    r = s.get(the_url + ".xml")
+    if r.status_code in THROTTLE_STATUSES or r.status_code >= 500:
+        raise DownloadError("Server answered %d for the metadata of %s" %
+                            (r.status_code, the_url.split("/")[-1]),
+                            status=r.status_code,
+                            retry_after=parse_retry_after(
+                                r.headers.get("Retry-After")))
+    if not r.ok:
+        return None, None, None
+    try:
+        return parse_granule_metadata(r.content)
+    except ET.ParseError:
+        return None, None, None
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+Writing downloaded granules to disk without the disk setting the pace.
+
+`GranuleWriter` writes each granule through a large buffer into a file that
+is preallocated to its full length up front (so the filesystem can lay it
+out in one piece rather than growing it 64 KB at a time), and offers a
+choice of how hard to try to get it onto the platters before giving it its
+real name:
+
+  * "file": fsync every granule before renaming it, as get_modis always did
+  * "group": rename granules in batches, after one round of fsyncs every N
+    files or T seconds, so that a slow archive disk isn't doing a
+    synchronous flush between every two downloads. The fsyncs are done by a
+    writer thread of their own, so the downloads carry on meanwhile
+  * "none": leave it to the OS
+
+While a granule is being written it is called NAME.alloc, because being
+preallocated its length says nothing about how much of it is valid. If the
+transfer fails the file is cut back to what was actually received and
+renamed NAME.part, which the downloader knows how to resume. A leftover
+.alloc file (from a crash) can't be trusted and is thrown away. A granule
+that is completely written and waiting for its group fsync is called
+NAME.done; one left over from a crash is checked by the downloader (its
+size, and checksum if known) like a complete .part file, rather than thrown
+away.
+"""
+import os
+import threading
+import time
+
+# suffix for granules that can be resumed
+PART_SUFFIX = ".part"
+# suffix for granules that are being written
+ALLOC_SUFFIX = ".alloc"
+# suffix for granules that are written and waiting for a group fsync
+DONE_SUFFIX = ".done"
+
+DURABILITY_MODES = ("file", "group", "none")
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def _preallocate(fp, offset, size):
+    """Reserve the disk space for bytes offset..size of an open file."""
+    if size <= offset:
+        return
+    fp.flush()
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fp.fileno(), offset, size - offset)
+            return
+        except OSError:
+            # e.g. not supported by this filesystem
+            pass
+    # on Windows setting the end of file allocates the space
+    fp.truncate(size)
+    fp.seek(offset)
+
+
+def _fsync_dir(dirname):
+    """Make renames in a directory durable (POSIX only)."""
+    if os.name != "posix":
+        return
+    fd = os.open(dirname or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PartFile(object):
+    """One granule being written. Use `GranuleWriter.open` to get one."""
+
+    def __init__(self, out_fname, offset, size, buffer_size, preallocate):
+        self.out_fname = out_fname
+        self.part_fname = out_fname + PART_SUFFIX
+        self.alloc_fname = out_fname + ALLOC_SUFFIX
+        self.done_fname = out_fname + DONE_SUFFIX
+        self.size = size
+        self.written = offset
+        if offset > 0:
+            os.rename(self.part_fname, self.alloc_fname)
+            self.fp = open(self.alloc_fname, 'r+b', buffer_size)
+            self.fp.seek(offset)
+        else:
+            self.fp = open(self.alloc_fname, 'wb', buffer_size)
+        if preallocate and size:
+            _preallocate(self.fp, offset, size)
+
+    def write(self, data):
+        self.fp.write(data)
+        self.written += len(data)
+
+    def abort(self):
+        """Keep what we've got so far as a resumable .part file."""
+        try:
+            self.fp.flush()
+            self.fp.truncate(self.written)
+        finally:
+            self.fp.close()
+        os.rename(self.alloc_fname, self.part_fname)
+
+    def discard(self):
+        """Throw away a granule that turned out to be bad."""
+        self.fp.close()
+        os.remove(self.alloc_fname)
+
+
+class GranuleWriter(object):
+    """Writes granules with big buffers, preallocation and a choice of
+    durability. One writer is shared by all the download threads.
+
+    Parameters
+    ----------
+    durability: str
+        "file", "group" or "none", see the module docstring.
+    buffer_size: int
+        Write buffer size in bytes.
+    group_files: int
+        With "group" durability, fsync once this many granules are waiting.
+    group_seconds: float
+        With "group" durability, fsync once the oldest waiting granule has
+        been waiting this long.
+    preallocate: bool
+        Whether to reserve each granule's full size up front.
+    """
+
+    def __init__(self, durability="file", buffer_size=DEFAULT_BUFFER_SIZE,
+                 group_files=32, group_seconds=30., preallocate=True):
+        if durability not in DURABILITY_MODES:
+            raise ValueError("durability has to be one of %s" %
+                             ", ".join(DURABILITY_MODES))
+        self.durability = durability
+        self.buffer_size = buffer_size
+        self.group_files = group_files
+        self.group_seconds = group_seconds
+        self.preallocate = preallocate
+        self._pending = []
+        self._pending_since = None
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        # one batch of fsyncs and renames at a time
+        self._flush_lock = threading.Lock()
+        self._closing = False
+        self._error = None
+        self._thread = None
+        if durability == "group":
+            self._thread = threading.Thread(target=self._group_syncer,
+                                            name="group fsync")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def open(self, out_fname, offset=0, size=None):
+        """Start (or carry on) writing a granule.
+
+        Parameters
+        ----------
+        out_fname: str
+            The granule's final filename
+        offset: int
+            How much of it is already in the .part file
+        size: int
+            Its full size, if known, for preallocating
+        """
+        return PartFile(out_fname, offset, size, self.buffer_size,
+                        self.preallocate)
+
+    def finish(self, part):
+        """Close a completely written granule and (eventually) give it its
+        real name, according to the durability setting."""
+        part.fp.flush()
+        if self.durability == "file":
+            os.fsync(part.fp.fileno())
+        part.fp.close()
+        if self.durability != "group":
+            os.rename(part.alloc_fname, part.out_fname)
+            return
+        # complete, so if we crash before the sync it's worth checking
+        os.rename(part.alloc_fname, part.done_fname)
+        with self._lock:
+            self._pending.append(part)
+            if self._pending_since is None:
+                self._pending_since = time.time()
+            if self._due():
+                self._wake.notify()
+
+    def _due(self):
+        return len(self._pending) >= self.group_files or \
+            (self._pending_since is not None and
+             time.time() - self._pending_since >= self.group_seconds)
+
+    def _group_syncer(self):
+        # the writer thread: sync a batch whenever one is due
+        while True:
+            with self._lock:
+                while not (self._closing or self._due()):
+                    if self._pending_since is None:
+                        self._wake.wait()
+                    else:
+                        self._wake.wait(max(0.01, self._pending_since +
+                                            self.group_seconds - time.time()))
+                if self._closing:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                # the granules stay .done, and close() says what went wrong
+                self._error = e
+                return
+
+    def flush(self):
+        """fsync and rename all the granules waiting for a group sync."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                self._pending_since = None
+            if not pending:
+                return
+            for part in pending:
+                # r+b rather than rb, as Windows won't flush a read-only handle
+                with open(part.done_fname, 'r+b') as fp:
+                    os.fsync(fp.fileno())
+            dirnames = set()
+            for part in pending:
+                os.rename(part.done_fname, part.out_fname)
+                dirnames.add(os.path.dirname(part.out_fname))
+            for dirname in dirnames:
+                _fsync_dir(dirname)
+
+    def close(self):
+        """Sync and rename whatever is still waiting, and stop the writer
+        thread."""
+        if self._thread is not None:
+            with self._lock:
+                self._closing = True
+                self._wake.notify()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Tests for the parts of get_modis.py that don't need a server.
+
+    $ python -m pytest test_get_modis.py
+"""
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import get_modis
+from modis_catalog import RemoteCatalog
+
+PRODUCT = "MOD11A2.006"
+TODAY = datetime.date(2016, 6, 1)
+
+
+def granule(date, tile):
+    """A granule filename for a "YYYY.MM.DD" date and a tile."""
+    when = datetime.datetime.strptime(date, "%Y.%m.%d")
+    return "MOD11A2.A%04d%03d.%s.006.2016001000000.hdf" % (
+        when.year, when.timetuple().tm_yday, tile)
+
+
+class AdvanceWatermarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp(prefix="test_get_modis_")
+        self.catalog = RemoteCatalog(os.path.join(self.out_dir, "catalog.sqlite"))
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.out_dir)
+
+    def download(self, pending):
+        for fnames in pending.values():
+            for fname in fnames:
+                open(os.path.join(self.out_dir, fname), "w").close()
+
+    def advance(self, pending, tiles=None):
+        return get_modis.advance_watermark(
+            self.catalog, PRODUCT, pending, out_dir=self.out_dir, tiles=tiles,
+            hold_back_days=30, today=TODAY)
+
+    def test_complete_dates(self):
+        pending = {"2016.01.01": [granule("2016.01.01", "h17v07")],
+                   "2016.01.09": [granule("2016.01.09", "h17v07")]}
+        self.download(pending)
+        self.assertEqual(self.advance(pending), "2016.01.09")
+        self.assertEqual(self.catalog.get_watermark(PRODUCT), "2016.01.09")
+
+    def test_stops_at_missing_granule(self):
+        pending = {"2016.01.01": [granule("2016.01.01", "h17v07")],
+                   "2016.01.09": [granule("2016.01.09", "h17v07")],
+                   "2016.01.17": [granule("2016.01.17", "h17v07")]}
+        self.download(pending)
+        os.remove(os.path.join(self.out_dir, granule("2016.01.09", "h17v07")))
+        self.assertEqual(self.advance(pending), "2016.01.01")
+
+    def test_recent_date_held_back(self):
+        # everything listed is there, but without a tile filter a recent
+        # date may not have been fully published yet
+        pending = {"2016.01.01": [granule("2016.01.01", "h17v07")],
+                   "2016.05.24": [granule("2016.05.24", "h17v07")]}
+        self.download(pending)
+        self.assertEqual(self.advance(pending), "2016.01.01")
+
+    def test_recent_date_with_all_tiles(self):
+        pending = {"2016.05.24": [granule("2016.05.24", "h17v07"),
+                                  granule("2016.05.24", "h18v07")]}
+        self.download(pending)
+        self.assertEqual(self.advance(pending, tiles={"h17v07", "h18v07"}),
+                         "2016.05.24")
+
+    def test_settled_date_without_aoi_granules(self):
+        # the AOI has nothing on 2016.01.09, which is long past the hold back
+        tiles = {"h17v07"}
+        pending = {"2016.01.01": [granule("2016.01.01", "h17v07")],
+                   "2016.01.09": [],
+                   "2016.01.17": [granule("2016.01.17", "h17v07")]}
+        self.download(pending)
+        self.assertEqual(self.advance(pending, tiles), "2016.01.17")
+
+    def test_recent_date_without_aoi_granules(self):
+        # but a recent one may still get some
+        tiles = {"h17v07"}
+        pending = {"2016.01.01": [granule("2016.01.01", "h17v07")],
+                   "2016.05.24": []}
+        self.download(pending)
+        self.assertEqual(self.advance(pending, tiles), "2016.01.01")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:     modis_inventory
+# Purpose:  Keep an index of the HDF granules in a local MODIS archive, so that
+#           the archive doesn't have to be listed and every filename parsed
+#           again each time we want to know what's in it.
+#-------------------------------------------------------------------------------
+"""
+Inventory of a local archive of MODIS HDF granules.
+
+`Inventory` walks an archive directory (and optionally its subdirectories)
+once with scandir, parses each granule name, e.g.
+MCD43B4.A2000055.h00v08.005.2006268133546.hdf, and keeps the product,
+acquisition year and day, tile, collection, production timestamp, size, mtime
+and whether there's an .hdf.xml sidecar in a NumPy structured array: one
+compact row per granule, saved as `.modis_inventory.npz` in the archive.
+
+On later runs only directories whose mtime has changed (i.e. that have had
+files added, removed or renamed) are listed again, and only new names in
+them are parsed and stat'ed. Questions like "which dates don't have all their
+tiles" are then just array operations:
+
+    $ python modis_inventory.py D:\\MODIS\\Raw --incomplete MOD11A2
+"""
+import collections
+import io
+import optparse
+import os
+import re
+import time
+import zipfile
+
+import numpy as np
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+INVENTORY_NAME = ".modis_inventory.npz"
+INVENTORY_VERSION = 1
+
+# one row per granule
+INVENTORY_DTYPE = np.dtype([
+    ("name", "S64"),
+    ("dir", "i4"),          # index into Inventory.dirs
+    ("product", "S12"),     # e.g. MOD11A2
+    ("year", "i2"),
+    ("doy", "i2"),
+    ("h", "i1"),
+    ("v", "i1"),
+    ("collection", "i2"),   # e.g. 5 for 005
+    ("production", "i8"),   # YYYYDDDHHMMSS
+    ("size", "i8"),
+    ("mtime", "f8"),
+    ("xml", "?"),           # whether the .hdf.xml sidecar is there too
+])
+
+# number of tiles in a complete global date, as seen in full downloads.
+# products not listed here are compared with their best-covered date
+EXPECTED_TILES = {"MCD43B4": 286, "MOD11A2": 317}
+
+_HDF_NAME_RE = re.compile(
+    r"^([A-Za-z0-9]+)\.A(\d{4})(\d{3})\.h(\d{2})v(\d{2})\.(\d{3})\.(\d{13})"
+    r"\.hdf$")
+
+# what the scan of one directory found: its granules (as a structured array)
+# and its subdirectories
+_DirScan = collections.namedtuple("_DirScan", ["granules", "subdirs"])
+
+
+def parse_hdf_name(fname):
+    """Split a granule filename into its parts.
+
+    Parameters
+    ----------
+    fname: str
+        A filename such as MCD43B4.A2000055.h00v08.005.2006268133546.hdf
+    Returns
+    -------
+    A (product, year, doy, h, v, collection, production) tuple, with all but
+    the product as ints, or None if it isn't a granule name.
+    """
+    match = _HDF_NAME_RE.match(fname)
+    if match is None:
+        return None
+    product, year, doy, h, v, collection, production = match.groups()
+    return (product, int(year), int(doy), int(h), int(v), int(collection),
+            int(production))
+
+
+def _list_dir(path):
+    """(name, is_dir, stat function) for each entry in a directory, using
+    scandir where we have it, which on Windows gets the stat for free."""
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.is_dir(), entry.stat
+        return
+    for name in os.listdir(path):
+        full_path = os.path.join(path, name)
+        yield (name, os.path.isdir(full_path),
+               lambda full_path=full_path: os.stat(full_path))
+
+
+class Inventory(object):
+    """An index of the granules in an archive directory.
+
+    Parameters
+    ----------
+    root: str
+        The archive directory
+    path: str
+        Where to keep the index, default `INVENTORY_NAME` in `root`
+    """
+
+    def __init__(self, root, path=None):
+        self.root = root
+        self.path = path or os.path.join(root, INVENTORY_NAME)
+        self.granules = np.zeros(0, dtype=INVENTORY_DTYPE)
+        # directories relative to root ("" is root itself), and their mtimes
+        # when they were last listed
+        self.dirs = []
+        self.dir_mtimes = []
+        if os.path.exists(self.path):
+            self.load()
+
+    def __len__(self):
+        return len(self.granules)
+
+    def load(self):
+        # it's only an index, so if it's from another version or a save was
+        # interrupted, just build it again
+        try:
+            with np.load(self.path) as npz:
+                if int(npz["version"]) != INVENTORY_VERSION:
+                    return
+                granules = npz["granules"]
+                dirs = [str(d) for d in npz["dirs"]]
+                dir_mtimes = list(npz["dir_mtimes"])
+        except (IOError, OSError, ValueError, KeyError, zipfile.BadZipfile):
+            return
+        self.granules, self.dirs, self.dir_mtimes = granules, dirs, dir_mtimes
+
+    def save(self):
+        # the directory mtimes are kept as they were when they were listed.
+        # the index is overwritten in place rather than a new file being
+        # swapped in, as adding or renaming a file would change the mtime of
+        # the directory it's in (usually the archive) and make that look
+        # changed next time. an interrupted save is caught by load
+        buf = io.BytesIO()
+        np.savez(buf, version=INVENTORY_VERSION, granules=self.granules,
+                 dirs=np.array(self.dirs, dtype="U"),
+                 dir_mtimes=np.array(self.dir_mtimes, dtype="f8"))
+        with open(self.path, "r+b" if os.path.exists(self.path) else "wb") as f:
+            f.write(buf.getvalue())
+            f.truncate()
+
+    def _scan_dir(self, rel_dir, dir_id, old_granules, restat=False):
+        """List one directory. Rows for names already in `old_granules` are
+        reused rather than parsed and stat'ed again, unless `restat`."""
+        known = {}
+        if not restat:
+            known = dict((name.decode("ascii"), i)
+                         for i, name in enumerate(old_granules["name"]))
+        kept = []
+        rows = []
+        xml_names = []
+        subdirs = []
+        for name, is_dir, stat in _list_dir(os.path.join(self.root, rel_dir)):
+            if is_dir:
+                subdirs.append(os.path.join(rel_dir, name))
+                continue
+            if name.endswith(".hdf.xml"):
+                xml_names.append(name[:-4])
+                continue
+            if name in known:
+                kept.append(known[name])
+                continue
+            parts = parse_hdf_name(name)
+            if parts is None:
+                continue
+            st = stat()
+            rows.append((name, dir_id) + parts +
+                        (st.st_size, st.st_mtime, False))
+        granules = np.concatenate([
+            old_granules[np.array(kept, dtype="i8")],
+            np.array(rows, dtype=INVENTORY_DTYPE)])
+        granules["dir"] = dir_id
+        granules["xml"] = np.isin(granules["name"],
+                                  np.array(xml_names, dtype="S64"))
+        return _DirScan(granules, subdirs)
+
+    def update(self, recursive=False, restat=False):
+        """Bring the index up to date with what's on disk.
+
+        Directories that haven't changed since they were last listed aren't
+        listed again (their subdirectories still are, if `recursive`).
+
+        Parameters
+        ----------
+        recursive: bool
+            Also index the subdirectories of the archive.
+        restat: bool
+            List and stat everything, even if it looks unchanged, in case
+            files have been changed in place.
+        Returns
+        -------
+        The number of directories that had to be listed.
+        """
+        old_dir_ids = dict((d, i) for i, d in enumerate(self.dirs))
+        old_by_dir = {}
+        if len(self.granules):
+            order = np.argsort(self.granules["dir"], kind="mergesort")
+            sorted_granules = self.granules[order]
+            bounds = np.searchsorted(sorted_granules["dir"],
+                                     np.arange(len(self.dirs) + 1))
+            for i in range(len(self.dirs)):
+                old_by_dir[i] = sorted_granules[bounds[i]:bounds[i + 1]]
+        # the subdirectories of each directory we knew about, for the ones
+        # we don't need to list again
+        old_children = collections.defaultdict(list)
+        for d in self.dirs:
+            if d:
+                old_children[os.path.dirname(d)].append(d)
+
+        new_dirs = []
+        new_mtimes = []
+        parts = []
+        n_listed = 0
+        pending = [""]
+        while pending:
+            rel_dir = pending.pop()
+            try:
+                mtime = os.stat(os.path.join(self.root, rel_dir)).st_mtime
+            except OSError:
+                continue
+            dir_id = len(new_dirs)
+            new_dirs.append(rel_dir)
+            new_mtimes.append(mtime)
+            old_id = old_dir_ids.get(rel_dir)
+            empty = np.zeros(0, dtype=INVENTORY_DTYPE)
+            old_granules = old_by_dir.get(old_id, empty)
+            if not restat and old_id is not None and \
+                    self.dir_mtimes[old_id] == mtime:
+                granules = old_granules.copy()
+                granules["dir"] = dir_id
+                subdirs = old_children[rel_dir]
+            else:
+                granules, subdirs = self._scan_dir(rel_dir, dir_id,
+                                                   old_granules, restat)
+                n_listed += 1
+            parts.append(granules)
+            if recursive:
+                pending.extend(subdirs)
+        self.dirs = new_dirs
+        self.dir_mtimes = new_mtimes
+        self.granules = np.concatenate(parts) if parts else \
+            np.zeros(0, dtype=INVENTORY_DTYPE)
+        return n_listed
+
+    def select(self, product=None, year=None, doy=None, tiles=None,
+               collection=None):
+        """A boolean mask of the granules matching all the given criteria.
+
+        Parameters
+        ----------
+        product: str
+            Product name without collection, e.g. "MOD11A2"
+        collection: int
+            e.g. 6 for 006
+        year: int
+        doy: int
+        tiles: iterable
+            Tile names, e.g. ["h17v07", "h18v07"]
+        """
+        g = self.granules
+        mask = np.ones(len(g), dtype=bool)
+        if product is not None:
+            mask &= g["product"] == product.encode("ascii")
+        if collection is not None:
+            mask &= g["collection"] == collection
+        if year is not None:
+            mask &= g["year"] == year
+        if doy is not None:
+            mask &= g["doy"] == doy
+        if tiles is not None:
+            hv = [(int(t[1:3]), int(t[4:6])) for t in tiles]
+            tile_codes = np.array([h * 100 + v for h, v in hv], dtype="i4")
+            mask &= np.isin(g["h"].astype("i4") * 100 + g["v"], tile_codes)
+        return mask
+
+    def paths(self, mask=None):
+        """Full paths of the granules (optionally just those in `mask`)."""
+        g = self.granules if mask is None else self.granules[mask]
+        return [os.path.join(self.root, self.dirs[d], name.decode("ascii"))
+                for d, name in zip(g["dir"], g["name"])]
+
+    def tiles_per_date(self, product, collection=None):
+        """How many distinct tiles each date of a product has, counting each
+        collection separately (an archive moving from C5 to C6 may have both).
+
+        Parameters
+        ----------
+        product: str
+            Product name without collection, e.g. "MOD11A2"
+        collection: int
+            Just this collection, default all of them
+        Returns
+        -------
+        A structured array with collection, year, doy and n_tiles fields,
+        sorted by collection and date.
+        """
+        mask = self.select(product, collection=collection)
+        g = self.granules
+        out = np.zeros(mask.sum(), dtype=[("collection", "i2"), ("year", "i2"),
+                                          ("doy", "i2"), ("n_tiles", "i4")])
+        if not len(out):
+            return out
+        # (np.unique would do, but sorting ourselves is several times faster)
+        date_keys = (g["collection"][mask].astype("i8") * 10000 +
+                     g["year"][mask]) * 1000 + g["doy"][mask]
+        keys = np.sort(date_keys * 10000 +
+                       g["h"][mask].astype("i8") * 100 + g["v"][mask])
+        # the same tile may be there more than once (reprocessed duplicates)
+        keys = keys[np.append(True, keys[1:] != keys[:-1])]
+        date_keys = keys // 10000
+        starts = np.flatnonzero(np.append(True, date_keys[1:] !=
+                                          date_keys[:-1]))
+        out = out[:len(starts)]
+        out["collection"] = date_keys[starts] // 10000000
+        out["year"] = date_keys[starts] // 1000 % 10000
+        out["doy"] = date_keys[starts] % 1000
+        out["n_tiles"] = np.diff(np.append(starts, len(keys)))
+        return out
+
+    def incomplete_dates(self, product, expected=None, collection=None):
+        """The dates of a product with fewer tiles than a complete date, in
+        each collection.
+
+        Parameters
+        ----------
+        product: str
+            Product name without collection, e.g. "MOD11A2"
+        collection: int
+            Just this collection, default all of them
+        expected: int
+            How many tiles a complete date has. Defaults to
+            `EXPECTED_TILES`, or failing that the most any date has.
+        Returns
+        -------
+        A structured array as from `tiles_per_date`.
+        """
+        counts = self.tiles_per_date(product, collection)
+        if expected is None:
+            expected = EXPECTED_TILES.get(product)
+        if expected is None:
+            expected = counts["n_tiles"].max() if len(counts) else 0
+        return counts[counts["n_tiles"] < expected]
+
+    def summary(self):
+        """(product, collection, number of dates, number of granules, bytes)
+        for each product in the archive."""
+        g = self.granules
+        out = []
+        for product in np.unique(g["product"]):
+            for collection in np.unique(g["collection"][g["product"] ==
+                                                         product]):
+                sel = g[(g["product"] == product) &
+                        (g["collection"] == collection)]
+                n_dates = len(np.unique(sel["year"].astype("i4") * 1000 +
+                                        sel["doy"]))
+                out.append((product.decode("ascii"), int(collection), n_dates,
+                            len(sel), int(sel["size"].sum())))
+        return out
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] ARCHIVE_DIR")
+    parser.add_option("-r", "--recursive", action="store_true",
+                      dest="recursive", default=False,
+                      help="Include subdirectories of the archive")
+    parser.add_option("--restat", action="store_true", dest="restat",
+                      default=False,
+                      help="Check every file again, not just changed " +
+                           "directories")
+    parser.add_option("-i", "--index", action="store", dest="index",
+                      default=None,
+                      help="Where to keep the index (default %s in the " %
+                           INVENTORY_NAME + "archive directory)")
+    parser.add_option("--incomplete", action="store", dest="incomplete",
+                      default=None,
+                      help="List the dates of this product (e.g. MOD11A2, " +
+                           "or MOD11A2.006 for one collection) that are " +
+                           "missing tiles")
+    parser.add_option("--expected", action="store", dest="expected",
+                      type=int, default=None,
+                      help="With --incomplete, the number of tiles in a " +
+                           "complete date")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Give the archive directory")
+
+    t0 = time.time()
+    inventory = Inventory(args[0], options.index)
+    n_listed = inventory.update(options.recursive, options.restat)
+    inventory.save()
+    print("Indexed %d granules in %.2fs (%d directories listed)" %
+          (len(inventory), time.time() - t0, n_listed))
+    if options.incomplete:
+        t0 = time.time()
+        product, _, collection = options.incomplete.partition(".")
+        incomplete = inventory.incomplete_dates(
+            product, options.expected,
+            int(collection) if collection else None)
+        for row in incomplete:
+            print("%s.A%04d%03d.%03d %d tiles" % (
+                product, row["year"], row["doy"], row["collection"],
+                row["n_tiles"]))
+        print("%d incomplete dates (%.1f ms)" %
+              (len(incomplete), (time.time() - t0) * 1000))
+    else:
+        for product, collection, n_dates, n_granules, n_bytes in \
+                inventory.summary():
+            print("%s.%03d: %d dates, %d granules, %.1f GB" %
+                  (product, collection, n_dates, n_granules, n_bytes / 1e9))
@@ -8,15 +8,48 @@
 # Copyright:   (c) zool1301 2014
 # Licence:     <your licence>
 #-------------------------------------------------------------------------------
+"""
+Sort MODIS granules from a single directory into subdirectories, one per tile
+(or per month, with --by date), optionally only for a whitelist of tiles.
+
+The whole job is planned from one listing of the source directory: each HDF
+and its .hdf.xml sidecar (if it has one) gets a destination. Then it's
+carried out as cheaply as the filesystem allows: on the same filesystem a
+move is a rename and a copy is a hard link, so reorganising a terabyte is
+only a metadata operation. Only across filesystems is any data copied, by a
+bounded pool of threads, into a temporary file that is renamed when done.
+Files that are already at their destination are skipped, so an interrupted
+run can just be started again.
+
+    $ python movefiles.py C:\\Downloads\\MOD11A2 D:\\MODIS\\ByTile -p MOD11A2 \\
+        --tiles modis_tiles_africa.csv --copy
+"""
 import os
 import collections
 import shutil
 import csv
-import glob
 import datetime
+import errno
+import optparse
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 reqTiles = None
 
+# what os.link fails with when the filesystem can't hard link at all, as
+# opposed to some other problem with this particular file
+_NO_LINK_ERRNOS = set(getattr(errno, name) for name in
+                      ("EPERM", "EXDEV", "ENOTSUP", "EOPNOTSUPP", "ENOSYS", "EMLINK")
+                      if hasattr(errno, name))
+# and on windows: ERROR_INVALID_FUNCTION, ERROR_NOT_SUPPORTED
+_NO_LINK_WINERRORS = (1, 50)
+
+# suffix for files still being copied across filesystems
+PART_SUFFIX = ".part"
+
 def parsepath(hdffilepath):
     filename = os.path.split(hdffilepath)[1]
     product,datebit,tile,version,stuff,ext = filename.split('.')
@@ -26,49 +59,206 @@ def parsepath(hdffilepath):
     dirname = str(d.year)+"_"+str(d.month).zfill(2)
     tileH = tile[1:3]
     tileV = tile[4:]
-    return {"Product":product,"Date":d,"TileName":tile,"Yr":yrbit,"Day":daybit,"TileH":tileH,"TileV":tileV,"Version":version,"Type":ext}
+    return {"Product":product,"Date":d,"TileName":tile,"Yr":yrbit,"Day":daybit,"TileH":tileH,"TileV":tileV,"Version":version,"Type":ext,"DirName":dirname}
 
 def readreqtiles(csvpath):
-    with open(csvpath,'rb') as f:
-        c = csv.reader(f)
-        fn = c.next()
-        c = csv.DictReader(f,fn)
+    """Read a CSV of required tiles (h and v columns) into a dict of
+    zero-padded h: list of zero-padded v, which is also kept in reqTiles."""
+    with open(csvpath) as f:
+        c = csv.DictReader(f)
         dct = collections.defaultdict(list)
         for i in c:
             dct[str(i['h']).zfill(2)].append(str(i['v']).zfill(2))
         global reqTiles
         reqTiles = dct
+    return dct
 
-def main():
-    readreqtiles(r"\\zoo-booty\home$\zool1301\My Documents\MODIS_Processing\modisdownload\modis_tiles_africa.csv")
-    # assume they are already downloaded else call a downloader function here
-    datadir = r"C:\Users\zool1301\Downloads"
-    #outdir = r"C:\Users\zool1301\Documents\MODIS\MOD11A2_2013_Global"
-    outdir = r"C:\Users\zool1301\Documents\MODIS\MOD11A2_Global_Day065"
-    products = ['MCD43B4','MOD11A2']
-    for product in products:
-        productindir = os.path.join(datadir,product+"_SingleDay")
-        productoutdir = os.path.join(outdir,product)
-        productfiles = glob.glob(os.path.join(productindir,"*.hdf"))
-        for daytilefile in productfiles:
-            filepath = os.path.join(productindir,daytilefile)
-            info = parsepath(filepath)
-            if not info["Product"] == product:
+def plan_moves(datadir, outdir, products, tiles=None, by="tile", day=None):
+    """Work out where every granule in datadir is going, from one listing.
+
+    Parameters
+    ----------
+    datadir: str
+        The directory the granules are in
+    outdir: str
+        The top of the sorted tree: granules go to outdir/PRODUCT/TILE (or
+        outdir/PRODUCT/YYYY_MM with by="date")
+    products: list
+        The products to sort, e.g. ['MCD43B4', 'MOD11A2']
+    tiles: dict
+        Tile whitelist as from readreqtiles, or None for all tiles
+    by: str
+        "tile" or "date"
+    day: int
+        Only sort granules for this day of the year
+    Returns
+    -------
+    A list of (source, destination) file paths, including .hdf.xml files.
+    """
+    names = os.listdir(datadir)
+    present = set(names)
+    plan = []
+    for name in names:
+        if not name.endswith(".hdf"):
+            continue
+        try:
+            info = parsepath(name)
+        except ValueError:
+            continue
+        if info["Product"] not in products:
+            continue
+        if tiles is not None and info["TileV"] not in tiles.get(info["TileH"], ()):
+            continue
+        if day is not None and info["Day"] != day:
+            continue
+        subdir = info["TileName"] if by == "tile" else info["DirName"]
+        outdirtile = os.path.join(outdir, info["Product"], subdir)
+        # the hdf and its xml file, if that's there too
+        for fn in (name, name + ".xml"):
+            if fn in present:
+                plan.append((os.path.join(datadir, fn), os.path.join(outdirtile, fn)))
+    return plan
+
+def _same_device(src, dstdir):
+    # the destination may not exist yet (e.g. on a dry run), in which case
+    # it'll be on the same device as whichever of its parents does
+    dstdir = os.path.abspath(dstdir)
+    while not os.path.exists(dstdir):
+        dstdir = os.path.dirname(dstdir)
+    return os.stat(src).st_dev == os.stat(dstdir).st_dev
+
+def _already_done(src, dst):
+    """Whether a previous run already got this file to its destination."""
+    if not os.path.exists(dst):
+        return False
+    if not os.path.exists(src):
+        return True
+    return os.path.getsize(src) == os.path.getsize(dst)
+
+def _copy(src, dst, keep):
+    # copy to a temporary name so a half copied file is never mistaken for
+    # a finished one by a rerun
+    shutil.copyfile(src, dst + PART_SUFFIX)
+    shutil.copystat(src, dst + PART_SUFFIX)
+    os.rename(dst + PART_SUFFIX, dst)
+    if not keep:
+        os.remove(src)
+
+def execute_plan(plan, copy=False, n_workers=4, dry_run=False):
+    """Carry out a plan from plan_moves.
+
+    Within a filesystem files are renamed (or hard linked, if copy), which
+    doesn't touch the data at all. Across filesystems they are copied by up
+    to n_workers threads at once (and the originals then removed, unless
+    copy).
+
+    Returns
+    -------
+    A dict of how many files were renamed, linked, copied and skipped.
+    """
+    counts = collections.Counter()
+    to_copy = []
+    made_dirs = {}
+    for src, dst in plan:
+        if _already_done(src, dst):
+            # a move that was interrupted between the copy and the delete
+            if not copy and not dry_run and os.path.exists(src):
+                os.remove(src)
+            counts["skipped"] += 1
+            continue
+        dstdir = os.path.dirname(dst)
+        if dstdir not in made_dirs:
+            if not os.path.isdir(dstdir) and not dry_run:
+                os.makedirs(dstdir)
+            made_dirs[dstdir] = _same_device(src, dstdir)
+        if not made_dirs[dstdir]:
+            to_copy.append((src, dst))
+            continue
+        if dry_run:
+            counts["linked" if copy else "renamed"] += 1
+            continue
+        if os.path.exists(dst):
+            # a stale incomplete copy. windows won't rename (or link) over it
+            os.remove(dst)
+        if copy:
+            try:
+                os.link(src, dst)
+                counts["linked"] += 1
+                continue
+            except OSError as e:
+                if e.errno not in _NO_LINK_ERRNOS and \
+                        getattr(e, "winerror", None) not in _NO_LINK_WINERRORS:
+                    raise
+                # not every filesystem can (e.g. FAT, some network shares)
+                to_copy.append((src, dst))
                 continue
-            #if not reqTiles[info["TileH"]].count(info["TileV"]) == 0:
-            #if 1:
-            if info["Day"] == 65:
-                outdirtile = os.path.join(productoutdir,info["TileName"])
-                if not os.path.isdir(outdirtile):
-                    os.makedirs(outdirtile)
-                # get the hdf and xml file names if they both exist
-                tilefiles = glob.glob(filepath+"*")
-                for fn in tilefiles:
-                    if 1:
-                    #if info["Yr"] != 2013:
-                        shutil.move(fn,outdirtile)
-                    else:
-                        shutil.copy(fn,outdirtile)
+        os.rename(src, dst)
+        counts["renamed"] += 1
+    if dry_run:
+        counts["copied"] += len(to_copy)
+        return counts
+    # only the copies across filesystems are worth doing in parallel
+    work = queue.Queue()
+    for item in to_copy:
+        work.put(item)
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                src, dst = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                _copy(src, dst, copy)
+            except (IOError, OSError) as e:
+                with lock:
+                    errors.append((src, e))
+            else:
+                with lock:
+                    counts["copied"] += 1
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(n_workers, len(to_copy))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive():
+            t.join(1)
+    for src, e in errors:
+        print("Failed to copy %s: %s" % (src, e))
+    counts["failed"] = len(errors)
+    return counts
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] DATADIR OUTDIR")
+    parser.add_option("-p", "--products", dest="products", default="MCD43B4,MOD11A2",
+                      help="Comma separated products to sort (default MCD43B4,MOD11A2)")
+    parser.add_option("-t", "--tiles", dest="tiles", default=None,
+                      help="CSV of the tiles to sort (h and v columns), e.g. modis_tiles_africa.csv")
+    parser.add_option("-d", "--day", dest="day", type=int, default=None,
+                      help="Only sort this day of the year, e.g. 65")
+    parser.add_option("--by", dest="by", type="choice", choices=["tile", "date"], default="tile",
+                      help="Sort into a directory per 'tile' (default) or per month ('date')")
+    parser.add_option("-c", "--copy", dest="copy", action="store_true", default=False,
+                      help="Leave the originals where they are")
+    parser.add_option("-j", "--jobs", dest="n_workers", type=int, default=4,
+                      help="Simultaneous copies when going across filesystems (default 4)")
+    parser.add_option("-n", "--dry-run", dest="dry_run", action="store_true", default=False,
+                      help="Just say what would be done")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("Give the data directory and the output directory")
+    datadir, outdir = args
+    tiles = readreqtiles(options.tiles) if options.tiles else None
+    plan = plan_moves(datadir, outdir, options.products.split(","), tiles,
+                      by=options.by, day=options.day)
+    counts = execute_plan(plan, copy=options.copy, n_workers=options.n_workers,
+                          dry_run=options.dry_run)
+    print("%s%d files: %d renamed, %d hard linked, %d copied, %d already done, %d failed" % (
+        "Would sort " if options.dry_run else "Sorted ", len(plan), counts["renamed"],
+        counts["linked"], counts["copied"], counts["skipped"], counts["failed"]))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
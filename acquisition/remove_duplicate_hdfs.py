@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:     remove_duplicate_hdfs
+# Purpose:  Get reprocessed duplicates out of a local MODIS archive, i.e. the
+#           same product, date, tile and collection downloaded more than once
+#           with different production timestamps. Replaces
+#           ensure_no_duplicate_hdfs.fmw, without needing FME.
+#-------------------------------------------------------------------------------
+"""
+Find and remove superseded granules from a local MODIS archive.
+
+When a granule is reprocessed the DAAC gives it a new production timestamp,
+e.g. MOD11A2.A2010001.h17v07.005.2010012345678.hdf replacing
+MOD11A2.A2010001.h17v07.005.2010009876543.hdf, and redownloading leaves both
+in the archive. For each (product, date, tile, collection) this keeps the
+granule with the newest production timestamp and either
+
+  * moves the others (and their .hdf.xml) into a duplicates directory, or
+  * with --mode link, leaves the archive alone and builds a clean copy of it
+    out of hard links to the granules being kept
+
+The archive is read through its `modis_inventory` index, so it's listed
+once, and the grouping is a sort of a few compact arrays rather than a dict
+of millions of filenames.
+
+    $ python remove_duplicate_hdfs.py D:\\MODIS\\Raw --dry-run
+"""
+import errno
+import optparse
+import os
+import shutil
+
+import numpy as np
+
+from modis_inventory import Inventory
+
+# the fields that say two granules are the same thing
+GROUP_FIELDS = ("product", "collection", "year", "doy", "h", "v")
+
+
+def find_duplicates(granules):
+    """Find the granules that have been superseded by a newer production.
+
+    Parameters
+    ----------
+    granules: np.ndarray
+        Inventory rows, see `modis_inventory.INVENTORY_DTYPE`
+    Returns
+    -------
+    (losers, winners): two arrays of indices into `granules`, the granules to
+    get rid of and the newest granule of the same group for each.
+    """
+    n = len(granules)
+    if n < 2:
+        return np.zeros(0, dtype="i8"), np.zeros(0, dtype="i8")
+    # lexsort sorts by the last key first, so each group comes out together
+    # with its newest production last
+    keys = [granules["production"]] + \
+        [granules[f] for f in reversed(GROUP_FIELDS)]
+    order = np.lexsort(keys)
+    same_as_next = np.ones(n - 1, dtype=bool)
+    for field in GROUP_FIELDS:
+        col = granules[field][order]
+        same_as_next &= col[1:] == col[:-1]
+    # each sorted position's winner is the last position of its group
+    positions = np.arange(n)
+    is_last = np.append(~same_as_next, True)
+    group_last = np.minimum.accumulate(
+        np.where(is_last, positions, n)[::-1])[::-1]
+    loser_positions = np.flatnonzero(same_as_next)
+    return order[loser_positions], order[group_last[loser_positions]]
+
+
+def _move(src, dst):
+    """Rename if we can, copy and delete if it's another filesystem."""
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def _link(src, dst):
+    if not os.path.exists(dst):
+        os.link(src, dst)
+
+
+def _with_xml(path):
+    """The granule and its sidecar, if there is one."""
+    if os.path.exists(path + ".xml"):
+        return [path, path + ".xml"]
+    return [path]
+
+
+def move_losers(inventory, losers, out_dir, dry_run=False):
+    """Move superseded granules (and their .hdf.xml files) into `out_dir`,
+    keeping their paths relative to the archive.
+
+    Returns
+    -------
+    The number of bytes moved.
+    """
+    n_bytes = 0
+    for i in losers:
+        row = inventory.granules[i]
+        rel_dir = inventory.dirs[row["dir"]]
+        src = os.path.join(inventory.root, rel_dir, row["name"].decode("ascii"))
+        if not os.path.exists(src):
+            # already done on an earlier run
+            continue
+        n_bytes += int(row["size"])
+        if dry_run:
+            continue
+        dst_dir = os.path.join(out_dir, rel_dir)
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir)
+        for path in _with_xml(src):
+            _move(path, os.path.join(dst_dir, os.path.basename(path)))
+    return n_bytes
+
+
+def link_winners(inventory, losers, out_dir, dry_run=False):
+    """Hard-link every granule that isn't superseded (and its .hdf.xml)
+    into `out_dir`, keeping their paths relative to the archive. `out_dir`
+    has to be on the same filesystem as the archive.
+
+    Returns
+    -------
+    The number of granules linked.
+    """
+    keep = np.ones(len(inventory.granules), dtype=bool)
+    keep[losers] = False
+    if dry_run:
+        return int(keep.sum())
+    made_dirs = set()
+    for src in inventory.paths(keep):
+        rel_dir = os.path.relpath(os.path.dirname(src), inventory.root)
+        dst_dir = os.path.normpath(os.path.join(out_dir, rel_dir))
+        if dst_dir not in made_dirs:
+            if not os.path.isdir(dst_dir):
+                os.makedirs(dst_dir)
+            made_dirs.add(dst_dir)
+        for path in _with_xml(src):
+            _link(path, os.path.join(dst_dir, os.path.basename(path)))
+    return int(keep.sum())
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] ARCHIVE_DIR")
+    parser.add_option("-o", "--output", action="store", dest="out_dir",
+                      default=None,
+                      help="Where to move the duplicates to (default " +
+                           "ARCHIVE_DIR_duplicates), or with --mode link " +
+                           "where to build the clean archive (default " +
+                           "ARCHIVE_DIR_deduplicated)")
+    parser.add_option("-m", "--mode", action="store", dest="mode",
+                      type="choice", choices=["move", "link"], default="move",
+                      help="'move' the duplicates out of the archive, or " +
+                           "'link' the granules to keep into a new one")
+    parser.add_option("-n", "--dry-run", action="store_true", dest="dry_run",
+                      default=False,
+                      help="Just report what would be done")
+    parser.add_option("-r", "--recursive", action="store_true",
+                      dest="recursive", default=False,
+                      help="Include subdirectories of the archive")
+    parser.add_option("-i", "--index", action="store", dest="index",
+                      default=None,
+                      help="Where the archive's inventory is kept")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose",
+                      default=False,
+                      help="List each duplicate and what replaces it")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Give the archive directory")
+    archive = args[0].rstrip("/\\")
+    out_dir = options.out_dir or archive + (
+        "_duplicates" if options.mode == "move" else "_deduplicated")
+
+    inventory = Inventory(archive, options.index)
+    inventory.update(options.recursive)
+    inventory.save()
+    losers, winners = find_duplicates(inventory.granules)
+
+    if options.verbose:
+        for loser, winner in zip(losers, winners):
+            print("%s superseded by %s" % (
+                inventory.paths(np.array([loser]))[0],
+                inventory.granules[winner]["name"].decode("ascii")))
+    g = inventory.granules
+    for product in np.unique(g["product"][losers]):
+        n = int((g["product"][losers] == product).sum())
+        print("%s: %d duplicates" % (product.decode("ascii"), n))
+    prefix = "Would " if options.dry_run else ""
+    if options.mode == "move":
+        n_bytes = move_losers(inventory, losers, out_dir, options.dry_run)
+        print("%s%s %d of %d granules (%.1f GB) to %s" % (
+            prefix, "move" if prefix else "Moved", len(losers), len(g),
+            n_bytes / 1e9, out_dir))
+    else:
+        n_linked = link_winners(inventory, losers, out_dir, options.dry_run)
+        print("%s%s %d of %d granules into %s" % (
+            prefix, "link" if prefix else "Linked", n_linked, len(g),
+            out_dir))
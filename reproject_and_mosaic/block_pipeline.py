@@ -0,0 +1,145 @@
+#-------------------------------------------------------------------------------
+# Name:     block_pipeline
+# Purpose:  Run the read -> calculate -> write block loop of calculate_*.py
+#           with the reads and writes in their own threads, so the disk and
+#           the numexpr threads are both kept busy
+# Note:     GDAL and numexpr both release the GIL, so the reader can fetch
+#           block k+1 and the writer flush block k-1 while block k is
+#           calculated. The blocks' buffers go round a fixed ring of buffer
+#           sets, which bounds the memory used and means nothing is
+#           allocated per block.
+#-------------------------------------------------------------------------------
+
+import sys
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# buffer sets in the ring: one being read, one being calculated and one
+# being written
+DEFAULT_BUFFER_SETS = 3
+
+
+class BlockPipeline(object):
+    """Process a list of blocks with the reading, calculating and writing of
+    consecutive blocks overlapped.
+
+    Parameters
+    ----------
+    readBlock: function(block, buffers)
+        Read a block's input into its buffers. Called in the reader thread.
+    computeBlock: function(block, buffers)
+        Calculate a block's results, in its buffers. Called in the thread that
+        calls run(), one block at a time in order.
+    writeBlock: function(block, buffers)
+        Write a block's results out. Called in the writer thread, in order.
+    makeBuffers: function(xsize, ysize)
+        Make a buffer set (whatever the functions above want) for a block of
+        this size. A set is reused for later blocks of the same size.
+    nBuffers: int
+        Buffer sets in the ring. 1 runs the blocks strictly one after another.
+    """
+
+    def __init__(self, readBlock, computeBlock, writeBlock, makeBuffers,
+                 nBuffers=DEFAULT_BUFFER_SETS):
+        self.readBlock = readBlock
+        self.computeBlock = computeBlock
+        self.writeBlock = writeBlock
+        self.makeBuffers = makeBuffers
+        self.nBuffers = max(1, nBuffers)
+
+    def run(self, blocks):
+        """Process the blocks, each an (xoff, yoff, xsize, ysize) tuple.
+        An exception in any stage stops the pipeline and is raised here."""
+        free = queue.Queue()
+        for i in range(self.nBuffers):
+            free.put(None)
+        readQueue = queue.Queue()
+        writeQueue = queue.Queue()
+        errors = []
+        stopping = threading.Event()
+
+        def reader():
+            try:
+                for block in blocks:
+                    bufs = free.get()
+                    if errors or stopping.is_set():
+                        break
+                    size = tuple(block[2:4])
+                    if bufs is None or bufs[0] != size:
+                        bufs = (size, self.makeBuffers(*size))
+                    self.readBlock(block, bufs[1])
+                    readQueue.put((block, bufs))
+            except Exception:
+                errors.append(sys.exc_info()[1])
+            finally:
+                readQueue.put(None)
+
+        def writer():
+            while True:
+                item = writeQueue.get()
+                if item is None:
+                    break
+                block, bufs = item
+                # after an error keep taking blocks, so nothing waits on
+                # their buffers, but don't write them
+                if not errors:
+                    try:
+                        self.writeBlock(block, bufs[1])
+                    except Exception:
+                        errors.append(sys.exc_info()[1])
+                free.put(bufs)
+
+        readThread = threading.Thread(target=reader, name="block reader")
+        writeThread = threading.Thread(target=writer, name="block writer")
+        readThread.daemon = writeThread.daemon = True
+        readThread.start()
+        writeThread.start()
+        try:
+            while True:
+                item = readQueue.get()
+                if item is None:
+                    break
+                block, bufs = item
+                if not errors:
+                    try:
+                        self.computeBlock(block, bufs[1])
+                    except Exception:
+                        errors.append(sys.exc_info()[1])
+                writeQueue.put(item)
+        finally:
+            writeQueue.put(None)
+            # let the reader out if it's waiting for a buffer set
+            stopping.set()
+            free.put(None)
+            readThread.join()
+            writeThread.join()
+        if errors:
+            raise errors[0]
+
+
+def blockList(xSize, ySize, blockXSize, blockYSize):
+    # (xoff, yoff, xsize, ysize) of each block, in columns of blocks from the
+    # top left, as the calculate_*.py loops went
+    blocks = []
+    for xoff in range(0, xSize, blockXSize):
+        for yoff in range(0, ySize, blockYSize):
+            blocks.append((xoff, yoff, min(blockXSize, xSize - xoff),
+                           min(blockYSize, ySize - yoff)))
+    return blocks
+
+
+def coveredBlocks(blocks, rects):
+    # just the blocks that overlap one of the rects, e.g. the tiles in a
+    # day's mosaic from modis_vrt.vrt_coverage, so the oceans are skipped
+    covered = []
+    for block in blocks:
+        xoff, yoff, xsize, ysize = block
+        for rx, ry, rxsize, rysize in rects:
+            if rx < xoff + xsize and xoff < rx + rxsize and \
+                    ry < yoff + ysize and yoff < ry + rysize:
+                covered.append(block)
+                break
+    return covered
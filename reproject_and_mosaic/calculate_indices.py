@@ -4,56 +4,32 @@
 # Note:     This is a simple modification of gdal_calc.py to process native (hardcoded) 
 #           blocksizes of HDF files, for more efficient I/O, and using numexpr for calculation
 #           As such there's various redundant code in main and elsewhere
+#           The calculation itself is in modis_calc, which can be used without this
 #-------------------------------------------------------------------------------
 
 from osgeo import gdal
-import numpy as np
 import os
 import sys
 from optparse import OptionParser
-import numexpr as ne
+
+from strip_warp import StripWarper, STRIP_ROWS
+from warp_index import WarpIndex
+from block_pipeline import blockList, DEFAULT_BUFFER_SETS
+from modis_calc import CALCULATIONS, check_inputs, covered_blocks, run_blocks, \
+    text_progress
 
 RequiredBandList = ["B1","B2","B3","B4","B5","B6","B7"]
 
 # set up some default nodatavalues for each datatype
 DefaultNDVLookup={'Byte':255, 'UInt16':65535, 'Int16':-32767, 'UInt32':4294967293, 'Int32':-2147483647, 'Float32':1.175494351E-38, 'Float64':1.7976931348623158E+308}
-OutputNDV = 0
-gdalDatasetsIn = []
-
-#define (hard code) the index calculations
-#eviCalc = "(((B - A) / (B + (A * 6.0) - (C * 7.5) +1.0) * 2.5))"
-#tcbCalc = "((A * 0.4395) + (B * 0.5945)+ (C * 0.2460)+ (D * 0.3918)+ (E * 0.3506)+ (F * 0.2136)+ (G * 0.2678)) * 0.0001"
-#tcwCalc = "((A * 0.1147) + (B * 0.2489)+ (C * 0.2408)+ (D * 0.3132)+ (E * -0.3132)+ (F * -0.6416)+ (G * -0.5087)) * 0.0001"
-
-
-# EVI coefficients from huete et al
-_EVI_C1 = 6.0
-_EVI_C2 = 7.5
-_EVI_L = 1.0 #muhahaha
-_EVI_G = 2.5
-
-# tasseled cap coefficients provided by Dan Weiss
-# tasseled cap brightness coefficients
-_TCB_COEFFS = np.asarray(
-    [0.4395, 0.5945, 0.2460, 0.3918, 0.3506, 0.2136, 0.2678]
-    ).reshape(7,1,1)
-
-# tasseled cap wetness coefficients
-_TCW_COEFFS = np.asarray(
-    [0.1147, 0.2489, 0.2408, 0.3132, -0.3122, -0.6416, -0.5087]
-    ).reshape(7,1,1)
-
-# scale conversion
-_MODIS_SCALE_CONST = 0.0001
-
 
 ################################################################
 # set up output files
 ################################################################
 
-def setupOutput(outputFN, opts, XSize, YSize, fileType=None, ndv=None):
-
-    global gdalDatasetsIn, OutputNDV
+def setupOutput(outputFN, opts, templateDS, fileType, ndv=None):
+    # returns (dataset, its nodata value), or None
+    XSize, YSize = templateDS.RasterXSize, templateDS.RasterYSize
     # open output file exists
     if os.path.isfile(outputFN) and not opts.overwrite:
         if opts.debug:
@@ -64,7 +40,6 @@ def setupOutput(outputFN, opts, XSize, YSize, fileType=None, ndv=None):
             return
         myOutB=myOut.GetRasterBand(1)
         OutputNDV=myOutB.GetNoDataValue()
-        myOutType=gdal.GetDataTypeName(myOutB.DataType)
 
     else:
         # remove existing file and regenerate
@@ -74,226 +49,107 @@ def setupOutput(outputFN, opts, XSize, YSize, fileType=None, ndv=None):
         if opts.debug:
             print("Generating output file %s" %(outputFN))
 
-        # find data type to use
-        if not fileType:
-            # use the largest type of the input files
-            myOutType=gdal.GetDataTypeName(max(myDataTypeNum))
-        else:
-            myOutType=fileType
-
         # create file
         myOutDrv = gdal.GetDriverByName(opts.format)
         myOut = myOutDrv.Create(
             outputFN, XSize, YSize, 1,
-            gdal.GetDataTypeByName(myOutType), opts.creation_options)
+            gdal.GetDataTypeByName(fileType), opts.creation_options)
 
         # set output geo info based on first input layer
-        myOut.SetGeoTransform(gdalDatasetsIn[0].GetGeoTransform())
-        myOut.SetProjection(gdalDatasetsIn[0].GetProjection())
+        myOut.SetGeoTransform(templateDS.GetGeoTransform())
+        myOut.SetProjection(templateDS.GetProjection())
 
         if ndv!=None:
             OutputNDV=ndv
         else:
-            OutputNDV=DefaultNDVLookup[myOutType]
+            OutputNDV=DefaultNDVLookup[fileType]
 
         myOutB = myOut.GetRasterBand(1)
         myOutB.SetNoDataValue(OutputNDV)
         myOutB = None
 
-    #if opts.debug:
-    #    print("output file: %s, dimensions: %s, %s, type: %s" %(outputFN,myOut.RasterXSize,myOut.RasterYSize,gdal.GetDataTypeName(myOutB.DataType)))
-    return myOut
+    return myOut, OutputNDV
 
 
-def doit(opts, args):
-    global gdalDatasetsIn
-    #bandsIn = []
-    dataTypes = []
-    dataTypeNums = []
-    inputNDVs = np.empty(len(RequiredBandList))
+def setupWarpedOutputs(outputFNs, opts, templateDS):
+    # outputs in global 30 arcsecond WGS84, filled a strip at a time by a StripWarper
+    for outputFN in outputFNs:
+        if os.path.isfile(outputFN):
+            if not opts.overwrite:
+                print("Error! Output %s exists. Use the --overwrite option to automatically overwrite the existing file" %(outputFN))
+                return
+            os.remove(outputFN)
+    if opts.NoDataValue!=None:
+        OutputNDV=opts.NoDataValue
+    else:
+        OutputNDV=DefaultNDVLookup['Float32']
+    # with a precomputed index (see warp_index.py) the warp is just a lookup
+    index = WarpIndex(opts.warp_index) if opts.warp_index else None
+    return StripWarper(outputFNs, OutputNDV, templateDS.GetGeoTransform(),
+                       templateDS.GetProjection(), opts.format,
+                       opts.creation_options, opts.warp_threads, index)
 
-    DimensionsCheck = None
-    # check dimensions of inputs
-    # loop through input files - checking dimensions
-    for i,myI in enumerate(RequiredBandList[0:len(sys.argv)-1]):
-        thisFN = eval("opts.%s" %(myI))
-        #myBand = eval("opts.%s_band" %(myI))
-        if thisFN:
-            gdalDatasetsIn.append(gdal.Open(thisFN, gdal.GA_ReadOnly))
-            dataTypes.append(gdal.GetDataTypeName(gdalDatasetsIn[i].GetRasterBand(1).DataType))
-            dataTypeNums.append(gdalDatasetsIn[i].GetRasterBand(1).DataType)
-            #inputNDVs.append(gdalDatasetsIn[i].GetRasterBand(1).GetNoDataValue())
-            inputNDVs[i] = gdalDatasetsIn[i].GetRasterBand(1).GetNoDataValue()
-            # check that the dimensions of each layer are the same
-            if DimensionsCheck:
-                if DimensionsCheck!=[gdalDatasetsIn[i].RasterXSize, gdalDatasetsIn[i].RasterYSize]:
-                    print("Error! Dimensions of file %s (%i, %i) are different from other files (%i, %i).  Cannot proceed" % \
-                            (thisFN,gdalDatasetsIn[i].RasterXSize, gdalDatasetsIn[i].RasterYSize,DimensionsCheck[0],DimensionsCheck[1]))
-                    return
-            else:
-                DimensionsCheck=[gdalDatasetsIn[i].RasterXSize, gdalDatasetsIn[i].RasterYSize]
-            if opts.debug:
-                print("file %s: %s, dimensions: %s, %s, type: %s" %(myI,thisFN,DimensionsCheck[0],DimensionsCheck[1],dataTypes[i]))
 
+def doit(opts, args):
+    inputFNs = [getattr(opts, myI) for myI in RequiredBandList]
+    gdalDatasetsIn = [gdal.Open(thisFN, gdal.GA_ReadOnly) for thisFN in inputFNs]
+    # check that the dimensions of each layer are the same
+    try:
+        XSize, YSize = check_inputs(gdalDatasetsIn)[:2]
+    except ValueError as e:
+        print("Error! %s.  Cannot proceed" % e)
+        return
+    if opts.debug:
+        for myI, thisFN, myDS in zip(RequiredBandList, inputFNs, gdalDatasetsIn):
+            print("file %s: %s, dimensions: %s, %s, type: %s" %(myI,thisFN,XSize,YSize,
+                  gdal.GetDataTypeName(myDS.GetRasterBand(1).DataType)))
 
     # set up output files
-    eviOut = setupOutput(opts.eviOutputFN, opts, DimensionsCheck[0], DimensionsCheck[1], 'Float32', opts.NoDataValue)
-    tcwOut = setupOutput(opts.tcwOutputFN, opts, DimensionsCheck[0], DimensionsCheck[1], 'Float32', opts.NoDataValue)
-    tcbOut = setupOutput(opts.tcbOutputFN, opts, DimensionsCheck[0], DimensionsCheck[1], 'Float32', opts.NoDataValue)
-
-    #myBlockSize = gdalDatasetsIn[0].GetRasterBand(1).GetBlockSize()
-    # vrt file reports a block size of 128*128 but the underlying hdf block size is 1200*100
-    # so hard code this, or some clean multiple : using 2400 * 2400 here which is the size
-    # of the file itself. this minimises disk access
-    myBlockSize = [2400,2400]
-    nXValid = myBlockSize[0]
-    nYValid = myBlockSize[1]
-    nXBlocks = (int)((DimensionsCheck[0] + myBlockSize[0] - 1) / myBlockSize[0]);
-    nYBlocks = (int)((DimensionsCheck[1] + myBlockSize[1] - 1) / myBlockSize[1]);
-    myBufSize = myBlockSize[0]*myBlockSize[1]
+    outputFNs = [opts.eviOutputFN, opts.tcbOutputFN, opts.tcwOutputFN]
+    if opts.wgs84:
+        # reproject each strip as it's calculated, straight into the final outputs
+        outputs = setupWarpedOutputs(outputFNs, opts, gdalDatasetsIn[0])
+        if outputs is None:
+            return
+        OutputNDV = outputs.ndv
+        fillingIn = False
+        # the warp needs whole rows
+        myBlockSize = [XSize, opts.strip_rows]
+    else:
+        # existing outputs are filled in rather than replaced
+        fillingIn = not opts.overwrite and any(os.path.isfile(outputFN) for outputFN in outputFNs)
+        outputs = []
+        for outputFN in outputFNs:
+            myOut = setupOutput(outputFN, opts, gdalDatasetsIn[0], 'Float32', opts.NoDataValue)
+            if myOut is None:
+                return
+            outputs.append(myOut[0])
+            OutputNDV = myOut[1]
+        # vrt file reports a block size of 128*128 but the underlying hdf block size is 1200*100
+        # so hard code this, or some clean multiple : using 2400 * 2400 here which is the size
+        # of the file itself. this minimises disk access
+        myBlockSize = list(CALCULATIONS["MCD43B4"].block_size)
+
+    blocks = blockList(XSize, YSize, myBlockSize[0], myBlockSize[1])
+    if not (opts.all_blocks or fillingIn):
+        # skip the blocks with no tiles in them at all (the oceans), leaving
+        # them unwritten, which reads as nodata in new SPARSE_OK outputs. Not
+        # when filling in existing outputs, whose old values would be left
+        nBlocks = len(blocks)
+        blocks = covered_blocks(blocks, inputFNs)
+        if opts.debug:
+            print("%d of %d blocks have tiles in them" % (len(blocks), nBlocks))
 
     if opts.debug:
         print("using blocksize %s x %s" %(myBlockSize[0], myBlockSize[1]))
 
-    # variables for displaying progress
-    ProgressCt = -1
-    ProgressMk = -1
-    ProgressEnd = nXBlocks * nYBlocks * 1 # for allBandsCount, removed
-
-    ################################################################
-    # start looping through blocks of data
-    ################################################################
-
-    # loop through X-lines
-    for X in range(0,nXBlocks):
-
-        # in the rare (impossible?) case that the blocks don't fit perfectly
-        # change the block size of the final piece
-        if X==nXBlocks-1:
-            nXValid = DimensionsCheck[0] - X * myBlockSize[0]
-            myBufSize = nXValid*nYValid
-
-        # find X offset
-        myX=X*myBlockSize[0]
-
-        # reset buffer size for start of Y loop
-        nYValid = myBlockSize[1]
-        myBufSize = nXValid * nYValid
-
-        # loop through Y lines
-        for Y in range(0,nYBlocks):
-            ProgressCt+=1
-            if 10*ProgressCt/ProgressEnd%10!=ProgressMk:
-                ProgressMk=10*ProgressCt/ProgressEnd%10
-                from sys import version_info
-                if version_info >= (3,0,0):
-                    exec('print("%d.." % (10*ProgressMk), end=" ")')
-                else:
-                    exec('print 10*ProgressMk, "..",')
-
-           #print ".",
-            # change the block size of the final piece
-            if Y==nYBlocks-1:
-                nYValid = DimensionsCheck[1] - Y * myBlockSize[1]
-                myBufSize = nXValid*nYValid
-
-            # find Y offset
-            myY=Y*myBlockSize[1]
-
-            # create empty buffer to mark where nodata occurs
-            myNDVs=np.zeros(myBufSize*len(gdalDatasetsIn))
-            myNDVs.shape=(len(gdalDatasetsIn),nYValid,nXValid)
-
-            # fetch data for each input layer
-            bands = np.empty(shape=(7, nYValid,nXValid),
-                                 dtype=gdal.GetDataTypeName(max(dataTypeNums)))
-            for i,Alpha in enumerate(RequiredBandList):
-
-                # populate lettered arrays with values
-                #if allBandsIndex is not None and allBandsIndex==i:
-                #    myBandNo=bandNo
-                #else:
-                #    myBandNo=myBands[i]
-                myBandNo = 1
-                bands[i]=gdalDatasetsIn[i].GetRasterBand(myBandNo).ReadAsArray(
-                                      xoff=myX, yoff=myY,
-                                      win_xsize=nXValid, win_ysize=nYValid)
-
-                # create an array of values for this block
-                TCBAlpha = "TCB"+str(i)
-                TCWAlpha = "TCW"+str(i)
-                exec("%s=_TCW_COEFFS[i]" %TCWAlpha)
-                exec("%s=_TCB_COEFFS[i]" %TCBAlpha)
-                exec("%s=bands[i]" %Alpha)
-
-                #myval=None
-            # fill in nodata values
-            #myNDVs=1*np.logical_or(myNDVs==1, bands[i]==myNDV[i])
-            myNDVs = bands == inputNDVs[:,np.newaxis,np.newaxis]
-            
-            # possibly do a rgb image too? http://www.idlcoyote.com/ip_tips/brightmodis.html and
-            # http://www.idlcoyote.com/programs/scalemodis.pro
-            # but scaling method would only work if we know the whole image's stats
-            #rgbInOut = [[0,0],[30,110],[60,160],[120,210],[190,240],[255,255]]
-            #rgbInOutRange = [-0.01, 1.10]
-
-            # try the calculation on the array blocks
-            try:
-                
-                # evi from equation 12 in Huete et al
-                # Do it with numexpr for easy multithreading:
-                #eviResult = ne.evaluate("(((B2 - B1) / (B2 + (B1 * _EVI_C1) - (B3 * _EVI_C2) + _EVI_L) * _EVI_G))")
-                eviResult = ne.evaluate("((((B2 - B1)*_MODIS_SCALE_CONST) / ((B2 + (B1 * _EVI_C1) - (B3 * _EVI_C2))*_MODIS_SCALE_CONST + _EVI_L) * _EVI_G))")
-
-                tcbResult = ne.evaluate ("(B1*TCB0 + B2*TCB1 + B3*TCB2 + B4*TCB3 + B5*TCB4 + B6*TCB5 + B7*TCB6)*_MODIS_SCALE_CONST")
-                tcwResult = ne.evaluate("(B1*TCW0 + B2*TCW1 + B3*TCW2 + B4*TCW3 + B5*TCW4 + B6*TCW5 + B7*TCW6)*_MODIS_SCALE_CONST")
-                np.clip(eviResult,0,1,out=eviResult)
-                np.clip(tcbResult,-100,100,out=tcbResult)
-                np.clip(tcwResult,-100,100,out=tcwResult)
-                # todo : handle nan in evi? i.e. when it is divide by zero
-                
-                # or classic numpy version:
-                #eviResult = (((bands[1] - bands[0])  ) /
-                #   (bands[1] + (bands[0] * _EVI_C1) - (bands[2] * _EVI_C2)
-                #    + _EVI_L)
-                #   * _EVI_G)
-                #tcbResult = np.clip(
-                #    np.sum(bands * _TCB_COEFFS * _MODIS_SCALE_CONST, axis=0),
-                #    0, 1)
-                #tcwResult = np.clip(
-                #    np.sum(bands * _TCW_COEFFS * _MODIS_SCALE_CONST, axis=0),
-                #    0, 1)
-
-                #byteScaled = bytescale(bands*_MODIS_SCALE_CONST, cmin=-0.01, cmax=1.10)
-                #ndviResult = (bands[1] - bands[0]) / (bands[1] + bands[0]).astype('Float32')
-                
-            except:
-                #print("evaluation of calculation %s failed" %(opts.calc))
-                raise
-
-            ndvInRelevantBands = np.any(myNDVs[[0,1,2]]==1,axis=0)
-            # propogate nodata values
-            # (set nodata cells to zero then add nodata value to these cells)
-
-            if 1: #useNumExpr:
-                eviResult = ne.evaluate("((1*(ndvInRelevantBands==0))*eviResult) + (OutputNDV*ndvInRelevantBands)")
-                ndvInRelevantBands = np.any(myNDVs==1,axis=0)
-                tcbResult = ne.evaluate("((1*(ndvInRelevantBands==0))*tcbResult) + (OutputNDV*ndvInRelevantBands)")
-                tcwResult = ne.evaluate("((1*(ndvInRelevantBands==0))*tcwResult) + (OutputNDV*ndvInRelevantBands)")
-            else:
-                eviResult = ((1*(ndvInRelevantBands==0))*eviResult) + (OutputNDV*ndvInRelevantBands)
-                ndvInRelevantBands = np.any(myNDVs==1,axis=0)
-                tcbResult = ((1*(ndvInRelevantBands==0))*tcbResult) + (OutputNDV*ndvInRelevantBands)
-                tcwResult = ((1*(ndvInRelevantBands==0))*tcwResult) + (OutputNDV*ndvInRelevantBands)
-
-            # write data block to the output file
-            eviOutB=eviOut.GetRasterBand(1)
-            tcbOutB=tcbOut.GetRasterBand(1)
-            tcwOutB=tcwOut.GetRasterBand(1)
-            eviOutB.WriteArray(eviResult, xoff=myX, yoff=myY)
-            tcbOutB.WriteArray(tcbResult, xoff=myX, yoff=myY)
-            tcwOutB.WriteArray(tcwResult, xoff=myX, yoff=myY)
+    # block k+1 is read and block k-1 written in other threads while block k
+    # is calculated
+    run_blocks(CALCULATIONS["MCD43B4"], gdalDatasetsIn, OutputNDV, outputs,
+               blocks, opts.buffers, text_progress)
 
+    if opts.wgs84:
+        outputs.close()
     print ("100 - Done")
     return
 
@@ -322,6 +178,13 @@ def main():
         help="Passes a creation option to the output format driver. Multiple "
         "options may be listed. See format specific documentation for legal "
         "creation options for each format.")
+    parser.add_option("--wgs84", dest="wgs84", action="store_true",
+                      help="write the outputs reprojected to global 30 arcsecond WGS84 (as gdalwarp -t_srs EPSG:4326 -te -180 -90 180 90 in the batch files), without temporary sinusoidal files")
+    parser.add_option("--strip-rows", dest="strip_rows", type=int, default=STRIP_ROWS, help="rows to calculate and warp at once with --wgs84 (default %d)" % STRIP_ROWS)
+    parser.add_option("--warp-threads", dest="warp_threads", type=int, default=1, help="threads for the warp with --wgs84 (default 1)")
+    parser.add_option("--warp-index", dest="warp_index", help="with --wgs84, look the source pixels up in this index from warp_index.py instead of calling gdal.Warp")
+    parser.add_option("--buffers", dest="buffers", type=int, default=DEFAULT_BUFFER_SETS, help="blocks in memory at once, so reading, calculating and writing overlap (default %d; 1 does them one after another)" % DEFAULT_BUFFER_SETS)
+    parser.add_option("--all-blocks", dest="all_blocks", action="store_true", help="process every block, not just those with tiles in the input vrts")
     parser.add_option("--overwrite", dest="overwrite", action="store_true", help="overwrite output file if it already exists")
     parser.add_option("--debug", dest="debug", action="store_true", help="print debugging information")
 
@@ -4,33 +4,32 @@
 # Note:     This is a simple modification of gdal_calc.py to process native (hardcoded) 
 #           blocksizes of HDF files, for more efficient I/O, and using numexpr for calculation
 #           As such there's various redundant code in main and elsewhere
-#-----------------------------------------------------
+#           The calculation itself is in modis_calc, which can be used without this
+#-------------------------------------------------------------------------------
 
 from osgeo import gdal
-import numpy as np
 import os
 import sys
 from optparse import OptionParser
-import numexpr as ne
+
+from strip_warp import StripWarper, STRIP_ROWS
+from warp_index import WarpIndex
+from block_pipeline import blockList, DEFAULT_BUFFER_SETS
+from modis_calc import CALCULATIONS, check_inputs, covered_blocks, run_blocks, \
+    text_progress
 
 RequiredBandList = ["DayInput","NightInput"]
 
 # set up some default nodatavalues for each datatype
 DefaultNDVLookup={'Byte':255, 'UInt16':65535, 'Int16':-32767, 'UInt32':4294967293, 'Int32':-2147483647, 'Float32':1.175494351E-38, 'Float64':1.7976931348623158E+308}
-OutputNDV = 0
-gdalDatasetsIn = []
-
-# scale conversion
-_MODIS_SCALE_CONST = 0.02
-_MODIS_OFFSET_CONST = -273.15
 
 ################################################################
 # set up output files
 ################################################################
 
-def setupOutput(outputFN, opts, XSize, YSize, fileType=None, ndv=None):
-
-    global gdalDatasetsIn, OutputNDV
+def setupOutput(outputFN, opts, templateDS, fileType, ndv=None):
+    # returns (dataset, its nodata value), or None
+    XSize, YSize = templateDS.RasterXSize, templateDS.RasterYSize
     # open output file exists
     if os.path.isfile(outputFN) and not opts.overwrite:
         if opts.debug:
@@ -41,7 +40,6 @@ def setupOutput(outputFN, opts, XSize, YSize, fileType=None, ndv=None):
             return
         myOutB=myOut.GetRasterBand(1)
         OutputNDV=myOutB.GetNoDataValue()
-        myOutType=gdal.GetDataTypeName(myOutB.DataType)
 
     else:
         # remove existing file and regenerate
@@ -51,183 +49,106 @@ def setupOutput(outputFN, opts, XSize, YSize, fileType=None, ndv=None):
         if opts.debug:
             print("Generating output file %s" %(outputFN))
 
-        # find data type to use
-        if not fileType:
-            # use the largest type of the input files
-            myOutType=gdal.GetDataTypeName(max(myDataTypeNum))
-        else:
-            myOutType=fileType
-
         # create file
         myOutDrv = gdal.GetDriverByName(opts.format)
         myOut = myOutDrv.Create(
             outputFN, XSize, YSize, 1,
-            gdal.GetDataTypeByName(myOutType), opts.creation_options)
+            gdal.GetDataTypeByName(fileType), opts.creation_options)
 
         # set output geo info based on first input layer
-        myOut.SetGeoTransform(gdalDatasetsIn[0].GetGeoTransform())
-        myOut.SetProjection(gdalDatasetsIn[0].GetProjection())
+        myOut.SetGeoTransform(templateDS.GetGeoTransform())
+        myOut.SetProjection(templateDS.GetProjection())
 
         if ndv!=None:
             OutputNDV=ndv
         else:
-            OutputNDV=DefaultNDVLookup[myOutType]
+            OutputNDV=DefaultNDVLookup[fileType]
 
         myOutB = myOut.GetRasterBand(1)
         myOutB.SetNoDataValue(OutputNDV)
         myOutB = None
 
-    #if opts.debug:
-    #    print("output file: %s, dimensions: %s, %s, type: %s" %(outputFN,myOut.RasterXSize,myOut.RasterYSize,gdal.GetDataTypeName(myOutB.DataType)))
-    return myOut
+    return myOut, OutputNDV
 
 
-def doit(opts, args):
-    global gdalDatasetsIn
-    #bandsIn = []
-    dataTypes = []
-    dataTypeNums = []
-    inputNDVs = np.empty(len(RequiredBandList))
+def setupWarpedOutputs(outputFNs, opts, templateDS):
+    # outputs in global 30 arcsecond WGS84, filled a strip at a time by a StripWarper
+    for outputFN in outputFNs:
+        if os.path.isfile(outputFN):
+            if not opts.overwrite:
+                print("Error! Output %s exists. Use the --overwrite option to automatically overwrite the existing file" %(outputFN))
+                return
+            os.remove(outputFN)
+    if opts.NoDataValue!=None:
+        OutputNDV=opts.NoDataValue
+    else:
+        OutputNDV=DefaultNDVLookup['Float32']
+    # with a precomputed index (see warp_index.py) the warp is just a lookup
+    index = WarpIndex(opts.warp_index) if opts.warp_index else None
+    return StripWarper(outputFNs, OutputNDV, templateDS.GetGeoTransform(),
+                       templateDS.GetProjection(), opts.format,
+                       opts.creation_options, opts.warp_threads, index)
 
-    DimensionsCheck = None
-    # check dimensions of inputs
-    # loop through input files - checking dimensions
-    for i,myI in enumerate(RequiredBandList[0:len(sys.argv)-1]):
-        thisFN = eval("opts.%s" %(myI))
-        #myBand = eval("opts.%s_band" %(myI))
-        if thisFN:
-            gdalDatasetsIn.append(gdal.Open(thisFN, gdal.GA_ReadOnly))
-            dataTypes.append(gdal.GetDataTypeName(gdalDatasetsIn[i].GetRasterBand(1).DataType))
-            dataTypeNums.append(gdalDatasetsIn[i].GetRasterBand(1).DataType)
-            #inputNDVs.append(gdalDatasetsIn[i].GetRasterBand(1).GetNoDataValue())
-            inputNDVs[i] = gdalDatasetsIn[i].GetRasterBand(1).GetNoDataValue()
-            # check that the dimensions of each layer are the same
-            if DimensionsCheck:
-                if DimensionsCheck!=[gdalDatasetsIn[i].RasterXSize, gdalDatasetsIn[i].RasterYSize]:
-                    print("Error! Dimensions of file %s (%i, %i) are different from other files (%i, %i).  Cannot proceed" % \
-                            (thisFN,gdalDatasetsIn[i].RasterXSize, gdalDatasetsIn[i].RasterYSize,DimensionsCheck[0],DimensionsCheck[1]))
-                    return
-            else:
-                DimensionsCheck=[gdalDatasetsIn[i].RasterXSize, gdalDatasetsIn[i].RasterYSize]
-            if opts.debug:
-                print("file %s: %s, dimensions: %s, %s, type: %s" %(myI,thisFN,DimensionsCheck[0],DimensionsCheck[1],dataTypes[i]))
 
+def doit(opts, args):
+    inputFNs = [getattr(opts, myI) for myI in RequiredBandList]
+    gdalDatasetsIn = [gdal.Open(thisFN, gdal.GA_ReadOnly) for thisFN in inputFNs]
+    # check that the dimensions of each layer are the same
+    try:
+        XSize, YSize = check_inputs(gdalDatasetsIn)[:2]
+    except ValueError as e:
+        print("Error! %s.  Cannot proceed" % e)
+        return
+    if opts.debug:
+        for myI, thisFN, myDS in zip(RequiredBandList, inputFNs, gdalDatasetsIn):
+            print("file %s: %s, dimensions: %s, %s, type: %s" %(myI,thisFN,XSize,YSize,
+                  gdal.GetDataTypeName(myDS.GetRasterBand(1).DataType)))
 
     # set up output files
-    dayTempOut = setupOutput(opts.dayOutputFN, opts, DimensionsCheck[0], DimensionsCheck[1], 'Float32', opts.NoDataValue)
-    nightTempOut = setupOutput(opts.nightOutputFN, opts, DimensionsCheck[0], DimensionsCheck[1], 'Float32', opts.NoDataValue)
-    
-    #myBlockSize = gdalDatasetsIn[0].GetRasterBand(1).GetBlockSize()
-    # vrt file reports a block size of 128*128 but the underlying hdf block size is 1200*100
-    # so hard code this, or some clean multiple : this minimises disk access
-    myBlockSize = [4800,4800]
-    nXValid = myBlockSize[0]
-    nYValid = myBlockSize[1]
-    nXBlocks = (int)((DimensionsCheck[0] + myBlockSize[0] - 1) / myBlockSize[0]);
-    nYBlocks = (int)((DimensionsCheck[1] + myBlockSize[1] - 1) / myBlockSize[1]);
-    myBufSize = myBlockSize[0]*myBlockSize[1]
+    outputFNs = [opts.dayOutputFN, opts.nightOutputFN]
+    if opts.wgs84:
+        # reproject each strip as it's calculated, straight into the final outputs
+        outputs = setupWarpedOutputs(outputFNs, opts, gdalDatasetsIn[0])
+        if outputs is None:
+            return
+        OutputNDV = outputs.ndv
+        fillingIn = False
+        # the warp needs whole rows
+        myBlockSize = [XSize, opts.strip_rows]
+    else:
+        # existing outputs are filled in rather than replaced
+        fillingIn = not opts.overwrite and any(os.path.isfile(outputFN) for outputFN in outputFNs)
+        outputs = []
+        for outputFN in outputFNs:
+            myOut = setupOutput(outputFN, opts, gdalDatasetsIn[0], 'Float32', opts.NoDataValue)
+            if myOut is None:
+                return
+            outputs.append(myOut[0])
+            OutputNDV = myOut[1]
+        # vrt file reports a block size of 128*128 but the underlying hdf block size is 1200*100
+        # so hard code this, or some clean multiple : this minimises disk access
+        myBlockSize = list(CALCULATIONS["MOD11A2"].block_size)
+
+    blocks = blockList(XSize, YSize, myBlockSize[0], myBlockSize[1])
+    if not (opts.all_blocks or fillingIn):
+        # skip the blocks with no tiles in them at all (the oceans), leaving
+        # them unwritten, which reads as nodata in new SPARSE_OK outputs. Not
+        # when filling in existing outputs, whose old values would be left
+        nBlocks = len(blocks)
+        blocks = covered_blocks(blocks, inputFNs)
+        if opts.debug:
+            print("%d of %d blocks have tiles in them" % (len(blocks), nBlocks))
 
     if opts.debug:
         print("using blocksize %s x %s" %(myBlockSize[0], myBlockSize[1]))
 
-    # variables for displaying progress
-    ProgressCt = -1
-    ProgressMk = -1
-    ProgressEnd = nXBlocks * nYBlocks * 1 # for allBandsCount, removed
-
-
-    ################################################################
-    # start looping through blocks of data
-    ################################################################
-
-    # loop through X-lines
-    for X in range(0,nXBlocks):
-
-        # in the rare (impossible?) case that the blocks don't fit perfectly
-        # change the block size of the final piece
-        if X==nXBlocks-1:
-            nXValid = DimensionsCheck[0] - X * myBlockSize[0]
-            myBufSize = nXValid*nYValid
-
-        # find X offset
-        myX=X*myBlockSize[0]
-
-        # reset buffer size for start of Y loop
-        nYValid = myBlockSize[1]
-        myBufSize = nXValid * nYValid
-
-        # loop through Y lines
-        for Y in range(0,nYBlocks):
-            ProgressCt+=1
-            if 10*ProgressCt/ProgressEnd%10!=ProgressMk:
-                ProgressMk=10*ProgressCt/ProgressEnd%10
-                from sys import version_info
-                if version_info >= (3,0,0):
-                    exec('print("%d.." % (10*ProgressMk), end=" ")')
-                else:
-                    exec('print 10*ProgressMk, "..",')
-
-           #print ".",
-            # change the block size of the final piece
-            if Y==nYBlocks-1:
-                nYValid = DimensionsCheck[1] - Y * myBlockSize[1]
-                myBufSize = nXValid*nYValid
-
-            # find Y offset
-            myY=Y*myBlockSize[1]
-
-            # create empty buffer to mark where nodata occurs
-            myNDVs=np.zeros(myBufSize*len(gdalDatasetsIn))
-            myNDVs.shape=(len(gdalDatasetsIn),nYValid,nXValid)
-
-            # fetch data for each input layer
-            bands = np.empty(shape=(2, nYValid,nXValid),
-                                 dtype=gdal.GetDataTypeName(max(dataTypeNums)))
-            for i,OptName in enumerate(RequiredBandList):
-
-                # populate lettered arrays with values
-                #if allBandsIndex is not None and allBandsIndex==i:
-                #    myBandNo=bandNo
-                #else:
-                #    myBandNo=myBands[i]
-                myBandNo = 1
-                bands[i]=gdalDatasetsIn[i].GetRasterBand(myBandNo).ReadAsArray(
-                                      xoff=myX, yoff=myY,
-                                      win_xsize=nXValid, win_ysize=nYValid)
-
-                # create an array of values for this block
-                exec("%s=bands[i]" %OptName)
-
-                #myval=None
-            # fill in nodata values
-            #myNDVs=1*np.logical_or(myNDVs==1, bands[i]==myNDV[i])
-            myNDVs = bands == inputNDVs[:,np.newaxis,np.newaxis]
-            
-            # try the calculation on the array blocks
-            try:
-                # Do it with numexpr for easy multithreading:
-                #dayResult = ne.evaluate("(DayInput * _MODIS_SCALE_CONST) + _MODIS_OFFSET_CONST")
-                #nightResult = ne.evaluate("(DayInput * _MODIS_SCALE_CONST)  + _MODIS_OFFSET_CONST")
-                result = ne.evaluate("(bands * _MODIS_SCALE_CONST) + _MODIS_OFFSET_CONST")
-            except:
-                #print("evaluation of calculation %s failed" %(opts.calc))
-                raise
-
-            # propogate nodata values
-            # (set nodata cells to zero then add nodata value to these cells)
-
-            if 1: #useNumExpr:
-                result = ne.evaluate("((1 * (myNDVs==0))*result) + (OutputNDV * myNDVs)")
-                
-            else:
-                result = ((1 * (myNDVs==0))*result) + (OutputNDV * myNDVs)
+    # block k+1 is read and block k-1 written in other threads while block k
+    # is calculated
+    run_blocks(CALCULATIONS["MOD11A2"], gdalDatasetsIn, OutputNDV, outputs,
+               blocks, opts.buffers, text_progress)
 
-            # write data block to the output file
-            dayOutB=dayTempOut.GetRasterBand(1)
-            nightOutB=nightTempOut.GetRasterBand(1)
-            # this order relies on "day" being enumerated before "night"!
-            dayOutB.WriteArray(result[0], xoff=myX, yoff=myY)
-            nightOutB.WriteArray(result[1], xoff=myX, yoff=myY)
+    if opts.wgs84:
+        outputs.close()
     print ("100 - Done")
     return
 
@@ -250,6 +171,13 @@ def main():
         help="Passes a creation option to the output format driver. Multiple "
         "options may be listed. See format specific documentation for legal "
         "creation options for each format.")
+    parser.add_option("--wgs84", dest="wgs84", action="store_true",
+                      help="write the outputs reprojected to global 30 arcsecond WGS84 (as gdalwarp -t_srs EPSG:4326 -te -180 -90 180 90 in the batch files), without temporary sinusoidal files")
+    parser.add_option("--strip-rows", dest="strip_rows", type=int, default=STRIP_ROWS, help="rows to calculate and warp at once with --wgs84 (default %d)" % STRIP_ROWS)
+    parser.add_option("--warp-threads", dest="warp_threads", type=int, default=1, help="threads for the warp with --wgs84 (default 1)")
+    parser.add_option("--warp-index", dest="warp_index", help="with --wgs84, look the source pixels up in this index from warp_index.py instead of calling gdal.Warp")
+    parser.add_option("--buffers", dest="buffers", type=int, default=DEFAULT_BUFFER_SETS, help="blocks in memory at once, so reading, calculating and writing overlap (default %d; 1 does them one after another)" % DEFAULT_BUFFER_SETS)
+    parser.add_option("--all-blocks", dest="all_blocks", action="store_true", help="process every block, not just those with tiles in the input vrts")
     parser.add_option("--overwrite", dest="overwrite", action="store_true", help="overwrite output file if it already exists")
     parser.add_option("--debug", dest="debug", action="store_true", help="print debugging information")
 
@@ -0,0 +1,219 @@
+#-------------------------------------------------------------------------------
+# Name:     check_hdfs
+# Purpose:  Find corrupt or truncated HDFs in an archive before they break a
+#           day's mosaic hours into Process_*_From_HDF
+#-------------------------------------------------------------------------------
+"""
+Check every granule in a MODIS archive can be opened by GDAL and has the
+subdatasets we need (see modis_products.PRODUCTS), optionally also reading
+the last block of each subdataset, which is where a truncated file fails.
+
+Files are checked in a pool of processes. Results are kept in a cache file
+keyed on each file's size and mtime, so a rerun only opens files that are new
+or have changed, and the bad ones are written to a quarantine list, one path
+per line.
+
+    python check_hdfs.py D:\\MODIS\\Raw --sample -j 8 --quarantine bad_hdfs.txt
+"""
+
+from osgeo import gdal
+import csv
+import multiprocessing
+import os
+import sys
+import time
+from optparse import OptionParser
+
+from modis_products import product_for, subdataset_name
+
+DEFAULT_CACHE_NAME = ".hdf_check_cache.csv"
+CACHE_FIELDS = ["path", "size", "mtime", "ok", "sampled", "message"]
+
+
+def check_hdf(path, sample=False):
+    """Check one granule.
+
+    Parameters
+    ----------
+    path: str
+        The HDF file
+    sample: bool
+        Also read the last block of each subdataset
+    Returns
+    -------
+    (ok, message): whether it's usable and if not, why not
+    """
+    gdal.PushErrorHandler("CPLQuietErrorHandler")
+    try:
+        ds = gdal.Open(path, gdal.GA_ReadOnly)
+        if ds is None:
+            return False, "can't open: %s" % gdal.GetLastErrorMsg()
+        product = product_for(path)
+        if product is None:
+            # nothing more we know to check
+            return True, ""
+        available = [name for name, desc in ds.GetSubDatasets()]
+        for subdataset in product.subdatasets:
+            suffix = ":%s:%s" % (product.grid, subdataset)
+            if not any(name.endswith(suffix) for name in available):
+                return False, "no %s subdataset" % subdataset
+            if not sample:
+                continue
+            sds = gdal.Open(subdataset_name(path, product, subdataset))
+            if sds is None:
+                return False, "can't open %s: %s" % (subdataset,
+                                                     gdal.GetLastErrorMsg())
+            band = sds.GetRasterBand(1)
+            block_x, block_y = band.GetBlockSize()
+            yoff = ((band.YSize - 1) // block_y) * block_y
+            data = band.ReadAsArray(0, yoff, min(block_x, band.XSize),
+                                    band.YSize - yoff)
+            if data is None:
+                return False, "can't read %s: %s" % (subdataset,
+                                                     gdal.GetLastErrorMsg())
+        return True, ""
+    finally:
+        gdal.PopErrorHandler()
+
+
+def _check_worker(item):
+    path, size, mtime, sample = item
+    try:
+        ok, message = check_hdf(path, sample)
+    except Exception as e:
+        ok, message = False, str(e)
+    return path, size, mtime, ok, sample, message
+
+
+def _init_worker():
+    # each worker only ever has one file open, so don't let GDAL hang on to
+    # much memory
+    gdal.SetCacheMax(64 * 1024 * 1024)
+
+
+def load_cache(cache_path):
+    """The cached results as a dict of path: row dict."""
+    cache = {}
+    if not os.path.exists(cache_path):
+        return cache
+    with open(cache_path) as f:
+        for row in csv.DictReader(f):
+            cache[row["path"]] = row
+    return cache
+
+
+def save_cache(cache_path, cache):
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        writer = csv.DictWriter(f, CACHE_FIELDS, lineterminator="\n")
+        writer.writeheader()
+        for path in sorted(cache):
+            writer.writerow(cache[path])
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    os.rename(tmp_path, cache_path)
+
+
+def list_hdfs(archive_dir, recursive=False):
+    """(path, size, mtime) for every .hdf in the archive."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(archive_dir):
+        for name in filenames:
+            if name.endswith(".hdf"):
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                found.append((path, st.st_size, st.st_mtime))
+        if not recursive:
+            break
+    return found
+
+
+def _cached_result(cached, size, mtime, sample):
+    """A cached row if it's still valid for this file, else None."""
+    if cached is None:
+        return None
+    if int(cached["size"]) != size or float(cached["mtime"]) != mtime:
+        return None
+    if sample and cached["sampled"] != "1":
+        return None
+    return cached
+
+
+def scan_archive(archive_dir, cache_path=None, n_workers=None, sample=False,
+                 recursive=False, verbose=False):
+    """Check every HDF in an archive, reusing cached results for files
+    that haven't changed.
+
+    Returns
+    -------
+    A list of (path, message) for the bad files.
+    """
+    cache_path = cache_path or os.path.join(archive_dir, DEFAULT_CACHE_NAME)
+    cache = load_cache(cache_path)
+    files = list_hdfs(archive_dir, recursive)
+    present = set(path for path, size, mtime in files)
+    # forget about files that have gone
+    for path in list(cache):
+        if path not in present:
+            del cache[path]
+    to_check = [(path, size, mtime, sample) for path, size, mtime in files
+                if _cached_result(cache.get(path), size, mtime, sample) is None]
+    print("%d files, %d to check" % (len(files), len(to_check)))
+
+    t0 = time.time()
+    if to_check:
+        pool = multiprocessing.Pool(n_workers or multiprocessing.cpu_count(),
+                                    _init_worker)
+        try:
+            results = pool.imap_unordered(_check_worker, to_check,
+                                          chunksize=16)
+            for i, (path, size, mtime, ok, sampled, message) in \
+                    enumerate(results):
+                cache[path] = {"path": path, "size": size, "mtime": repr(mtime),
+                               "ok": int(ok), "sampled": int(sampled),
+                               "message": message}
+                if verbose and not ok:
+                    print("%s: %s" % (path, message))
+                if (i + 1) % 1000 == 0:
+                    # keep what we've done so far in case we're interrupted
+                    save_cache(cache_path, cache)
+                    print("%d of %d checked (%.0f files/s)" %
+                          (i + 1, len(to_check), (i + 1) / (time.time() - t0)))
+        finally:
+            pool.close()
+            pool.join()
+    save_cache(cache_path, cache)
+    return [(path, cache[path]["message"]) for path in sorted(cache)
+            if str(cache[path]["ok"]) != "1"]
+
+
+def main():
+    usage = "usage: %prog [options] ARCHIVE_DIR"
+    parser = OptionParser(usage)
+    parser.add_option("-j", "--jobs", dest="n_workers", type=int, default=None,
+                      help="number of processes (default one per CPU)")
+    parser.add_option("--sample", dest="sample", action="store_true", default=False,
+                      help="also read the last block of each subdataset")
+    parser.add_option("-r", "--recursive", dest="recursive", action="store_true", default=False,
+                      help="include subdirectories of the archive")
+    parser.add_option("--cache", dest="cache", default=None,
+                      help="where to keep the results (default %s in the archive)" % DEFAULT_CACHE_NAME)
+    parser.add_option("--quarantine", dest="quarantine", default="bad_hdfs.txt",
+                      help="file to list the bad HDFs in (default bad_hdfs.txt)")
+    parser.add_option("--debug", dest="debug", action="store_true",
+                      help="print each bad file as it's found")
+
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    bad = scan_archive(args[0], opts.cache, opts.n_workers, opts.sample,
+                       opts.recursive, opts.debug)
+    with open(opts.quarantine, "w") as f:
+        for path, message in bad:
+            f.write(path + "\n")
+    print("%d bad files listed in %s" % (len(bad), opts.quarantine))
+
+if __name__ == '__main__':
+    main()
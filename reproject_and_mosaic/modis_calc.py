@@ -0,0 +1,360 @@
+#-------------------------------------------------------------------------------
+# Name:     modis_calc
+# Purpose:  The calculations of calculate_indices.py and calculate_temps.py as
+#           functions of arrays and GDAL datasets, with no global state, so
+#           one process can run them day after day
+# Note:     calculate_*.py are now thin command line wrappers around this,
+#           and process_days.py's workers call it directly rather than
+#           starting a new Python (and GDAL and numexpr) for every day
+#-------------------------------------------------------------------------------
+"""
+The MCD43B4 indices (EVI, TCB, TCW) and MOD11A2 temperatures (day and night,
+in celsius) of calculate_indices.py / calculate_temps.py.
+
+On arrays in memory:
+
+    evi, tcb, tcw = calculate_indices(bands, [32767] * 7, -99)
+    day, night = calculate_temps(bands, [0, 0], -9999)
+
+where bands is the 7 (or 2) input bands stacked into one array. On GDAL
+datasets, a block at a time with the reads and writes overlapped (see
+block_pipeline.py):
+
+    run_blocks(CALCULATIONS["MCD43B4"], [gdal.Open(vrt) for vrt in vrts],
+               -99, [evi_ds, tcb_ds, tcw_ds])
+
+or from file to file, optionally reprojecting to WGS84 as it goes (see
+strip_warp.py):
+
+    calculate_files("MCD43B4", vrts, [evi_path, tcb_path, tcw_path], -99,
+                    wgs84=True)
+"""
+
+import collections
+import os
+import sys
+
+from osgeo import gdal, gdal_array
+import numpy as np
+import numexpr as ne
+
+from block_pipeline import BlockPipeline, blockList, coveredBlocks, \
+    DEFAULT_BUFFER_SETS
+from modis_vrt import vrt_coverage
+from strip_warp import STRIP_ROWS, StripWarper
+
+# EVI coefficients from huete et al
+_EVI_C1 = 6.0
+_EVI_C2 = 7.5
+_EVI_L = 1.0
+_EVI_G = 2.5
+
+# tasseled cap coefficients provided by Dan Weiss
+# tasseled cap brightness coefficients
+_TCB_COEFFS = np.asarray(
+    [0.4395, 0.5945, 0.2460, 0.3918, 0.3506, 0.2136, 0.2678])
+
+# tasseled cap wetness coefficients
+_TCW_COEFFS = np.asarray(
+    [0.1147, 0.2489, 0.2408, 0.3132, -0.3122, -0.6416, -0.5087])
+
+# scale conversions
+_REFLECTANCE_SCALE = 0.0001
+_LST_SCALE = 0.02
+_LST_OFFSET = -273.15
+
+
+# each index is calculated by numexpr straight into its output buffer, then
+# clipped (EVI to 0..1, the tasseled caps to +-100) and set to nodata where any
+# band it uses is (EVI uses bands 1-3, the tasseled caps all of them) in a
+# second pass over just that and a mask of the nodata pixels. numexpr doesn't
+# reuse common subexpressions, so doing it all in one expression calculated
+# the index three times over, and the nodata tests are only done once
+def _any_nodata(first, last):
+    return " | ".join("(B%d == N%d)" % (b, b) for b in range(first, last + 1))
+
+
+def _clip_expr(lo, hi):
+    return "where(NODATA, NDV, where(OUT < %s, %s, where(OUT > %s, %s, OUT)))" % (
+        lo, lo, hi, hi)
+
+_EVI_NODATA_EXPR = _any_nodata(1, 3)
+# the bands the tasseled caps use that EVI doesn't
+_TC_NODATA_EXPR = "NODATA | " + _any_nodata(4, 7)
+_EVI_EXPR = "((B2 - B1)*SCALE) / ((B2 + (B1 * EVI_C1) - (B3 * EVI_C2))*SCALE + EVI_L) * EVI_G"
+_TCB_EXPR = "(%s)*SCALE" % " + ".join("B%d*TCB%d" % (b + 1, b) for b in range(7))
+_TCW_EXPR = "(%s)*SCALE" % " + ".join("B%d*TCW%d" % (b + 1, b) for b in range(7))
+_EVI_CLIP = _clip_expr(0, 1)
+_TC_CLIP = _clip_expr(-100, 100)
+
+
+def _evaluate_clipped(expr, clip, names, out):
+    ne.evaluate(expr, local_dict=names, out=out, casting="same_kind")
+    names["OUT"] = out
+    ne.evaluate(clip, local_dict=names, out=out, casting="same_kind")
+
+
+def index_kernel(bands, input_ndvs, ndv, results):
+    """EVI (from equation 12 in Huete et al), TCB and TCW of the 7 MCD43B4
+    bands, into results[0], [1] and [2]."""
+    names = {"SCALE": _REFLECTANCE_SCALE, "EVI_C1": _EVI_C1,
+             "EVI_C2": _EVI_C2, "EVI_L": _EVI_L, "EVI_G": _EVI_G, "NDV": ndv}
+    for i in range(7):
+        names["B%d" % (i + 1)] = bands[i]
+        names["N%d" % (i + 1)] = input_ndvs[i]
+        names["TCB%d" % i] = _TCB_COEFFS[i]
+        names["TCW%d" % i] = _TCW_COEFFS[i]
+    # todo : handle nan in evi? i.e. when it is divide by zero
+    names["NODATA"] = ne.evaluate(_EVI_NODATA_EXPR, local_dict=names)
+    _evaluate_clipped(_EVI_EXPR, _EVI_CLIP, names, results[0])
+    ne.evaluate(_TC_NODATA_EXPR, local_dict=names, out=names["NODATA"])
+    _evaluate_clipped(_TCB_EXPR, _TC_CLIP, names, results[1])
+    _evaluate_clipped(_TCW_EXPR, _TC_CLIP, names, results[2])
+
+
+def temps_kernel(bands, input_ndvs, ndv, results):
+    """The MOD11A2 day and night bands scaled to celsius, into results."""
+    ne.evaluate("where(bands == band_ndvs, NDV, (bands * SCALE) + OFFSET)",
+                local_dict={"bands": bands,
+                            "band_ndvs": np.asarray(input_ndvs, dtype=np.float64)[:, np.newaxis, np.newaxis],
+                            "NDV": ndv, "SCALE": _LST_SCALE,
+                            "OFFSET": _LST_OFFSET},
+                out=results, casting="same_kind")
+
+
+# n_inputs, n_outputs: bands in and out; block_size: the (xsize, ysize) to
+# read the sinusoidal mosaic in, a clean multiple of the HDFs' 1200x100
+# blocks; kernel: function(bands, input nodata values, output nodata value,
+# results), filling a float32 results array (n_outputs, rows, cols) from an
+# array of the bands (n_inputs, rows, cols)
+Calculation = collections.namedtuple(
+    "Calculation", ["name", "n_inputs", "n_outputs", "block_size", "kernel"])
+
+CALCULATIONS = {
+    "MCD43B4": Calculation("indices", 7, 3, (2400, 2400), index_kernel),
+    "MOD11A2": Calculation("temps", 2, 2, (4800, 4800), temps_kernel),
+}
+
+
+def calculate(calculation, bands, input_ndvs, ndv, out=None):
+    """Run a calculation on arrays in memory.
+
+    Parameters
+    ----------
+    calculation: Calculation
+        From CALCULATIONS
+    bands: array
+        The input bands, (n_inputs, rows, cols), of any numeric type
+    input_ndvs: list
+        The nodata value of each band
+    ndv: float
+        Nodata value of the results
+    out: array
+        float32 (n_outputs, rows, cols) to write the results into, default a
+        new one
+    Returns
+    -------
+    The results, out if it was given.
+    """
+    if len(bands) != calculation.n_inputs:
+        raise ValueError("the %s need %d bands, not %d" % (
+            calculation.name, calculation.n_inputs, len(bands)))
+    if out is None:
+        out = np.empty((calculation.n_outputs,) + tuple(np.shape(bands[0])),
+                       dtype=np.float32)
+    calculation.kernel(bands, input_ndvs, ndv, out)
+    return out
+
+
+def calculate_indices(bands, input_ndvs, ndv=-99, out=None):
+    """EVI, TCB and TCW of the 7 MCD43B4 bands, see calculate."""
+    return calculate(CALCULATIONS["MCD43B4"], bands, input_ndvs, ndv, out)
+
+
+def calculate_temps(bands, input_ndvs, ndv=-9999, out=None):
+    """Day and night LST in celsius from the MOD11A2 bands, see calculate."""
+    return calculate(CALCULATIONS["MOD11A2"], bands, input_ndvs, ndv, out)
+
+
+def check_inputs(datasets):
+    """The size, band nodata values and numpy type of some input datasets.
+
+    Returns
+    -------
+    (xsize, ysize, list of nodata values, numpy type to read them all as)
+
+    Raises ValueError if they aren't all the same size.
+    """
+    xsize, ysize = datasets[0].RasterXSize, datasets[0].RasterYSize
+    for ds in datasets[1:]:
+        if (ds.RasterXSize, ds.RasterYSize) != (xsize, ysize):
+            raise ValueError("dimensions of %s (%i, %i) are different from other files (%i, %i)" % (
+                ds.GetDescription(), ds.RasterXSize, ds.RasterYSize, xsize, ysize))
+    input_ndvs = [ds.GetRasterBand(1).GetNoDataValue() for ds in datasets]
+    # numpy no longer understands gdal's type names (Int16 etc)
+    band_type = gdal_array.GDALTypeCodeToNumericTypeCode(
+        max(ds.GetRasterBand(1).DataType for ds in datasets))
+    return xsize, ysize, input_ndvs, band_type
+
+
+def covered_blocks(blocks, input_paths):
+    """Just the blocks with tiles in them, if the inputs are mosaic VRTs,
+    leaving out the oceans; otherwise all of them."""
+    coverage = []
+    for path in input_paths:
+        rects = vrt_coverage(path)
+        if rects is None:
+            return blocks
+        coverage.extend(rects)
+    return coveredBlocks(blocks, coverage)
+
+
+def text_progress(done, total):
+    """A progress function for run_blocks printing 0.. 10.. 20.. like the
+    GDAL utilities."""
+    if done == 0 or 10 * done // total != 10 * (done - 1) // total:
+        sys.stdout.write("%d.. " % (10 * (10 * done // total)))
+        sys.stdout.flush()
+
+
+def run_blocks(calculation, datasets, ndv, outputs, blocks=None,
+               n_buffers=DEFAULT_BUFFER_SETS, progress=None):
+    """Run a calculation over GDAL datasets a block at a time.
+
+    Parameters
+    ----------
+    calculation: Calculation
+        From CALCULATIONS
+    datasets: list
+        The input datasets, one per band, all the same size
+    ndv: float
+        Nodata value of the results
+    outputs: list or StripWarper
+        One dataset per result, the same size as the inputs; or a
+        StripWarper, in which case the blocks must be full-width strips
+    blocks: list
+        (xoff, yoff, xsize, ysize) of each block to do; default all of the
+        calculation's block_size (or strips of STRIP_ROWS for a StripWarper)
+    n_buffers: int
+        Blocks in memory at once, see BlockPipeline
+    progress: function(done, total)
+        Called as each block is started, e.g. text_progress
+    """
+    xsize, ysize, input_ndvs, band_type = check_inputs(datasets)
+    if blocks is None:
+        if isinstance(outputs, StripWarper):
+            blocks = blockList(xsize, ysize, xsize, STRIP_ROWS)
+        else:
+            blocks = blockList(xsize, ysize, *calculation.block_size)
+    n_done = [0]
+
+    def makeBuffers(block_xsize, block_ysize):
+        # the bands and the results of a block, reused for later blocks
+        bands = np.empty((calculation.n_inputs, block_ysize, block_xsize), dtype=band_type)
+        results = np.empty((calculation.n_outputs, block_ysize, block_xsize), dtype=np.float32)
+        return bands, results
+
+    def readBlock(block, buffers):
+        xoff, yoff, block_xsize, block_ysize = block
+        # straight into the buffer
+        for ds, band in zip(datasets, buffers[0]):
+            ds.GetRasterBand(1).ReadAsArray(xoff=xoff, yoff=yoff,
+                                            win_xsize=block_xsize,
+                                            win_ysize=block_ysize,
+                                            buf_obj=band)
+
+    def computeBlock(block, buffers):
+        if progress is not None:
+            progress(n_done[0], len(blocks))
+        n_done[0] += 1
+        bands, results = buffers
+        calculation.kernel(bands, input_ndvs, ndv, results)
+
+    def writeBlock(block, buffers):
+        xoff, yoff = block[:2]
+        results = buffers[1]
+        if isinstance(outputs, StripWarper):
+            outputs.write(yoff, list(results))
+            return
+        for ds, result in zip(outputs, results):
+            ds.GetRasterBand(1).WriteArray(result, xoff=xoff, yoff=yoff)
+
+    BlockPipeline(readBlock, computeBlock, writeBlock, makeBuffers,
+                  n_buffers).run(blocks)
+
+
+def calculate_files(product_name, input_paths, output_paths, ndv, wgs84=False,
+                    out_format="GTiff", creation_options=None, n_threads=1,
+                    index=None, strip_rows=STRIP_ROWS,
+                    n_buffers=DEFAULT_BUFFER_SETS, all_blocks=False,
+                    progress=None):
+    """Run a product's calculation from its input files into new output
+    files, replacing any that are there.
+
+    Parameters
+    ----------
+    product_name: str
+        A key of CALCULATIONS
+    input_paths: list
+        One GDAL dataset per band, e.g. the mosaic VRTs from modis_vrt
+    output_paths: list
+        One Float32 file per result
+    ndv: float
+        Nodata value of the outputs
+    wgs84: bool
+        Write the outputs reprojected to global 30 arcsecond WGS84 (see
+        StripWarper), calculating strip_rows full-width rows at a time;
+        otherwise on the grid of the inputs
+    out_format, creation_options:
+        For the outputs
+    n_threads: int
+        For the warp, with wgs84
+    index: warp_index.WarpIndex
+        Reproject with this rather than gdal.Warp, with wgs84
+    all_blocks: bool
+        Calculate every block, rather than just those with tiles in them
+    n_buffers, progress:
+        As for run_blocks
+    """
+    calculation = CALCULATIONS[product_name]
+    datasets = []
+    for path in input_paths:
+        ds = gdal.Open(path, gdal.GA_ReadOnly)
+        if ds is None:
+            raise IOError("couldn't open %s" % path)
+        datasets.append(ds)
+    xsize, ysize = datasets[0].RasterXSize, datasets[0].RasterYSize
+    for path in output_paths:
+        if os.path.isfile(path):
+            os.remove(path)
+    if wgs84:
+        outputs = StripWarper(output_paths, ndv, datasets[0].GetGeoTransform(),
+                              datasets[0].GetProjection(), out_format,
+                              creation_options, n_threads, index)
+        blocks = blockList(xsize, ysize, xsize, strip_rows)
+    else:
+        outputs = []
+        driver = gdal.GetDriverByName(out_format)
+        for path in output_paths:
+            ds = driver.Create(path, xsize, ysize, 1, gdal.GDT_Float32,
+                               creation_options or [])
+            ds.SetGeoTransform(datasets[0].GetGeoTransform())
+            ds.SetProjection(datasets[0].GetProjection())
+            ds.GetRasterBand(1).SetNoDataValue(ndv)
+            outputs.append(ds)
+        blocks = blockList(xsize, ysize, *calculation.block_size)
+    if not all_blocks:
+        # skip the blocks with no tiles in them at all (the oceans), leaving
+        # them unwritten, which reads as nodata in SPARSE_OK outputs
+        blocks = covered_blocks(blocks, input_paths)
+    try:
+        run_blocks(calculation, datasets, ndv, outputs, blocks, n_buffers,
+                   progress)
+    finally:
+        # close everything, so nothing is held open from one day to the next
+        if wgs84:
+            outputs.close()
+        else:
+            for ds in outputs:
+                ds.FlushCache()
+        outputs = datasets = None
@@ -0,0 +1,105 @@
+#-------------------------------------------------------------------------------
+# Name:     modis_products
+# Purpose:  What we need to know about each MODIS product we process (which
+#           HDF-EOS subdatasets it has, their data type and nodata value, the
+#           tile size) and about the sinusoidal grid the tiles sit on
+#-------------------------------------------------------------------------------
+
+import collections
+import os
+import re
+
+# grid: the HDF-EOS grid name; subdatasets: the fields we use from it;
+# band_names: short names for those, as used in the .vrt filenames;
+# tile_pixels: the width (and height) of one tile; data_type and nodata: as
+# stored in the HDFs (the _FillValue)
+ProductInfo = collections.namedtuple(
+    "ProductInfo",
+    ["name", "grid", "subdatasets", "band_names", "tile_pixels", "data_type",
+     "nodata"])
+
+PRODUCTS = {
+    "MCD43B4": ProductInfo(
+        "MCD43B4", "MOD_Grid_BRDF",
+        ["Nadir_Reflectance_Band%d" % b for b in range(1, 8)],
+        ["Band%d" % b for b in range(1, 8)],
+        1200, "Int16", 32767),
+    "MOD11A2": ProductInfo(
+        "MOD11A2", "MODIS_Grid_8Day_1km_LST",
+        ["LST_Day_1km", "LST_Night_1km"],
+        ["Day", "Night"],
+        1200, "UInt16", 0),
+}
+
+# the global sinusoidal mosaic extent, as passed to gdalbuildvrt -te in the
+# Process_*_From_HDF.bat files
+SIN_XMIN = -20015109.356
+SIN_YMIN = -10007554.678
+SIN_XMAX = 20015109.356
+SIN_YMAX = 10007554.678
+N_TILES_H = 36
+N_TILES_V = 18
+# and the resolution passed as -tr, for 1200 pixel (1km) tiles
+SIN_XRES_1KM = 926.625433138760630
+SIN_YRES_1KM = 926.625433138788940
+
+# the radius of the MODIS sinusoidal sphere
+SIN_RADIUS = 6371007.181
+
+# the global 30 arcsecond WGS84 grid the outputs are on, as given to gdalwarp
+# in the batch files
+WGS84_RES = 0.008333333333333
+WGS84_XSIZE = 43200
+WGS84_YSIZE = 21600
+WGS84_GEOTRANSFORM = (-180.0, WGS84_RES, 0.0, 90.0, 0.0, -WGS84_RES)
+
+# the MODIS sinusoidal projection, as GDAL reports it for the HDFs
+SIN_WKT = (
+    'PROJCS["unnamed",GEOGCS["Unknown datum based upon the custom spheroid",'
+    'DATUM["Not specified (based on custom spheroid)",'
+    'SPHEROID["Custom spheroid",6371007.181,0]],PRIMEM["Greenwich",0],'
+    'UNIT["degree",0.0174532925199433]],PROJECTION["Sinusoidal"],'
+    'PARAMETER["longitude_of_center",0],PARAMETER["false_easting",0],'
+    'PARAMETER["false_northing",0],UNIT["Meter",1]]')
+
+# e.g. MCD43B4.A2002345.h17v00.005.2009071183311.hdf
+_GRANULE_RE = re.compile(
+    r"^([A-Za-z0-9]+)\.(A\d{7})\.h(\d{2})v(\d{2})\.(\d{3})\.(\d{13})\.hdf$")
+
+Granule = collections.namedtuple("Granule", ["product", "day", "h", "v"])
+
+
+def parse_granule(fname):
+    """Get the product, day token (e.g. A2002345) and tile numbers out of a
+    granule filename, or None if it isn't one."""
+    match = _GRANULE_RE.match(os.path.basename(fname))
+    if match is None:
+        return None
+    return Granule(match.group(1), match.group(2), int(match.group(3)),
+                   int(match.group(4)))
+
+
+def product_for(fname):
+    """The ProductInfo for a granule filename, or None if we don't know it."""
+    granule = parse_granule(fname)
+    if granule is None:
+        return None
+    return PRODUCTS.get(granule.product)
+
+
+def subdataset_name(hdf_path, product, subdataset):
+    """The GDAL name of one field of a granule, as used in the .bat files."""
+    return 'HDF4_EOS:EOS_GRID:"%s":%s:%s' % (hdf_path, product.grid,
+                                             subdataset)
+
+
+def mosaic_size(product):
+    """(xsize, ysize) of the global sinusoidal mosaic of a product."""
+    return N_TILES_H * product.tile_pixels, N_TILES_V * product.tile_pixels
+
+
+def mosaic_geotransform(product):
+    """The GDAL geotransform of the global sinusoidal mosaic of a product."""
+    scale = 1200.0 / product.tile_pixels
+    return (SIN_XMIN, SIN_XRES_1KM * scale, 0.0,
+            SIN_YMAX, 0.0, -SIN_YRES_1KM * scale)
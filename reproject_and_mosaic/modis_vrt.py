@@ -0,0 +1,178 @@
+#-------------------------------------------------------------------------------
+# Name:     modis_vrt
+# Purpose:  Write the global mosaic VRTs for a day of MODIS tiles directly,
+#           instead of calling gdalbuildvrt once per band
+# Note:     gdalbuildvrt opens every HDF to find out where it goes, but a
+#           tile's place in the mosaic is fixed by the hXXvYY in its name and
+#           the sinusoidal grid, so the VRT can be written without touching
+#           the HDFs at all
+#-------------------------------------------------------------------------------
+"""
+Global sinusoidal mosaic VRTs for one day, from the tile names alone.
+
+The VRTs cover the same extent at the same resolution as
+
+    gdalbuildvrt -te -20015109.356 -10007554.678 20015109.356 10007554.678
+        -tr 926.625433138760630 926.625433138788940
+
+in the Process_*_From_HDF.bat files, with each tile placed at exactly
+(h * 1200, v * 1200) pixels. The source size, type and block size are
+written into the VRT too, so GDAL doesn't need to open an HDF until it
+actually reads from it.
+
+    python modis_vrt.py -p MCD43B4 -d A2002345 M:\\data M:\\vrts
+"""
+
+import os
+import sys
+from optparse import OptionParser
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from modis_products import PRODUCTS, SIN_WKT, mosaic_geotransform, \
+    mosaic_size, parse_granule, subdataset_name
+
+# the HDFs are stored in chunks of 100 full-width rows
+HDF_BLOCK_ROWS = 100
+
+
+def mosaic_vrt_xml(product, sources, data_type=None, nodata=None,
+                   block_rows=HDF_BLOCK_ROWS):
+    """The XML of a global mosaic VRT of some single-band tile rasters.
+
+    Parameters
+    ----------
+    product: ProductInfo
+        From modis_products.PRODUCTS, for the grid
+    sources: list
+        (GDAL name, h, v) of each tile raster, each tile_pixels square
+    data_type, nodata: str, float
+        Of the tiles, default the product's (as in the HDFs)
+    block_rows: int
+        Rows per block of the tiles
+    Returns
+    -------
+    The VRT as a string.
+    """
+    data_type = data_type or product.data_type
+    nodata = product.nodata if nodata is None else nodata
+    xsize, ysize = mosaic_size(product)
+    tile = product.tile_pixels
+    geotransform = ", ".join("%.16g" % v for v in mosaic_geotransform(product))
+    lines = [
+        '<VRTDataset rasterXSize="%d" rasterYSize="%d">' % (xsize, ysize),
+        '  <SRS>%s</SRS>' % escape(SIN_WKT),
+        '  <GeoTransform>%s</GeoTransform>' % geotransform,
+        '  <VRTRasterBand dataType="%s" band="1">' % data_type,
+        '    <NoDataValue>%s</NoDataValue>' % nodata,
+    ]
+    for name, h, v in sources:
+        lines.extend([
+            '    <SimpleSource>',
+            '      <SourceFilename relativeToVRT="0">%s</SourceFilename>' %
+            escape(name),
+            '      <SourceBand>1</SourceBand>',
+            '      <SourceProperties RasterXSize="%d" RasterYSize="%d" '
+            'DataType="%s" BlockXSize="%d" BlockYSize="%d" />' %
+            (tile, tile, data_type, tile, block_rows),
+            '      <SrcRect xOff="0" yOff="0" xSize="%d" ySize="%d" />' %
+            (tile, tile),
+            '      <DstRect xOff="%d" yOff="%d" xSize="%d" ySize="%d" />' %
+            (h * tile, v * tile, tile, tile),
+            '    </SimpleSource>',
+        ])
+    lines.extend(['  </VRTRasterBand>', '</VRTDataset>', ''])
+    return "\n".join(lines)
+
+
+def band_vrt_xml(product, subdataset, hdf_paths):
+    """The XML of a global mosaic VRT of one subdataset of some granules.
+
+    Parameters
+    ----------
+    product: ProductInfo
+        From modis_products.PRODUCTS
+    subdataset: str
+        One of product.subdatasets
+    hdf_paths: list
+        The granules (of one day) to mosaic. Only their names are used.
+    Returns
+    -------
+    The VRT as a string.
+    """
+    sources = []
+    for path in hdf_paths:
+        granule = parse_granule(path)
+        if granule is None:
+            continue
+        sources.append((subdataset_name(path, product, subdataset),
+                        granule.h, granule.v))
+    return mosaic_vrt_xml(product, sources)
+
+
+def write_day_vrts(product, hdf_paths, vrt_dir, day):
+    """Write a mosaic VRT for each subdataset of a day's granules, named like
+    the .bat files' ones, e.g. A2002345_Band1.vrt or A2002345_Day.vrt.
+
+    Returns
+    -------
+    A list of the VRT paths, in the order of product.subdatasets.
+    """
+    vrt_paths = []
+    for subdataset, band_name in zip(product.subdatasets, product.band_names):
+        vrt_path = os.path.join(vrt_dir, "%s_%s.vrt" % (day, band_name))
+        with open(vrt_path, "w") as f:
+            f.write(band_vrt_xml(product, subdataset, hdf_paths))
+        vrt_paths.append(vrt_path)
+    return vrt_paths
+
+
+def vrt_coverage(vrt_path):
+    """The parts of a VRT's raster that come from one of its sources, as a
+    list of (xoff, yoff, xsize, ysize) rectangles in VRT pixels, from the
+    DstRects (which gdalbuildvrt writes too). None if it isn't a VRT."""
+    if not vrt_path.lower().endswith(".vrt"):
+        return None
+    try:
+        root = ElementTree.parse(vrt_path).getroot()
+    except (IOError, OSError, ElementTree.ParseError):
+        return None
+    rects = []
+    for rect in root.iter("DstRect"):
+        rects.append(tuple(int(round(float(rect.get(name)))) for name in
+                           ("xOff", "yOff", "xSize", "ySize")))
+    return rects
+
+
+def day_granules(data_dir, product_name, day):
+    """The granules of one product and day in a directory, sorted by tile."""
+    found = []
+    for name in os.listdir(data_dir):
+        granule = parse_granule(name)
+        if granule is not None and granule.product == product_name and \
+                granule.day == day:
+            found.append(((granule.v, granule.h), os.path.join(data_dir, name)))
+    return [path for key, path in sorted(found)]
+
+
+def main():
+    usage = "usage: %prog -p PRODUCT -d DAY DATA_DIR VRT_DIR"
+    parser = OptionParser(usage)
+    parser.add_option("-p", "--product", dest="product",
+                      help="product, one of %s" % sorted(PRODUCTS.keys()))
+    parser.add_option("-d", "--day", dest="day",
+                      help="day token from the filenames, e.g. A2002345")
+
+    (opts, args) = parser.parse_args()
+    if len(args) != 2 or not opts.day or opts.product not in PRODUCTS:
+        parser.print_help()
+        sys.exit(1)
+
+    data_dir, vrt_dir = args
+    product = PRODUCTS[opts.product]
+    hdf_paths = day_granules(data_dir, product.name, opts.day)
+    for vrt_path in write_day_vrts(product, hdf_paths, vrt_dir, opts.day):
+        print("%s (%d tiles)" % (vrt_path, len(hdf_paths)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,461 @@
+#-------------------------------------------------------------------------------
+# Name:     process_days
+# Purpose:  Run the HDF -> global WGS84 GeoTIFF workflow of the
+#           Process_*_From_HDF.bat files for every day in an archive, several
+#           days at a time, sized to the machine
+#-------------------------------------------------------------------------------
+"""
+Process every day of a product in an archive, like calling
+Process_MCD43B4_Indices_From_HDF.bat / Process_MOD11A2_Temp_From_HDF.bat
+through ppx2 -P 4, but without having to tune the batch files by hand.
+
+For each day this does what the batch files do: stage the day's HDFs on the
+scratch disk, write the mosaic VRTs (with modis_vrt, so the HDFs aren't
+opened to do it), run the calculate_indices.py / calculate_temps.py
+calculation to make temporary sinusoidal GeoTIFFs, gdalwarp those into the
+compressed WGS84 outputs, and clean up. Days run in a pool of worker
+processes, which call the calculation (modis_calc) themselves, so Python,
+GDAL and numexpr are started once per worker rather than once per day.
+
+The staging is done by the main process, one day after another (see
+staging.py), a few days ahead of the workers, so copying the next days' HDFs
+off the archive disk overlaps with computing the current ones instead of
+every worker waiting on its own copy.
+
+Rather than "4 processes, GDAL_CACHEMAX=8000 on a 64Gb machine", give the
+memory and CPUs it may use; the number of workers, each one's GDAL cache and
+its numexpr / warp threads are worked out from those. Days whose outputs are
+all there already are skipped, so it can be rerun after an interruption.
+
+    python process_days.py -p MCD43B4 /data/MCD43B4 /output/MCD43B4_Indices \\
+        --memory 64 --scratch /dev/shm/modis
+"""
+
+import collections
+import functools
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+from osgeo import gdal
+import numexpr as ne
+
+from modis_calc import calculate_files
+from modis_products import PRODUCTS, mosaic_geotransform, mosaic_size, \
+    parse_granule
+from modis_vrt import write_day_vrts
+from staging import StagingArea
+from warp_index import WarpIndex, build_index
+
+# how the batch files process each product (the calculation is
+# modis_calc.CALCULATIONS[product]): its outputs, in the calculation's order,
+# as (output subdirectory, name suffix) and the output nodata value
+DayJob = collections.namedtuple("DayJob", ["outputs", "ndv"])
+
+DAY_JOBS = {
+    "MCD43B4": DayJob(
+        [("EVI", "EVI"), ("TCB", "TCB"), ("TCW", "TCW")],
+        -99),
+    "MOD11A2": DayJob(
+        [("Day", "LST_Day"), ("Night", "LST_Night")],
+        -9999),
+}
+
+# creation options for the temporary sinusoidal tiffs and the outputs, as in
+# the batch files
+TMP_CREATION_OPTIONS = ["TILED=YES", "SPARSE_OK=TRUE", "BLOCKXSIZE=1024",
+                        "BLOCKYSIZE=1024"]
+OUTPUT_CREATION_OPTIONS = ["COMPRESS=LZW", "PREDICTOR=2", "TILED=YES",
+                           "SPARSE_OK=TRUE"]
+WARP_EXTENT = ["-te", "-180", "-90", "180", "90",
+               "-tr", "0.008333333333333", "-0.008333333333333"]
+
+# memory (MB) each worker needs besides its GDAL cache: gdalwarp -wm, the
+# block buffers in modis_calc (three blocks in flight, up to about 575Mb
+# each for the 7-band strips of --fused), and a day of HDFs if the scratch
+# area is in memory
+WARP_MEMORY_MB = 1024
+COMPUTE_MEMORY_MB = 2048
+DAY_HDFS_MB = 1500
+# a worker isn't worth running with less GDAL cache than this, and more than
+# this doesn't help
+MIN_CACHE_MB = 4000
+MAX_CACHE_MB = 12000
+# and it wants at least this many threads for numexpr and the warp
+MIN_THREADS = 2
+# days staged ahead of the ones being processed
+PREFETCH_DAYS = 2
+# how often (seconds) to check that the workers processing days are still
+# there, as a day whose worker dies never gets a result
+WORKER_CHECK_SECONDS = 10
+
+Resources = collections.namedtuple(
+    "Resources", ["n_workers", "cache_mb", "n_threads"])
+
+
+def physical_memory_mb():
+    """Total RAM in MB, or None if we can't tell."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // \
+            (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def plan_resources(memory_mb, n_cpus, scratch_in_memory=False, n_workers=None,
+                   prefetch_days=PREFETCH_DAYS):
+    """Work out how many days to run at once and what each one gets.
+
+    Parameters
+    ----------
+    memory_mb: int
+        Memory the whole run may use
+    n_cpus: int
+        CPUs the whole run may use
+    scratch_in_memory: bool
+        Whether the scratch area is a RAM disk, so the staged HDFs count
+        against memory
+    n_workers: int
+        Use this many workers rather than working it out
+    prefetch_days: int
+        Days staged ahead of the workers, which also count against memory if
+        the scratch area is in it
+    Returns
+    -------
+    Resources
+    """
+    fixed_mb = WARP_MEMORY_MB + COMPUTE_MEMORY_MB
+    if scratch_in_memory:
+        fixed_mb += DAY_HDFS_MB
+        memory_mb -= prefetch_days * DAY_HDFS_MB
+    if n_workers is None:
+        by_memory = memory_mb // (fixed_mb + MIN_CACHE_MB)
+        by_cpu = n_cpus // MIN_THREADS
+        n_workers = max(1, min(by_memory, by_cpu))
+    cache_mb = memory_mb // n_workers - fixed_mb
+    cache_mb = max(256, min(MAX_CACHE_MB, cache_mb))
+    n_threads = max(1, n_cpus // n_workers)
+    return Resources(n_workers, cache_mb, n_threads)
+
+
+def find_days(data_dir, product_name, recursive=True):
+    """The granules of each day of a product in an archive.
+
+    Returns
+    -------
+    An ordered dict of day token (e.g. A2002345): list of HDF paths.
+    """
+    days = collections.defaultdict(list)
+    for dirpath, dirnames, filenames in os.walk(data_dir):
+        for name in filenames:
+            granule = parse_granule(name)
+            if granule is not None and granule.product == product_name:
+                days[granule.day].append(os.path.join(dirpath, name))
+        if not recursive:
+            break
+    return collections.OrderedDict(sorted(days.items()))
+
+
+def output_paths(product_name, output_dir, day):
+    return [os.path.join(output_dir, subdir, "%s_%s.tif" % (day, suffix))
+            for subdir, suffix in DAY_JOBS[product_name].outputs]
+
+
+def _tile_order(path):
+    granule = parse_granule(path)
+    return (granule.v, granule.h)
+
+
+# each worker's WarpIndex, loaded once and used for all its days, and where
+# it says which day it's started on, as (day, pid)
+_worker_index = None
+_worker_started = None
+
+
+def process_day(task):
+    """Process one day's staged HDFs, in a worker. Returns
+    (day, ok, seconds, message)."""
+    (product_name, day, hdf_paths, output_dir, scratch_dir, tmp_dir, vrt_dir,
+     resources, fused) = task
+    if _worker_started is not None:
+        _worker_started.put((day, os.getpid()))
+    t0 = time.time()
+    day_dir = None
+    tmp_tifs = []
+    try:
+        product = PRODUCTS[product_name]
+        job = DAY_JOBS[product_name]
+        day_dir = tempfile.mkdtemp(prefix=day + "_", dir=scratch_dir)
+        outputs = output_paths(product_name, output_dir, day)
+        # write to temporary names so an interrupted day doesn't leave outputs
+        # that look finished
+        partials = [output + ".part.tif" for output in outputs]
+        if not fused:
+            tmp_tifs = [os.path.join(tmp_dir, "%s_%s_Sinusoidal_Tmp.tif" % (day, suffix))
+                        for subdir, suffix in job.outputs]
+        vrts = write_day_vrts(product, hdf_paths, day_dir, day)
+        for output in outputs:
+            if not os.path.isdir(os.path.dirname(output)):
+                try:
+                    os.makedirs(os.path.dirname(output))
+                except OSError:
+                    # another worker got there first
+                    pass
+
+        if fused:
+            # reproject as it goes, straight into the outputs
+            creation_options = OUTPUT_CREATION_OPTIONS + \
+                ["NUM_THREADS=%d" % resources.n_threads]
+        else:
+            creation_options = TMP_CREATION_OPTIONS
+        # in this process, with the GDAL and numexpr set up by _init_worker
+        calculate_files(product_name, vrts, tmp_tifs or partials, job.ndv,
+                        wgs84=fused, creation_options=creation_options,
+                        n_threads=resources.n_threads, index=_worker_index)
+
+        for tmp_tif, partial in zip(tmp_tifs, partials):
+            cmd = ["gdalwarp", "-q", "-overwrite", "-of", "GTiff"]
+            for co in OUTPUT_CREATION_OPTIONS + ["NUM_THREADS=%d" % resources.n_threads]:
+                cmd.extend(["-co", co])
+            cmd.extend(["-multi", "-wo", "NUM_THREADS=%d" % resources.n_threads,
+                        "-wm", str(WARP_MEMORY_MB), "-t_srs", "EPSG:4326"])
+            cmd.extend(WARP_EXTENT)
+            cmd.extend(["-dstnodata", str(job.ndv), tmp_tif, partial])
+            subprocess.check_call(cmd)
+        for partial, output in zip(partials, outputs):
+            os.rename(partial, output)
+
+        if vrt_dir is not None:
+            for vrt in vrts:
+                shutil.copy(vrt, vrt_dir)
+        return day, True, time.time() - t0, ""
+    except Exception as e:
+        # anything else too, so the main process always hears back and can
+        # free the day's staging space
+        return day, False, time.time() - t0, str(e)
+    finally:
+        if day_dir is not None:
+            shutil.rmtree(day_dir, ignore_errors=True)
+        for tmp_tif in tmp_tifs:
+            if os.path.exists(tmp_tif):
+                os.remove(tmp_tif)
+
+
+def _init_worker(resources, warp_index, started=None):
+    global _worker_index, _worker_started
+    _worker_started = started
+    # the workers calculate day after day in-process; gdalwarp picks the
+    # cache size up from the environment
+    os.environ["GDAL_CACHEMAX"] = str(resources.cache_mb)
+    gdal.SetCacheMax(resources.cache_mb * 1024 * 1024)
+    ne.set_num_threads(resources.n_threads)
+    # the mosaic VRTs refer to hundreds of HDFs, and the HDF4 library can't
+    # have more than 32 open at once
+    gdal.SetConfigOption("GDAL_MAX_DATASET_POOL_SIZE", "30")
+    if warp_index is not None:
+        _worker_index = WarpIndex(warp_index)
+
+
+def process_days(product_name, data_dir, output_dir, scratch_dir, tmp_dir,
+                 resources, vrt_dir=None, days=None, staging_mb=None,
+                 fused=False, warp_index=None):
+    """Process every day of a product that hasn't been done yet.
+
+    The days' HDFs are staged into scratch_dir in day order, up to staging_mb
+    (default enough for every worker plus PREFETCH_DAYS), and each day is
+    handed to the pool once it's staged. With fused, the calculation
+    reprojects as it goes (modis_calc.calculate_files' wgs84) rather than writing
+    temporary sinusoidal tiffs for gdalwarp, looking the source pixels up in
+    warp_index (see warp_index.py) if it's given, which is built first if it
+    doesn't exist.
+
+    Returns
+    -------
+    A list of (day, message) for the days that failed.
+    """
+    all_days = find_days(data_dir, product_name)
+    todo = []
+    for day, hdf_paths in all_days.items():
+        if days is not None and day not in days:
+            continue
+        if all(os.path.exists(p) for p in output_paths(product_name, output_dir, day)):
+            continue
+        todo.append((day, sorted(hdf_paths, key=_tile_order)))
+    print("%d days found, %d to process with %d workers (GDAL_CACHEMAX=%d, %d threads each)" % (
+        len(all_days), len(todo), resources.n_workers, resources.cache_mb,
+        resources.n_threads))
+    failed = []
+    if not todo:
+        return failed
+    if warp_index is not None and not os.path.exists(warp_index + ".cols.npy"):
+        print("building the warp index %s" % warp_index)
+        product = PRODUCTS[product_name]
+        xsize, ysize = mosaic_size(product)
+        build_index(warp_index, mosaic_geotransform(product), xsize, ysize)
+    if staging_mb is None:
+        staging_mb = (resources.n_workers + PREFETCH_DAYS) * DAY_HDFS_MB
+    staging = StagingArea(tempfile.mkdtemp(prefix="staging_", dir=scratch_dir),
+                          staging_mb * 1024 * 1024)
+    # where the workers write each day's VRTs, cleared at the end in case a
+    # worker died before it could tidy up after itself
+    work_dir = tempfile.mkdtemp(prefix="days_", dir=scratch_dir)
+    done = []
+    # day: AsyncResult, for the days in the pool. every day leaves it through
+    # day_finished, which frees its staging space
+    running = {}
+    lock = threading.Condition()
+    lost_workers = []
+
+    # runs in the pool's result thread, or watch_workers
+    def day_finished(result):
+        day, ok, seconds, message = result
+        with lock:
+            if running.pop(day, None) is None:
+                # already given up on
+                return
+            staging.release(day)
+            done.append(day)
+            if ok:
+                print("%s done in %.0fs (%d of %d)" % (day, seconds, len(done), len(todo)))
+            else:
+                print("%s FAILED: %s" % (day, message))
+                failed.append((day, message))
+            lock.notify_all()
+
+    # if process_day couldn't be run at all, e.g. its task couldn't be pickled
+    def day_raised(day, e):
+        day_finished((day, False, 0, "%s: %s" % (type(e).__name__, e)))
+
+    # a worker that dies (e.g. in GDAL) takes its day with it, without a
+    # result, so the days still running on workers that have gone are failed
+    # here. a day is only given up on if it still has no result the next
+    # time round, in case the worker sent one and then went
+    started = multiprocessing.SimpleQueue()
+    stop = threading.Event()
+
+    def watch_workers():
+        pids = {}
+        suspects = set()
+        while not stop.wait(WORKER_CHECK_SECONDS):
+            while not started.empty():
+                day, pid = started.get()
+                pids[day] = pid
+            alive = set(p.pid for p in multiprocessing.active_children())
+            with lock:
+                lost = set(day for day in running
+                           if day in pids and pids[day] not in alive)
+            for day in lost & suspects:
+                lost_workers.append(day)
+                day_finished((day, False, 0, "the worker processing it died"))
+            suspects = lost
+
+    pool = multiprocessing.Pool(resources.n_workers, _init_worker,
+                                (resources, warp_index if fused else None, started))
+    watcher = threading.Thread(target=watch_workers)
+    watcher.daemon = True
+    watcher.start()
+    finished = False
+    try:
+        for day, hdf_paths in todo:
+            # waits here while the staging area is full of days still being
+            # processed
+            try:
+                staged = staging.stage(day, hdf_paths, _tile_order)
+            except (IOError, OSError) as e:
+                print("%s FAILED to stage: %s" % (day, e))
+                failed.append((day, str(e)))
+                continue
+            with lock:
+                running[day] = pool.apply_async(
+                    process_day,
+                    ((product_name, day, staged, output_dir, work_dir,
+                      tmp_dir, vrt_dir, resources, fused),),
+                    callback=day_finished,
+                    error_callback=functools.partial(day_raised, day))
+        with lock:
+            while running:
+                lock.wait()
+        finished = True
+    finally:
+        stop.set()
+        if finished and not lost_workers:
+            pool.close()
+        else:
+            # the pool would wait forever for a lost day's result
+            pool.terminate()
+        pool.join()
+        staging.close()
+        shutil.rmtree(staging.root, ignore_errors=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return failed
+
+
+def main():
+    usage = "usage: %prog -p PRODUCT [options] DATA_DIR OUTPUT_DIR"
+    parser = OptionParser(usage)
+    parser.add_option("-p", "--product", dest="product",
+                      help="product to process, one of %s" % sorted(DAY_JOBS.keys()))
+    parser.add_option("--memory", dest="memory_gb", type=float, default=None,
+                      help="GB of memory to use (default 80% of this machine's)")
+    parser.add_option("--cpus", dest="n_cpus", type=int, default=None,
+                      help="CPUs to use (default all of them)")
+    parser.add_option("-j", "--jobs", dest="n_workers", type=int, default=None,
+                      help="days to process at once (default worked out from --memory and --cpus)")
+    parser.add_option("--scratch", dest="scratch_dir", default=None,
+                      help="fast scratch directory to stage HDFs in, ideally a RAM disk "
+                           "(default the system temp directory)")
+    parser.add_option("--scratch-in-memory", dest="scratch_in_memory", action="store_true",
+                      default=None,
+                      help="count the staged HDFs against --memory (default: if --scratch is under /dev/shm)")
+    parser.add_option("--staging-gb", dest="staging_gb", type=float, default=None,
+                      help="GB of HDFs to stage ahead in --scratch at once "
+                           "(default a day per worker plus %d)" % PREFETCH_DAYS)
+    parser.add_option("--tmp", dest="tmp_dir", default=None,
+                      help="directory for the temporary sinusoidal tiffs (default the system temp directory)")
+    parser.add_option("--fused", dest="fused", action="store_true", default=False,
+                      help="reproject as the days are calculated instead of writing temporary "
+                           "sinusoidal tiffs and running gdalwarp")
+    parser.add_option("--warp-index", dest="warp_index", default=None,
+                      help="with --fused, reproject by looking the pixels up in this index "
+                           "(see warp_index.py), building it first if need be")
+    parser.add_option("--vrt-dir", dest="vrt_dir", default=None,
+                      help="keep each day's mosaic VRTs in this directory")
+    parser.add_option("-d", "--days", dest="days", default=None,
+                      help="comma separated day tokens (e.g. A2002345) to process, default all")
+
+    (opts, args) = parser.parse_args()
+    if len(args) != 2 or opts.product not in DAY_JOBS:
+        parser.print_help()
+        sys.exit(1)
+    data_dir, output_dir = args
+
+    memory_mb = int(opts.memory_gb * 1024) if opts.memory_gb else \
+        int((physical_memory_mb() or 16384) * 0.8)
+    n_cpus = opts.n_cpus or multiprocessing.cpu_count()
+    scratch_dir = opts.scratch_dir or tempfile.gettempdir()
+    tmp_dir = opts.tmp_dir or tempfile.gettempdir()
+    for d in (scratch_dir, tmp_dir, opts.vrt_dir):
+        if d is not None and not os.path.isdir(d):
+            os.makedirs(d)
+    scratch_in_memory = opts.scratch_in_memory
+    if scratch_in_memory is None:
+        scratch_in_memory = os.path.abspath(scratch_dir).startswith("/dev/shm")
+    resources = plan_resources(memory_mb, n_cpus, scratch_in_memory, opts.n_workers)
+    days = set(opts.days.split(",")) if opts.days else None
+
+    staging_mb = int(opts.staging_gb * 1024) if opts.staging_gb else None
+    failed = process_days(opts.product, data_dir, output_dir, scratch_dir,
+                          tmp_dir, resources, opts.vrt_dir, days, staging_mb,
+                          opts.fused, opts.warp_index)
+    if failed:
+        print("%d days failed: %s" % (len(failed), ", ".join(day for day, message in failed)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
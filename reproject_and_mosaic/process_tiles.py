@@ -0,0 +1,312 @@
+#-------------------------------------------------------------------------------
+# Name:     process_tiles
+# Purpose:  Calculate the indices / temperatures of each HDF tile on its own,
+#           in a pool of worker processes, and only mosaic and reproject the
+#           results afterwards
+# Note:     Walking blocks of a global VRT of the HDFs means one block can
+#           need several HDFs, and with hundreds of them behind each VRT and
+#           at most 30 open at once (GDAL_MAX_DATASET_POOL_SIZE) they are
+#           opened and closed over and over. Here each worker reads all the
+#           fields it needs from one HDF, once, a whole tile at a time.
+#-------------------------------------------------------------------------------
+"""
+Process days of a product tile by tile rather than through a global VRT.
+
+For each day, every granule is handed to the pool: a worker reads each of
+its fields once, at the tile's native 1200x1200, runs the same calculation
+as calculate_indices.py / calculate_temps.py (from modis_calc) and
+writes each output as a small sinusoidal Float32 tiff. The main process then
+mosaics those with modis_vrt, as it does the HDFs, and reprojects the
+mosaics into the compressed WGS84 outputs a strip at a time (see
+strip_warp.py), while the pool gets on with the next day's tiles.
+
+The outputs are the same files process_days.py writes.
+
+    python process_tiles.py -p MCD43B4 /data/MCD43B4 /output/MCD43B4_Indices \\
+        --scratch /dev/shm/modis --warp-index /data/warp_index/modis_1km
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from osgeo import gdal, gdal_array
+import numpy as np
+import numexpr as ne
+
+from block_pipeline import blockList, coveredBlocks
+from modis_calc import CALCULATIONS, calculate
+from modis_products import PRODUCTS, SIN_WKT, mosaic_geotransform, \
+    mosaic_size, parse_granule, subdataset_name
+from modis_vrt import mosaic_vrt_xml
+from process_days import DAY_JOBS, OUTPUT_CREATION_OPTIONS, find_days, \
+    output_paths
+from strip_warp import STRIP_ROWS, StripWarper
+from warp_index import WarpIndex, build_index
+
+# the per-tile tiffs are read back through the mosaic VRT, so store them in
+# strips of rows like the HDFs
+TILE_BLOCK_ROWS = 100
+TILE_CREATION_OPTIONS = ["BLOCKYSIZE=%d" % TILE_BLOCK_ROWS]
+
+# GDAL cache (MB) for each tile worker: a tile is read once and not revisited
+TILE_CACHE_MB = 256
+
+# the share of the CPUs for reprojecting and compressing one day, while the
+# rest calculate the next day's tiles
+WARP_CPU_SHARE = 0.25
+
+
+def split_cpus(n_cpus, n_workers=None, n_threads=None):
+    """Divide the CPUs between the tile workers and the threads assembling
+    the day before, as (n_workers, n_threads), as they run at the same time.
+    Either can be given, and the other gets the rest."""
+    if n_threads is None:
+        if n_workers is None:
+            n_threads = max(1, int(n_cpus * WARP_CPU_SHARE))
+        else:
+            n_threads = max(1, n_cpus - n_workers)
+    if n_workers is None:
+        n_workers = max(1, n_cpus - n_threads)
+    return n_workers, n_threads
+
+
+def tile_geotransform(product, h, v):
+    """The geotransform of one tile of the sinusoidal grid."""
+    gt = list(mosaic_geotransform(product))
+    gt[0] += h * product.tile_pixels * gt[1]
+    gt[3] += v * product.tile_pixels * gt[5]
+    return gt
+
+
+def process_tile(task):
+    """Calculate the outputs for one granule, in a worker. Returns
+    (hdf_path, list of output tiffs, message), the list None if it failed."""
+    product_name, hdf_path, tile_dir = task
+    product = PRODUCTS[product_name]
+    job = DAY_JOBS[product_name]
+    granule = parse_granule(hdf_path)
+    tile = product.tile_pixels
+    try:
+        band_type = gdal_array.GDALTypeCodeToNumericTypeCode(
+            gdal.GetDataTypeByName(product.data_type))
+        bands = np.empty((len(product.subdatasets), tile, tile), dtype=band_type)
+        input_ndvs = []
+        for i, subdataset in enumerate(product.subdatasets):
+            ds = gdal.Open(subdataset_name(hdf_path, product, subdataset))
+            if ds is None:
+                raise IOError("couldn't open %s of %s" % (subdataset, hdf_path))
+            band = ds.GetRasterBand(1)
+            band.ReadAsArray(buf_obj=bands[i])
+            # as the mosaic VRTs would report it, the product's if it has none
+            ndv = band.GetNoDataValue()
+            input_ndvs.append(product.nodata if ndv is None else ndv)
+            ds = band = None
+        results = calculate(CALCULATIONS[product_name], bands, input_ndvs, job.ndv)
+
+        driver = gdal.GetDriverByName("GTiff")
+        tile_paths = []
+        for (subdir, suffix), result in zip(job.outputs, results):
+            path = os.path.join(tile_dir, "h%02dv%02d_%s.tif" % (granule.h, granule.v, suffix))
+            ds = driver.Create(path, tile, tile, 1, gdal.GDT_Float32,
+                               TILE_CREATION_OPTIONS)
+            ds.SetGeoTransform(tile_geotransform(product, granule.h, granule.v))
+            ds.SetProjection(SIN_WKT)
+            band = ds.GetRasterBand(1)
+            band.SetNoDataValue(job.ndv)
+            band.WriteArray(result)
+            ds = None
+            tile_paths.append(path)
+        return hdf_path, tile_paths, ""
+    except Exception as e:
+        return hdf_path, None, str(e)
+
+
+def _init_tile_worker():
+    # the parallelism is across tiles, one thread each
+    ne.set_num_threads(1)
+    gdal.SetCacheMax(TILE_CACHE_MB * 1024 * 1024)
+
+
+def assemble_day(product_name, tile_results, outputs, vrt_dir, n_threads=1,
+                 index=None):
+    """Mosaic a day's per-tile results and reproject them into the outputs.
+
+    Parameters
+    ----------
+    product_name: str
+    tile_results: list
+        (hdf_path, list of output tiffs) from process_tile, for the tiles
+        that worked
+    outputs: list
+        The WGS84 GeoTIFFs to write, in DAY_JOBS order
+    vrt_dir: str
+        Where to write the mosaic VRTs
+    n_threads: int
+        For the warp and the output compression
+    index: warp_index.WarpIndex
+        If given, reproject with this rather than gdal.Warp
+    Returns
+    -------
+    The mosaic VRT paths.
+    """
+    product = PRODUCTS[product_name]
+    job = DAY_JOBS[product_name]
+    vrt_paths = []
+    for i, (subdir, suffix) in enumerate(job.outputs):
+        sources = []
+        for hdf_path, tile_paths in tile_results:
+            granule = parse_granule(hdf_path)
+            sources.append((tile_paths[i], granule.h, granule.v))
+        vrt_path = os.path.join(vrt_dir, "%s.vrt" % suffix)
+        with open(vrt_path, "w") as f:
+            f.write(mosaic_vrt_xml(product, sources, "Float32", job.ndv,
+                                   TILE_BLOCK_ROWS))
+        vrt_paths.append(vrt_path)
+
+    xsize, ysize = mosaic_size(product)
+    tile = product.tile_pixels
+    granules = [parse_granule(hdf_path) for hdf_path, tile_paths in tile_results]
+    rects = [(g.h * tile, g.v * tile, tile, tile) for g in granules]
+    mosaics = [gdal.Open(vrt_path) for vrt_path in vrt_paths]
+    warper = StripWarper(outputs, job.ndv, mosaic_geotransform(product),
+                         creation_options=OUTPUT_CREATION_OPTIONS +
+                         ["NUM_THREADS=%d" % n_threads],
+                         n_threads=n_threads, index=index)
+    try:
+        # strips with no tiles in them are left as nodata
+        for xoff, yoff, width, height in coveredBlocks(
+                blockList(xsize, ysize, xsize, STRIP_ROWS), rects):
+            warper.write(yoff, [ds.GetRasterBand(1).ReadAsArray(0, yoff, width, height)
+                                for ds in mosaics])
+    finally:
+        warper.close()
+        mosaics = None
+    return vrt_paths
+
+
+def process_days_by_tile(product_name, data_dir, output_dir, scratch_dir,
+                         n_workers, n_threads=1, days=None, warp_index=None):
+    """Process every day of a product that hasn't been done yet, tile by tile.
+
+    Each day's tiles are calculated in a pool of n_workers processes; while
+    the main process mosaics and reprojects one day (with n_threads), the
+    pool calculates the next one, so the two together shouldn't be more
+    than the CPUs (see split_cpus). With warp_index (see warp_index.py) the reprojection is a
+    lookup, and the index is built first if it doesn't exist.
+
+    Returns
+    -------
+    A list of (day, message) for the days that failed.
+    """
+    all_days = find_days(data_dir, product_name)
+    todo = [(day, hdf_paths) for day, hdf_paths in all_days.items()
+            if (days is None or day in days) and not
+            all(os.path.exists(p) for p in output_paths(product_name, output_dir, day))]
+    print("%d days found, %d to process with %d tile workers" % (
+        len(all_days), len(todo), n_workers))
+    failed = []
+    if not todo:
+        return failed
+    index = None
+    if warp_index is not None:
+        if not os.path.exists(warp_index + ".cols.npy"):
+            print("building the warp index %s" % warp_index)
+            product = PRODUCTS[product_name]
+            xsize, ysize = mosaic_size(product)
+            build_index(warp_index, mosaic_geotransform(product), xsize, ysize)
+        index = WarpIndex(warp_index)
+
+    pool = multiprocessing.Pool(n_workers, _init_tile_worker)
+
+    def start_day(day, hdf_paths):
+        tile_dir = tempfile.mkdtemp(prefix=day + "_", dir=scratch_dir)
+        tasks = [(product_name, hdf_path, tile_dir) for hdf_path in hdf_paths]
+        return tile_dir, time.time(), pool.map_async(process_tile, tasks)
+
+    try:
+        pending = start_day(*todo[0])
+        for n, (day, hdf_paths) in enumerate(todo):
+            tile_dir, t0, async_result = pending
+            results = async_result.get()
+            if n + 1 < len(todo):
+                pending = start_day(*todo[n + 1])
+            outputs = output_paths(product_name, output_dir, day)
+            # write to temporary names so an interrupted day doesn't leave
+            # outputs that look finished
+            partials = [output + ".part.tif" for output in outputs]
+            try:
+                errors = ["%s: %s" % (os.path.basename(hdf_path), message)
+                          for hdf_path, tile_paths, message in results
+                          if tile_paths is None]
+                if errors:
+                    raise IOError("; ".join(errors))
+                for output in outputs:
+                    if not os.path.isdir(os.path.dirname(output)):
+                        os.makedirs(os.path.dirname(output))
+                assemble_day(product_name,
+                                    [(hdf_path, tile_paths)
+                                     for hdf_path, tile_paths, message in results],
+                                    partials, tile_dir, n_threads, index)
+                for partial, output in zip(partials, outputs):
+                    os.rename(partial, output)
+                print("%s done in %.0fs (%d of %d)" % (day, time.time() - t0,
+                                                       n + 1, len(todo)))
+            except Exception as e:
+                print("%s FAILED: %s" % (day, e))
+                failed.append((day, str(e)))
+            finally:
+                shutil.rmtree(tile_dir, ignore_errors=True)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+def main():
+    usage = "usage: %prog -p PRODUCT [options] DATA_DIR OUTPUT_DIR"
+    parser = OptionParser(usage)
+    parser.add_option("-p", "--product", dest="product",
+                      help="product to process, one of %s" % sorted(DAY_JOBS.keys()))
+    parser.add_option("-j", "--jobs", dest="n_workers", type=int, default=None,
+                      help="tiles to calculate at once (default the CPUs not used by --warp-threads)")
+    parser.add_option("--warp-threads", dest="n_threads", type=int, default=None,
+                      help="threads for the reprojection and compression, which run alongside "
+                           "the tile workers (default a quarter of the CPUs)")
+    parser.add_option("--cpus", dest="n_cpus", type=int, default=None,
+                      help="CPUs to use (default all of them)")
+    parser.add_option("--scratch", dest="scratch_dir", default=None,
+                      help="directory for the per-tile tiffs, ideally a RAM disk "
+                           "(default the system temp directory)")
+    parser.add_option("--warp-index", dest="warp_index", default=None,
+                      help="reproject by looking the pixels up in this index "
+                           "(see warp_index.py), building it first if need be")
+    parser.add_option("-d", "--days", dest="days", default=None,
+                      help="comma separated day tokens (e.g. A2002345) to process, default all")
+
+    (opts, args) = parser.parse_args()
+    if len(args) != 2 or opts.product not in DAY_JOBS:
+        parser.print_help()
+        sys.exit(1)
+    data_dir, output_dir = args
+
+    n_workers, n_threads = split_cpus(opts.n_cpus or multiprocessing.cpu_count(),
+                                      opts.n_workers, opts.n_threads)
+    scratch_dir = opts.scratch_dir or tempfile.gettempdir()
+    if not os.path.isdir(scratch_dir):
+        os.makedirs(scratch_dir)
+    days = set(opts.days.split(",")) if opts.days else None
+
+    failed = process_days_by_tile(opts.product, data_dir, output_dir, scratch_dir,
+                                  n_workers, n_threads,
+                                  days, opts.warp_index)
+    if failed:
+        print("%d days failed: %s" % (len(failed), ", ".join(day for day, message in failed)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#-------------------------------------------------------------------------------
+# Name:     staging
+# Purpose:  Copy the HDFs for upcoming days onto a fast scratch disk while the
+#           current days are being processed, within a fixed space budget
+#-------------------------------------------------------------------------------
+"""
+A bounded staging area for the days' HDFs.
+
+The batch files copied a day's HDFs to the RAM disk at the start of each day,
+so with 4 processes the archive disk sat idle while they computed and then
+got 4 copies at once. Here a single prefetcher copies days one after another,
+each day's files in tile order with large sequential reads, so the archive
+disk streams continuously, and only blocks when the scratch area is full.
+
+Each staged day is pinned while it's being processed. Once it's released it
+stays on the scratch disk (in case it's wanted again) until the space is
+needed, least recently released first.
+"""
+
+import collections
+import os
+import shutil
+import threading
+
+# big reads keep the archive disk streaming
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def _copy(src, dst):
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+
+
+class StagingArea(object):
+    """Files for several keys (e.g. days), copied into a scratch directory
+    within a byte budget.
+
+    Parameters
+    ----------
+    root: str
+        The scratch directory
+    budget_bytes: int
+        How much may be staged at once. A single key bigger than this is still
+        staged, once nothing else is.
+    """
+
+    def __init__(self, root, budget_bytes):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        # key: (list of staged paths, bytes), in-use entries and released ones
+        # oldest release first
+        self._pinned = {}
+        self._released = collections.OrderedDict()
+        self._cond = threading.Condition()
+
+    def _evict_one(self):
+        key, (paths, n_bytes) = self._released.popitem(last=False)
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+        self.used_bytes -= n_bytes
+
+    def stage(self, key, paths, order=None):
+        """Copy some files into the staging area, waiting for space if need
+        be, and pin them until `release(key)`.
+
+        Parameters
+        ----------
+        key: str
+            Name for this set of files, e.g. the day
+        paths: list
+            The files to copy
+        order: function
+            Sort key for the order to copy them in, e.g. by tile
+        Returns
+        -------
+        The staged paths, in the same order as `paths`.
+        """
+        with self._cond:
+            if key in self._released:
+                # still here from before
+                entry = self._released.pop(key)
+                self._pinned[key] = entry
+                return entry[0]
+        n_bytes = sum(os.path.getsize(p) for p in paths)
+        with self._cond:
+            while self.used_bytes + n_bytes > self.budget_bytes:
+                if self._released:
+                    self._evict_one()
+                elif self._pinned:
+                    self._cond.wait()
+                else:
+                    break
+            self.used_bytes += n_bytes
+        key_dir = os.path.join(self.root, key)
+        staged = [os.path.join(key_dir, os.path.basename(p)) for p in paths]
+        try:
+            if not os.path.isdir(key_dir):
+                os.makedirs(key_dir)
+            for src, dst in sorted(zip(paths, staged),
+                                   key=lambda pair: order(pair[0]) if order else pair[0]):
+                _copy(src, dst)
+        except Exception:
+            shutil.rmtree(key_dir, ignore_errors=True)
+            with self._cond:
+                self.used_bytes -= n_bytes
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._pinned[key] = (staged, n_bytes)
+        return staged
+
+    def release(self, key, discard=False):
+        """Done with a key's files for now. They stay staged until the space is
+        needed, unless `discard`."""
+        with self._cond:
+            entry = self._pinned.pop(key, None)
+            if entry is not None:
+                if discard:
+                    shutil.rmtree(os.path.join(self.root, key),
+                                  ignore_errors=True)
+                    self.used_bytes -= entry[1]
+                else:
+                    self._released[key] = entry
+            self._cond.notify_all()
+
+    def close(self):
+        """Remove everything that has been released."""
+        with self._cond:
+            while self._released:
+                self._evict_one()
@@ -0,0 +1,174 @@
+#-------------------------------------------------------------------------------
+# Name:     strip_warp
+# Purpose:  Reproject a global sinusoidal mosaic into the global 30 arcsecond
+#           WGS84 GeoTIFFs a strip at a time, as it's calculated, instead of
+#           writing it to a temporary sinusoidal tiff and running gdalwarp
+# Note:     Sinusoidal y is proportional to latitude, so a full-width strip of
+#           sinusoidal rows covers exactly a band of latitude, and the output
+#           rows in that band only need those rows. Each strip is warped on
+#           its own in memory and written straight into the outputs.
+#-------------------------------------------------------------------------------
+"""
+Warp full-width strips of a global sinusoidal mosaic into global WGS84
+GeoTIFFs, giving the same result as the batch files'
+
+    gdalwarp -t_srs EPSG:4326 -te -180 -90 180 90
+        -tr 0.008333333333333 -0.008333333333333 -dstnodata NDV
+
+(nearest neighbour, as gdalwarp defaults to) without the temporary
+uncompressed Float32 sinusoidal tiffs, which are 3.7Gb each at 1km and are
+written once and read back once per output.
+
+    warper = StripWarper([evi_path, tcb_path], ndv, vrt.GetGeoTransform(),
+                         creation_options=["COMPRESS=LZW", "PREDICTOR=2",
+                                           "TILED=YES", "SPARSE_OK=TRUE"])
+    for row in range(0, vrt.RasterYSize, STRIP_ROWS):
+        ...
+        warper.write(row, [evi, tcb])
+    warper.close()
+"""
+
+from osgeo import gdal, osr
+import math
+
+from modis_products import SIN_RADIUS, SIN_WKT, WGS84_GEOTRANSFORM, \
+    WGS84_RES, WGS84_XSIZE, WGS84_YSIZE
+
+# rows per strip: a whole number of the outputs' 256 row tiles, so each tile
+# is compressed and written once
+STRIP_ROWS = 512
+
+
+def _wgs84_wkt():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    return srs.ExportToWkt()
+
+
+def strip_dst_rows(src_geotransform, src_row, n_rows):
+    """The rows of the WGS84 output covered by some rows of the sinusoidal
+    mosaic, as (first, end), clipped to the output."""
+    y_top = src_geotransform[3] + src_row * src_geotransform[5]
+    y_bottom = y_top + n_rows * src_geotransform[5]
+    lat_top = math.degrees(y_top / SIN_RADIUS)
+    lat_bottom = math.degrees(y_bottom / SIN_RADIUS)
+    first = int(round((WGS84_GEOTRANSFORM[3] - lat_top) / WGS84_RES))
+    end = int(round((WGS84_GEOTRANSFORM[3] - lat_bottom) / WGS84_RES))
+    return max(0, first), min(WGS84_YSIZE, end)
+
+
+class StripWarper(object):
+    """Global WGS84 outputs, filled from full-width strips of a sinusoidal
+    mosaic.
+
+    Parameters
+    ----------
+    out_paths: list
+        The output files, one per array passed to write()
+    ndv: float
+        Nodata value of the strips and the outputs
+    src_geotransform: tuple
+        Geotransform of the whole sinusoidal mosaic
+    src_projection: str
+        WKT of the mosaic, default the MODIS sinusoidal
+    out_format: str
+        GDAL driver for the outputs
+    creation_options: list
+        For the outputs, e.g. COMPRESS=LZW
+    n_threads: int
+        For the warp
+    index: warp_index.WarpIndex
+        If given, look the source pixels up in this precomputed index rather
+        than calling gdal.Warp for each strip
+    error_threshold: float
+        For gdal.Warp's approximate transformer, in pixels; default as gdalwarp
+    """
+
+    def __init__(self, out_paths, ndv, src_geotransform, src_projection=SIN_WKT,
+                 out_format="GTiff", creation_options=None, n_threads=1,
+                 index=None, error_threshold=None):
+        self.ndv = ndv
+        self.src_geotransform = tuple(src_geotransform)
+        self.src_projection = src_projection
+        self.n_threads = n_threads
+        self.index = index
+        self.error_threshold = error_threshold
+        self.dst_projection = _wgs84_wkt()
+        driver = gdal.GetDriverByName(out_format)
+        self.outputs = []
+        for path in out_paths:
+            ds = driver.Create(path, WGS84_XSIZE, WGS84_YSIZE, 1, gdal.GDT_Float32,
+                               creation_options or [])
+            ds.SetGeoTransform(WGS84_GEOTRANSFORM)
+            ds.SetProjection(self.dst_projection)
+            ds.GetRasterBand(1).SetNoDataValue(ndv)
+            self.outputs.append(ds)
+        # in-memory strips, kept for the next strip of the same size
+        self._src = None
+        self._dst = None
+
+    def _mem_dataset(self, current, xsize, ysize, n_bands, projection):
+        if current is not None and current.RasterXSize == xsize and \
+                current.RasterYSize == ysize and current.RasterCount == n_bands:
+            return current
+        ds = gdal.GetDriverByName("MEM").Create("", xsize, ysize, n_bands,
+                                                gdal.GDT_Float32)
+        ds.SetProjection(projection)
+        for b in range(n_bands):
+            ds.GetRasterBand(b + 1).SetNoDataValue(self.ndv)
+        return ds
+
+    def warp_strip(self, src_row, arrays):
+        """Warp one strip, returning (first output row, list of arrays) or
+        None if it's outside the output."""
+        n_rows, xsize = arrays[0].shape
+        first, end = strip_dst_rows(self.src_geotransform, src_row, n_rows)
+        if end <= first:
+            return None
+        if self.index is not None:
+            return first, [self.index.gather(arr, src_row, first, end, self.ndv)
+                           for arr in arrays]
+        self._src = self._mem_dataset(self._src, xsize, n_rows, len(arrays),
+                                      self.src_projection)
+        gt = list(self.src_geotransform)
+        gt[3] = gt[3] + src_row * gt[5]
+        self._src.SetGeoTransform(gt)
+        for b, arr in enumerate(arrays):
+            self._src.GetRasterBand(b + 1).WriteArray(arr)
+
+        self._dst = self._mem_dataset(self._dst, WGS84_XSIZE, end - first,
+                                      len(arrays), self.dst_projection)
+        gt = list(WGS84_GEOTRANSFORM)
+        gt[3] = gt[3] + first * gt[5]
+        self._dst.SetGeoTransform(gt)
+        gdal.Warp(self._dst, self._src, options=gdal.WarpOptions(
+            resampleAlg="near", srcNodata=self.ndv, dstNodata=self.ndv,
+            multithread=self.n_threads > 1,
+            errorThreshold=self.error_threshold,
+            warpOptions=["NUM_THREADS=%d" % self.n_threads, "INIT_DEST=NO_DATA"]))
+        return first, [self._dst.GetRasterBand(b + 1).ReadAsArray()
+                       for b in range(len(arrays))]
+
+    def write(self, src_row, arrays):
+        """Warp a strip of the sinusoidal mosaic and write it into the outputs.
+
+        Parameters
+        ----------
+        src_row: int
+            The mosaic row the strip starts at
+        arrays: list
+            One 2d array per output, full width of the mosaic
+        """
+        warped = self.warp_strip(src_row, arrays)
+        if warped is None:
+            return
+        first, out_arrays = warped
+        for ds, arr in zip(self.outputs, out_arrays):
+            ds.GetRasterBand(1).WriteArray(arr, 0, first)
+
+    def close(self):
+        for ds in self.outputs:
+            ds.FlushCache()
+        self.outputs = []
+        self._src = None
+        self._dst = None
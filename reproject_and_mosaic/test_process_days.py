@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Smoke test of process_days.py's staging and worker pool, with the GDAL work
+(write_day_vrts and calculate_files) stubbed out.
+
+    $ python -m pytest test_process_days.py
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import process_days
+except ImportError:
+    # no GDAL
+    process_days = None
+
+PRODUCT = "MCD43B4"
+DAYS = ["A2002001", "A2002009", "A2002017", "A2002025", "A2002033"]
+TILES = ["h17v07", "h18v07", "h19v08"]
+# what the stub calculate_files does with these days
+FAILING_DAY = "A2002009"
+DYING_DAY = "A2002025"
+
+
+def fake_write_day_vrts(product, hdf_paths, vrt_dir, day):
+    for path in hdf_paths:
+        # the worker is given the staged copies, not the archive
+        assert os.path.exists(path) and "staging_" in path, path
+    vrt = os.path.join(vrt_dir, day + "_Band1.vrt")
+    open(vrt, "w").close()
+    return [vrt]
+
+
+def fake_calculate_files(product_name, vrts, output_paths, ndv, **kwargs):
+    day = os.path.basename(vrts[0]).split("_")[0]
+    if day == FAILING_DAY:
+        raise RuntimeError("no good")
+    if day == DYING_DAY:
+        os._exit(1)
+    for path in output_paths:
+        with open(path, "w") as f:
+            f.write(day)
+
+
+@unittest.skipIf(process_days is None, "needs GDAL")
+@unittest.skipIf(multiprocessing.get_start_method() != "fork",
+                 "the stubs only reach the workers if they're forked")
+class ProcessDaysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="test_process_days_")
+        self.data_dir = os.path.join(self.root, "data")
+        self.output_dir = os.path.join(self.root, "output")
+        self.scratch_dir = os.path.join(self.root, "scratch")
+        for d in (self.data_dir, self.output_dir, self.scratch_dir):
+            os.makedirs(d)
+        for day in DAYS:
+            for tile in TILES:
+                name = "%s.%s.%s.005.2007001000000.hdf" % (PRODUCT, day, tile)
+                with open(os.path.join(self.data_dir, name), "wb") as f:
+                    f.write(b"\0" * 1024 * 1024)
+        self.saved = (process_days.write_day_vrts, process_days.calculate_files,
+                      process_days.WORKER_CHECK_SECONDS)
+        process_days.write_day_vrts = fake_write_day_vrts
+        process_days.calculate_files = fake_calculate_files
+        process_days.WORKER_CHECK_SECONDS = 0.2
+
+    def tearDown(self):
+        (process_days.write_day_vrts, process_days.calculate_files,
+         process_days.WORKER_CHECK_SECONDS) = self.saved
+        shutil.rmtree(self.root)
+
+    def run_days(self, n_workers=2, staging_mb=5):
+        resources = process_days.Resources(n_workers, 256, 1)
+        return process_days.process_days(
+            PRODUCT, self.data_dir, self.output_dir, self.scratch_dir,
+            self.scratch_dir, resources, staging_mb=staging_mb, fused=True)
+
+    def test_days(self):
+        # room for fewer days than there are, so staging has to wait for the
+        # days before to be released, including the ones that fail
+        failed = dict(self.run_days())
+        self.assertEqual(sorted(failed), [FAILING_DAY, DYING_DAY])
+        self.assertIn("no good", failed[FAILING_DAY])
+        self.assertIn("died", failed[DYING_DAY])
+        for day in DAYS:
+            exists = [os.path.exists(path) for path in
+                      process_days.output_paths(PRODUCT, self.output_dir, day)]
+            self.assertEqual(exists, [day not in failed] * 3)
+        # nothing left behind on the scratch disk
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+        # and only the days that failed are done again
+        failed = dict(self.run_days())
+        self.assertEqual(sorted(failed), [FAILING_DAY, DYING_DAY])
+
+
+if __name__ == "__main__":
+    unittest.main()
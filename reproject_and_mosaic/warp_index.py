@@ -0,0 +1,220 @@
+#-------------------------------------------------------------------------------
+# Name:     warp_index
+# Purpose:  Work out once which sinusoidal pixel each pixel of the global
+#           WGS84 output comes from, so every day's warp is just a lookup
+# Note:     Every day and every variable is warped from the identical
+#           sinusoidal grid to the identical WGS84 grid, so the nearest
+#           neighbour source pixels never change
+#-------------------------------------------------------------------------------
+"""
+A nearest neighbour index from the global 30 arcsecond WGS84 grid (as in the
+batch files' gdalwarp) into a global sinusoidal mosaic.
+
+The index is two .npy files, memory mapped when used:
+
+    PATH.cols.npy: uint16, one per output pixel, the source column
+                   (INDEX_NODATA if it falls outside the mosaic)
+    PATH.rows.npy: int32, one per output row, the source row (or -1): in the
+                   sinusoidal projection y depends on latitude alone
+
+which at 1km is 1.8Gb, built in a minute or so. Warping a strip is then a
+numpy gather (see StripWarper's index option).
+
+    python warp_index.py build -p MCD43B4 M:\\warp_index\\modis_1km
+    python warp_index.py validate -p MCD43B4 M:\\warp_index\\modis_1km
+"""
+
+import os
+import sys
+from optparse import OptionParser
+
+import numpy as np
+
+from modis_products import PRODUCTS, SIN_RADIUS, WGS84_GEOTRANSFORM, \
+    WGS84_XSIZE, WGS84_YSIZE, mosaic_geotransform, mosaic_size
+
+INDEX_NODATA = 65535
+# output rows to compute at once when building
+BUILD_ROWS = 256
+
+
+def _index_paths(path):
+    return path + ".cols.npy", path + ".rows.npy"
+
+
+def build_index(path, src_geotransform, src_xsize, src_ysize):
+    """Work out the source pixel of every output pixel and save them as
+    PATH.cols.npy and PATH.rows.npy.
+
+    Parameters
+    ----------
+    path: str
+        Where to save the index, without the suffixes
+    src_geotransform: tuple
+        Of the sinusoidal mosaic
+    src_xsize, src_ysize: int
+        Size of the sinusoidal mosaic
+    """
+    cols_path, rows_path = _index_paths(path)
+    if src_xsize >= INDEX_NODATA:
+        raise ValueError("mosaic too wide for a uint16 index")
+    x0, xres, _, y0, _, yres = WGS84_GEOTRANSFORM
+    # pixel centres, as gdalwarp transforms
+    lons = np.radians(x0 + (np.arange(WGS84_XSIZE) + 0.5) * xres)
+    lats = np.radians(y0 + (np.arange(WGS84_YSIZE) + 0.5) * yres)
+
+    src_rows = np.floor((SIN_RADIUS * lats - src_geotransform[3]) /
+                        src_geotransform[5]).astype(np.int64)
+    src_rows[(src_rows < 0) | (src_rows >= src_ysize)] = -1
+    np.save(rows_path, src_rows.astype(np.int32))
+
+    cols = np.lib.format.open_memmap(cols_path + ".tmp", mode="w+",
+                                     dtype=np.uint16,
+                                     shape=(WGS84_YSIZE, WGS84_XSIZE))
+    scaled_lons = SIN_RADIUS * lons
+    for first in range(0, WGS84_YSIZE, BUILD_ROWS):
+        end = min(first + BUILD_ROWS, WGS84_YSIZE)
+        # sinusoidal x = R * lon * cos(lat)
+        x = np.cos(lats[first:end])[:, np.newaxis] * scaled_lons
+        block = np.floor((x - src_geotransform[0]) / src_geotransform[1])
+        outside = (block < 0) | (block >= src_xsize)
+        outside |= (src_rows[first:end] < 0)[:, np.newaxis]
+        block[outside] = INDEX_NODATA
+        cols[first:end] = block
+    cols.flush()
+    del cols
+    if os.path.exists(cols_path):
+        os.remove(cols_path)
+    os.rename(cols_path + ".tmp", cols_path)
+
+
+class WarpIndex(object):
+    """A saved index, memory mapped.
+
+    Parameters
+    ----------
+    path: str
+        As given to build_index
+    """
+
+    def __init__(self, path):
+        cols_path, rows_path = _index_paths(path)
+        self.cols = np.load(cols_path, mmap_mode="r")
+        self.rows = np.load(rows_path)
+        # the flat index for the last strip, for its other arrays
+        self._last_key = None
+        self._flat = None
+        self._outside = None
+
+    def _strip_index(self, src_row, n_rows, xsize, first, end):
+        key = (src_row, n_rows, xsize, first, end)
+        if key != self._last_key:
+            # intp, or take() converts it every time
+            rows = self.rows[first:end].astype(np.intp) - src_row
+            cols = np.asarray(self.cols[first:end])
+            self._outside = (cols == INDEX_NODATA) | \
+                ((rows < 0) | (rows >= n_rows))[:, np.newaxis]
+            # outside pixels point at 0 for now
+            self._flat = rows.clip(0, n_rows - 1)[:, np.newaxis] * xsize + cols
+            self._flat[self._outside] = 0
+            self._last_key = key
+        return self._flat, self._outside
+
+    def gather(self, strip, src_row, first, end, ndv):
+        """Output rows first to end, from a full-width strip of the mosaic
+        starting at src_row.
+
+        Returns
+        -------
+        An array of (end - first) by the output width, of the strip's type,
+        ndv where the source pixel isn't in the strip.
+        """
+        n_rows, xsize = strip.shape
+        flat, outside = self._strip_index(src_row, n_rows, xsize, first, end)
+        out = np.ravel(strip).take(flat)
+        out[outside] = ndv
+        return out
+
+
+def validate_index(index, product, n_strips=4, rows_per_strip=256,
+                   error_threshold=None):
+    """Compare the index with gdal.Warp, on a few strips of a mosaic whose
+    pixels hold their own column and row numbers.
+
+    Parameters
+    ----------
+    index: WarpIndex
+    product: ProductInfo
+        For the sinusoidal mosaic's size and geotransform
+    n_strips: int
+        Strips to check, spread from pole to pole
+    error_threshold: float
+        For gdal.Warp's approximate transformer, in pixels; default as
+        gdalwarp (0.125). 0 transforms every pixel exactly.
+    Returns
+    -------
+    (pixels checked, pixels different, largest column difference)
+    """
+    # only needed for this
+    from strip_warp import StripWarper
+
+    src_gt = mosaic_geotransform(product)
+    xsize, ysize = mosaic_size(product)
+    warper = StripWarper([], -1, src_gt, error_threshold=error_threshold)
+    n_checked = n_different = max_col_diff = 0
+    for src_row in np.linspace(0, ysize - rows_per_strip, n_strips).astype(int):
+        src_row = int(src_row)
+        col_ids = np.tile(np.arange(xsize, dtype=np.float32),
+                          (rows_per_strip, 1))
+        row_ids = np.repeat(np.arange(src_row, src_row + rows_per_strip,
+                                      dtype=np.float32)[:, np.newaxis],
+                            xsize, axis=1)
+        first, (gdal_cols, gdal_rows) = warper.warp_strip(src_row,
+                                                          [col_ids, row_ids])
+        end = first + gdal_cols.shape[0]
+        ours_cols = index.gather(col_ids, src_row, first, end, -1)
+        ours_rows = index.gather(row_ids, src_row, first, end, -1)
+        different = (ours_cols != gdal_cols) | (ours_rows != gdal_rows)
+        n_checked += different.size
+        n_different += int(different.sum())
+        both = (ours_cols >= 0) & (gdal_cols >= 0)
+        if both.any():
+            max_col_diff = max(max_col_diff, int(
+                np.abs(ours_cols[both] - gdal_cols[both]).max()))
+    return n_checked, n_different, max_col_diff
+
+
+def main():
+    usage = "usage: %prog build|validate -p PRODUCT INDEX_PATH"
+    parser = OptionParser(usage)
+    parser.add_option("-p", "--product", dest="product", default="MCD43B4",
+                      help="product whose mosaic grid to index, one of %s (default MCD43B4)" % sorted(PRODUCTS.keys()))
+    parser.add_option("--strips", dest="n_strips", type=int, default=4,
+                      help="strips to compare with gdal.Warp when validating (default 4)")
+    parser.add_option("--exact", dest="exact", action="store_true", default=False,
+                      help="validate against gdal.Warp transforming every pixel exactly, "
+                           "rather than with gdalwarp's default approximation")
+
+    (opts, args) = parser.parse_args()
+    if len(args) != 2 or args[0] not in ("build", "validate") or \
+            opts.product not in PRODUCTS:
+        parser.print_help()
+        sys.exit(1)
+
+    command, path = args
+    product = PRODUCTS[opts.product]
+    if command == "build":
+        xsize, ysize = mosaic_size(product)
+        build_index(path, mosaic_geotransform(product), xsize, ysize)
+        print("built %s.cols.npy and %s.rows.npy" % (path, path))
+    else:
+        n_checked, n_different, max_col_diff = validate_index(
+            WarpIndex(path), product, opts.n_strips,
+            error_threshold=0 if opts.exact else None)
+        print("%d of %d pixels differ from gdal.Warp (%.4f%%), by at most %d columns" % (
+            n_different, n_checked, 100.0 * n_different / n_checked, max_col_diff))
+        if opts.exact and n_different:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()